@@ -11,14 +11,17 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack 
 from chat import routing
+from chat.attachments import UploadSizeLimit
+from userauths.media import MediaFilesHandler
+from userauths.middleware import CachedAuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NexChat.settings')
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),        # Handles normal HTTP
-    "websocket": AuthMiddlewareStack(      # Handles WebSockets
+    # Handles normal HTTP, MEDIA_URL itself, and refuses oversized uploads before reading them
+    "http": MediaFilesHandler(UploadSizeLimit(get_asgi_application())),
+    "websocket": CachedAuthMiddlewareStack(  # Handles WebSockets
         URLRouter(
             routing.websocket_urlpatterns
         )
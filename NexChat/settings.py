@@ -63,6 +63,81 @@ CHANNEL_LAYERS = {
     }
 }
 
+# To run several daphne workers on one host, start `manage.py run_channel_broker`
+# and point every worker at it instead. The workers then need a shared cache
+# too (see CACHES below); chat refuses to start with a local-memory one:
+# CHANNEL_LAYERS = {
+#     "default": {
+#         "BACKEND": "chat.layers.UnixSocketChannelLayer",
+#         "CONFIG": {
+#             "path": str(BASE_DIR / "channels.sock"),
+#             "capacity": 100,  # Per channel
+#             "expiry": 60,  # Seconds an undelivered message is kept
+#         },
+#     }
+# }
+
+# Messages received over WebSockets are written in batches
+CHAT_WRITE_BEHIND = {
+    "MAX_BATCH": 100,  # Flush once this many messages are queued
+    "MAX_DELAY_MS": 5,  # ...or this long after the first one arrived
+}
+
+# Typing indicators are coalesced per user and conversation
+CHAT_TYPING = {
+    "TIMEOUT_MS": 5000,  # Report "stopped typing" after this much silence
+}
+
+# Who is connected is published to a cache with a heartbeat; last_activity is
+# written in batches (see chat.presence)
+CHAT_PRESENCE = {
+    "FLUSH_INTERVAL_S": 30,
+    "HEARTBEAT_S": 10,  # Refresh the online keys of connected users this often
+    "ONLINE_TTL_S": 30,  # ...which expire this long after a worker stops refreshing them
+    "CACHE": "default",  # An alias in CACHES, shared between workers
+    "FLUSH_AT_EXIT": True,  # Flush once more when the process exits
+}
+
+# Reconnecting sockets get missed direct messages replayed by seq
+CHAT_REPLAY = {
+    "BUFFER_SIZE": 200,  # Recent messages kept in memory per conversation
+    "MAX_REPLAY": 500,  # Beyond this the client reloads the page instead
+}
+
+# Optional msgpack WebSocket subprotocol (JSON stays the default). Only offered when
+# the msgpack package is installed (pip install msgpack); it is not a requirement
+CHAT_PROTOCOL = {
+    "COMPRESS_MIN_BYTES": 1024,  # Deflate binary frames at least this large
+    "COMPRESS_LEVEL": 6,
+}
+
+# Every socket gets a bounded queue of outgoing frames
+CHAT_OUTBOUND = {
+    "MAX_QUEUE": 256,
+    "POLICY": "coalesce",  # "drop_typing", "coalesce" or "disconnect" once a queue is full
+}
+
+# Opt-in: gather events per group for a few ms and deliver them as one frame
+CHAT_BATCHING = {
+    "ENABLED": False,
+    "WINDOW_MS": 15,
+    "MAX_BATCH": 50,  # Events per frame; a full batch goes out without waiting
+}
+
+# Files sent in chats, uploaded in resumable chunks (see chat.attachments)
+CHAT_ATTACHMENTS = {
+    "ROOT": BASE_DIR / 'attachments',  # Not under MEDIA_ROOT: downloads go through an access check
+    "MAX_SIZE": 100 * 1024 * 1024,
+    "CHUNK_SIZE": 2 * 1024 * 1024,  # Largest upload request, refused on Content-Length; under FILE_UPLOAD_MAX_MEMORY_SIZE it is buffered in memory
+}
+
+# The conversation list is cached per user and dropped whenever one of its rows changes
+CHAT_INBOX_CACHE = {
+    "ENABLED": True,
+    "CACHE": "default",  # An alias in CACHES
+    "TIMEOUT_S": 300,
+}
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -105,6 +180,17 @@ DATABASES = {
 }
 
 
+# In-process cache, shared by nothing outside this worker; point "default" at
+# Redis or Memcached to share it (membership and inbox entries, session and
+# user cache versions) between workers
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -151,6 +237,28 @@ MEDIA_URL = '/media/'
 
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are named by a hash of their content, so identical files are stored once
+STORAGES = {
+    "default": {"BACKEND": "userauths.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+# Caching headers for MEDIA_URL, which the ASGI application serves itself
+MEDIA_FILES = {
+    "IMMUTABLE_MAX_AGE": 365 * 24 * 60 * 60,  # Seconds, for content-addressed files
+    "MUTABLE_CACHE_CONTROL": "public, no-cache",  # Everything else, e.g. default.jpg
+}
+
+# Square copies of user and room avatars, made in a process pool when the file changes
+AVATARS = {
+    "SIZES": [48, 96, 300],
+    "WEBP": True,  # Also write a WebP copy of every size
+    "WORKERS": 2,  # Processes rendering them; 0 renders inline (tests do, see NexChat.testrunner)
+}
+
+# Runs the tests with settings only they need (inline avatar variants, no presence flush at exit)
+TEST_RUNNER = 'NexChat.testrunner.TestRunner'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -166,4 +274,13 @@ LOGIN_REDIRECT_URL = '/chat/conversations-list/'
 # Session expires after 30 minutes of inactivity
 SESSION_COOKIE_AGE = 1800  # 30 minutes in seconds
 SESSION_SAVE_EVERY_REQUEST = True  # Reset timer on each request
-SESSION_EXPIRE_AT_BROWSER_CLOSE = True  # Optional: Clear session when browser closes
\ No newline at end of file
+SESSION_EXPIRE_AT_BROWSER_CLOSE = True  # Optional: Clear session when browser closes
+
+# Database sessions with an in-process cache; touches are written at most once per interval
+SESSION_ENGINE = 'userauths.sessions'
+AUTH_CACHE = {
+    "SESSION_TTL_S": 10,  # Serve a loaded session from memory for this long
+    "USER_TTL_S": 10,  # Same for the user a WebSocket handshake resolves
+    "TOUCH_INTERVAL_S": 60,  # Skip expiry-only session writes newer than this
+    "CACHE": "default",  # Versions entries for other workers; only works if CACHES shares it
+}
\ No newline at end of file
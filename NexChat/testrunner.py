@@ -0,0 +1,29 @@
+"""
+Test runner for `manage.py test`: switches off what only makes sense in a
+running server, so the settings can keep their production defaults.
+"""
+import atexit
+
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+
+        from chat import presence
+        from userauths import avatars
+
+        # The test database is gone by the time the process exits
+        atexit.unregister(presence.flushOnExit)
+
+        # Render avatar variants inline: tests check them right after saving,
+        # and a process pool would record them after the test's data is gone
+        self.avatar_workers = avatars.WORKERS
+        avatars.WORKERS = 0
+
+    def teardown_test_environment(self, **kwargs):
+        from userauths import avatars
+
+        avatars.WORKERS = self.avatar_workers
+        super().teardown_test_environment(**kwargs)
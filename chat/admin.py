@@ -3,17 +3,37 @@ from django.contrib import admin
 from import_export.admin import ImportExportModelAdmin
 
 from .models import (
+    Attachment,
     Messages,
+    ConversationSummary,
+    ConversationSequence,
+    ReadWatermark,
     RoomModel,
     RoomMessagesModel,
+    RoomReadWatermark,
  )
 
 class MessageAdmin(ImportExportModelAdmin):
-    list_display = ['user', 'sender','recipient', 'body', 'is_read']
-    list_filter = ['is_read']
+    list_display = ['sender','recipient', 'body', 'seq', 'created_at']
+    list_filter = ['sender_deleted', 'recipient_deleted']
 
 admin.site.register(Messages, MessageAdmin)
 
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ['user', 'partner', 'last_message_preview', 'last_message_at', 'unread_count']
+
+admin.site.register(ConversationSummary, ConversationSummaryAdmin)
+
+class ConversationSequenceAdmin(admin.ModelAdmin):
+    list_display = ['low_user', 'high_user', 'last_seq']
+
+admin.site.register(ConversationSequence, ConversationSequenceAdmin)
+
+class ReadWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['user', 'partner', 'last_read_id', 'updated_at']
+
+admin.site.register(ReadWatermark, ReadWatermarkAdmin)
+
 class RoomAdmin(ImportExportModelAdmin):
     list_display = ['name', 'admin', 'created_at', 'description']
     
@@ -22,4 +42,14 @@ admin.site.register(RoomModel, RoomAdmin)
 class RoomMessagesAdmin(ImportExportModelAdmin):
     list_display = ['room', 'sender', 'message']
 
-admin.site.register(RoomMessagesModel, RoomMessagesAdmin)
\ No newline at end of file
+admin.site.register(RoomMessagesModel, RoomMessagesAdmin)
+
+class RoomReadWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['user', 'room', 'last_read_id', 'updated_at']
+
+admin.site.register(RoomReadWatermark, RoomReadWatermarkAdmin)
+
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ['name', 'uploader', 'content_type', 'size', 'received', 'created_at', 'completed_at']
+
+admin.site.register(Attachment, AttachmentAdmin)
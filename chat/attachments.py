@@ -0,0 +1,210 @@
+"""
+Files sent with direct and group messages.
+
+Uploads are resumable: the client creates an Attachment for a
+conversation, then PUTs the file in chunks of at most CHUNK_SIZE bytes,
+each with a Content-Range header:
+
+    POST /chat/attachments/                 name, size, content_type, to_user | room
+    PUT  /chat/attachments/<id>/upload      Content-Range: bytes 0-2097151/7340032
+    GET  /chat/attachments/<id>/upload      {"offset": 2097152, ...}, to resume
+
+Django reads a whole request body before the view runs (into memory up
+to FILE_UPLOAD_MAX_MEMORY_SIZE, then a temporary file), so UploadSizeLimit
+refuses a chunk on its Content-Length first, in front of the ASGI
+application.
+
+Chunks must start at or before the stored offset, so a retried chunk is
+simply written again. Once every byte is in, the next chat frame for that
+conversation can carry {"attachment_id": <id>} and the attachment goes
+out with the message.
+
+Files live under ROOT, outside MEDIA_ROOT: they are only served through
+the download view, which checks that the user is in the conversation and
+answers Range requests. Disk reads and writes run in worker threads, a
+piece at a time, so a large file neither blocks the event loop nor is
+held in memory.
+"""
+import json
+import os
+import re
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+ATTACHMENTS = getattr(settings, 'CHAT_ATTACHMENTS', {})
+ROOT = str(ATTACHMENTS.get('ROOT', os.path.join(settings.BASE_DIR, 'attachments')))
+MAX_SIZE = ATTACHMENTS.get('MAX_SIZE', 100 * 1024 * 1024)
+CHUNK_SIZE = ATTACHMENTS.get('CHUNK_SIZE', 2 * 1024 * 1024)  # Largest chunk an upload request may carry, see UploadSizeLimit
+PIECE_SIZE = 256 * 1024  # Bytes read or written per worker-thread call
+
+# Shown in the browser rather than downloaded; anything else goes out as
+# application/octet-stream, so an uploaded page or script never runs on our origin
+INLINE_TYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'audio/mpeg', 'audio/ogg', 'audio/webm', 'video/mp4', 'video/webm',
+}
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_counters = {'chunks': 0, 'bytes_received': 0, 'refused': 0, 'downloads': 0, 'range_downloads': 0}
+
+
+def fullPath(path):
+    return os.path.join(ROOT, path)
+
+
+def createFile():
+    """Makes an empty file for a new upload and returns its path relative to ROOT."""
+    name = uuid.uuid4().hex
+    path = f'{name[:2]}/{name}'
+    os.makedirs(os.path.dirname(fullPath(path)), exist_ok=True)
+    open(fullPath(path), 'xb').close()
+    return path
+
+
+def deleteFile(path):
+    try:
+        os.remove(fullPath(path))
+    except FileNotFoundError:
+        pass
+
+
+def writeChunk(path, offset, stream, length):
+    """
+    Copies length bytes from stream (the request) into the file at offset,
+    a piece at a time. Returns the number of bytes written, which is less
+    than length if the body was short.
+    """
+    written = 0
+    with open(fullPath(path), 'r+b') as file:
+        file.seek(offset)
+        while written < length:
+            piece = stream.read(min(PIECE_SIZE, length - written))
+            if not piece:
+                break
+            file.write(piece)
+            written += len(piece)
+
+    _counters['chunks'] += 1
+    _counters['bytes_received'] += written
+    return written
+
+
+def parseContentRange(header, size):
+    """(first, last) byte of an upload chunk; ValueError if the header doesn't fit the file."""
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise ValueError('Content-Range must look like "bytes <first>-<last>/<size>"')
+
+    first, last, total = (int(group) for group in match.groups())
+    if total != size or first > last or last >= size:
+        raise ValueError('Content-Range does not fit the file')
+    return first, last
+
+
+def parseRange(header, size):
+    """
+    (first, last) byte asked for by a Range header, or None to send the
+    whole file: no header, or one we don't serve (e.g. several ranges).
+    ValueError when the range is out of the file, for a 416.
+    """
+    match = RANGE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # bytes=-500: the last 500 bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+
+    if first >= size or first > last:
+        raise ValueError('Range not satisfiable')
+    return first, last
+
+
+async def readFile(path, first, last):
+    """Yields bytes first..last of a file, each piece read in a worker thread."""
+    inThread = lambda function: sync_to_async(function, thread_sensitive=False)
+
+    file = await inThread(open)(fullPath(path), 'rb')
+    try:
+        await inThread(file.seek)(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            piece = await inThread(file.read)(min(PIECE_SIZE, remaining))
+            if not piece:
+                break
+            remaining -= len(piece)
+            yield piece
+    finally:
+        file.close()
+
+
+def isUploadPath(path):
+    try:
+        return resolve(path).url_name == 'attachment-upload'
+    except Resolver404:
+        return False
+
+
+class UploadSizeLimit:
+    """
+    Wraps the HTTP application and answers upload chunks without a
+    Content-Length, or with one over CHUNK_SIZE, before the body is read.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'PUT':
+            path = scope['path'].removeprefix(scope.get('root_path', ''))
+            if isUploadPath(path):
+                refusal = self.check(dict(scope['headers']).get(b'content-length'))
+                if refusal is not None:
+                    await self.refuse(send, *refusal)
+                    return
+
+        await self.application(scope, receive, send)
+
+    def check(self, content_length):
+        """(status, message) to refuse the chunk with, or None."""
+        if content_length is None:
+            return 411, 'Chunks need a Content-Length.'
+        if not content_length.isdigit() or int(content_length) > CHUNK_SIZE:
+            return 413, f'Chunks can be at most {CHUNK_SIZE} bytes.'
+        return None
+
+    async def refuse(self, send, status, message):
+        body = json.dumps({'message': message}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'connection', b'close'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        _counters['refused'] += 1
+
+
+def countDownload(partial):
+    _counters['range_downloads' if partial else 'downloads'] += 1
+
+
+def stats():
+    """Attachment counters for this process."""
+    return dict(_counters)
+
+
+def resetStats():
+    for name in _counters:
+        _counters[name] = 0
@@ -0,0 +1,94 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+
+
+BATCHING = getattr(settings, 'CHAT_BATCHING', {})
+ENABLED = BATCHING.get('ENABLED', False)
+WINDOW = BATCHING.get('WINDOW_MS', 15) / 1000  # How long events for a group are gathered
+MAX_BATCH = BATCHING.get('MAX_BATCH', 50)  # Events per batch; a full batch goes out right away
+
+_counters = {'events': 0, 'group_sends': 0}
+
+# One batcher per event loop; its tasks belong to that loop
+_batchers = weakref.WeakKeyDictionary()
+
+
+class GroupBatcher:
+    """
+    Gathers the events sent to each channel group for `window` seconds and
+    passes them to group_send together, as one 'event_batch' event:
+
+        {"type": "event_batch", "events": [event, event, ...]}
+
+    A lone event is sent as is. Consumers unpack batches with
+    EventConsumer.event_batch, so each member handles the events in order
+    and sends its client one frame for the lot.
+    """
+
+    def __init__(self, window=WINDOW, max_batch=MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}  # group -> events waiting for the window to close
+        self.full = {}  # group -> Event set once max_batch events are waiting
+        self.tails = {}  # group -> the latest drain task, so batches go out in order
+
+    async def send(self, channel_layer, group, event):
+        _counters['events'] += 1
+        events = self.pending.get(group)
+        if events is not None:
+            events.append(event)
+            if len(events) >= self.max_batch:
+                self.full[group].set()
+            return
+
+        self.pending[group] = [event]
+        self.full[group] = asyncio.Event()
+        previous = self.tails.get(group)
+        self.tails[group] = asyncio.get_running_loop().create_task(self.drain(channel_layer, group, previous))
+
+    async def drain(self, channel_layer, group, previous):
+        try:
+            await asyncio.wait_for(self.full[group].wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+
+        events = self.pending.pop(group)
+        del self.full[group]
+
+        if previous is not None:
+            # The batch before this one may still be going out
+            await asyncio.gather(previous, return_exceptions=True)
+
+        try:
+            for start in range(0, len(events), self.max_batch):
+                batch = events[start:start + self.max_batch]
+                _counters['group_sends'] += 1
+                await channel_layer.group_send(
+                    group,
+                    batch[0] if len(batch) == 1 else {'type': 'event_batch', 'events': batch}
+                )
+        finally:
+            if self.tails.get(group) is asyncio.current_task():
+                del self.tails[group]
+
+
+def getBatcher():
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = GroupBatcher(WINDOW, MAX_BATCH)
+    return batcher
+
+
+def stats():
+    """Batching counters for this process."""
+    counters = dict(_counters)
+    counters['events_per_group_send'] = counters['events'] / counters['group_sends'] if counters['group_sends'] else 0
+    return counters
+
+
+def resetStats():
+    for name in _counters:
+        _counters[name] = 0
@@ -0,0 +1,46 @@
+"""
+Startup check for running chat on more than one worker process.
+
+Room membership, inbox lists and session/user versions are cached, and the
+signal handlers that invalidate them run in the worker that made the change;
+presence is published to a cache for the other workers to read. With a
+channel layer that connects several processes (anything but
+InMemoryChannelLayer), those caches have to be shared too, or the other
+workers keep serving removed members and stale lists until the entries
+expire, and show users connected elsewhere as offline. ChatConfig.ready() refuses to start in that case instead.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+IN_PROCESS_LAYERS = {'channels.layers.InMemoryChannelLayer'}
+IN_PROCESS_CACHES = {'django.core.cache.backends.locmem.LocMemCache'}
+
+
+def sharedCacheAliases():
+    """The CACHES aliases other workers have to see, with what uses each of them."""
+    users = [
+        ('default', 'chat.membership'),
+        (getattr(settings, 'CHAT_INBOX_CACHE', {}).get('CACHE', 'default'), 'CHAT_INBOX_CACHE'),
+        (getattr(settings, 'AUTH_CACHE', {}).get('CACHE', 'default'), 'AUTH_CACHE'),
+        (getattr(settings, 'CHAT_PRESENCE', {}).get('CACHE', 'default'), 'CHAT_PRESENCE'),
+    ]
+    aliases = {}
+    for alias, user in users:
+        aliases.setdefault(alias, []).append(user)
+    return aliases
+
+
+def checkSharedCache():
+    layer = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND')
+    if layer is None or layer in IN_PROCESS_LAYERS:
+        return
+
+    for alias, users in sharedCacheAliases().items():
+        backend = settings.CACHES.get(alias, {}).get('BACKEND')
+        if backend in IN_PROCESS_CACHES:
+            raise ImproperlyConfigured(
+                f"CHANNEL_LAYERS uses {layer}, which connects several processes, but "
+                f"CACHES['{alias}'] (used by {', '.join(users)}) is {backend}, which each process keeps "
+                f"to itself. Point it at a shared cache such as Redis or Memcached."
+            )
@@ -0,0 +1,153 @@
+"""
+Conditional GET for the conversation and group pages and their JSON
+endpoints.
+
+Before a view does any real work, ConditionalGetMixin asks it for
+validators: a few values read with one or two indexed lookups that change
+whenever the response would, and the newest timestamp among them. They
+are hashed into a weak ETag (and sent as Last-Modified), so a client that
+still has the response gets a 304 without the messages being queried or
+the template rendered:
+
+    conversation   the user's ConversationSummary row, the partner's
+                   ReadWatermark (read receipts) and last_activity
+    inbox          every ConversationSummary row of the user
+    room           RoomModel.updated_at
+    group list     the user's rooms and room read watermarks
+
+The models move these timestamps on every change the pages show (see
+ConversationSummary.touch and RoomModel.touch). Presence isn't in the
+database, so the views add it to the ETag themselves, along with the
+partner's last activity as the page shows it; both come from the cache
+chat.presence publishes to, so every worker computes the same ETag.
+
+Responses are "private, no-cache": browsers keep them but revalidate every
+time. Django checks If-None-Match before If-Modified-Since, so the ETag
+decides for every browser; Last-Modified only matters to clients that
+send nothing else.
+"""
+import hashlib
+import threading
+
+from django.contrib import messages
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from userauths.models import CustomUser
+from .models import ConversationSummary, ReadWatermark, RoomModel, RoomReadWatermark
+
+_lock = threading.Lock()
+_counters = {'not_modified': 0, 'rendered': 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def makeEtag(parts):
+    return 'W/"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def newest(*timestamps):
+    return max((timestamp for timestamp in timestamps if timestamp is not None), default=None)
+
+
+def conversation(user, partner_id):
+    """Validators for user's conversation with partner, or None if there's no such user."""
+    row = CustomUser.objects.filter(pk=partner_id).annotate(
+        summary_changed=Subquery(
+            ConversationSummary.objects.filter(user=user, partner=OuterRef('pk')).values('updated_at')[:1]
+        ),
+        read_changed=Subquery(
+            ReadWatermark.objects.filter(user=OuterRef('pk'), partner=user).values('updated_at')[:1]
+        ),
+    ).values_list('summary_changed', 'read_changed', 'last_activity').first()
+
+    if row is None:
+        return None
+    return list(row), newest(row[0], row[1])
+
+
+def inbox(user):
+    """Validators for user's conversation list: (partner id, updated_at) of every row."""
+    rows = list(
+        ConversationSummary.objects.filter(user=user).order_by('partner_id').values_list('partner_id', 'updated_at')
+    )
+    return rows, newest(*(changed for _, changed in rows))
+
+
+def room(room_id):
+    """Validators for a room's messages, or None if it doesn't exist."""
+    changed = RoomModel.objects.filter(pk=room_id).values_list('updated_at', flat=True).first()
+    if changed is None:
+        return None
+    return [changed], changed
+
+
+def groupList(user):
+    """Validators for the list of user's rooms and their unread counts."""
+    rooms = RoomModel.objects.filter(participants=user).aggregate(count=Count('pk'), changed=Max('updated_at'))
+    read = RoomReadWatermark.objects.filter(user=user).aggregate(changed=Max('updated_at'))['changed']
+    return [rooms['count'], rooms['changed'], read], newest(rooms['changed'], read)
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET and HEAD with 304 Not Modified when the client's copy is
+    current. Put it after LoginRequiredMixin, so validators() runs for
+    signed-in users only.
+    """
+
+    def validators(self, request, *args, **kwargs):
+        """
+        ([values the response depends on], last modified datetime or None),
+        or None to render without a validator.
+        """
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        # A pending flash message is only shown by a fresh render
+        if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+            return super().dispatch(request, *args, **kwargs)
+
+        validators = self.validators(request, *args, **kwargs)
+        if validators is None:
+            return super().dispatch(request, *args, **kwargs)
+
+        parts, last_modified = validators
+        user = request.user
+        # Pages embed the user's name and avatar, and a form token made from the CSRF secret
+        etag = makeEtag([user.pk, user.username, user.avatar.name, request.META.get('CSRF_COOKIE'), parts])
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is not None:
+            _count('not_modified')
+        else:
+            response = super().dispatch(request, *args, **kwargs)
+            _count('rendered')
+
+        if response.status_code in (200, 304):
+            response.headers.setdefault('ETag', etag)
+            if timestamp is not None:
+                response.headers.setdefault('Last-Modified', http_date(timestamp))
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+def stats():
+    """Counters for this process; a 304 skipped the queries and the render."""
+    with _lock:
+        counters = dict(_counters)
+
+    requests = counters['not_modified'] + counters['rendered']
+    counters['not_modified_rate'] = counters['not_modified'] / requests if requests else 0.0
+    return counters
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
@@ -1,19 +1,281 @@
-import json
-from django.utils import timezone
+from urllib.parse import parse_qs
+
 from channels.db import database_sync_to_async
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from . import batching, membership, outbound, presence, protocol, replay, typingstatus, writebehind
+from .models import Attachment, Messages, RoomModel, RoomMessagesModel, RoomReadWatermark
+from userauths.models import CustomUser
+
 def getPrivateGroupName(user1_id, user2_id):
     sorted_ids = sorted([user1_id, user2_id])
     return f"private_chat_{sorted_ids[0]}_{sorted_ids[1]}"
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def getRoomGroupName(room_id):
+    return f"room_chat_{room_id}"
+
+
+def getUserGroupName(user_id):
+    """Every multiplexed socket of a user; direct messages are delivered here too."""
+    return f"user_{user_id}"
+
+
+def directMessageEvent(message, attachments=()):
+    """The group event for a saved direct message, as sent by every code path."""
+    event = {
+        'type': 'chat_message',
+        'id': message.pk,
+        'seq': message.seq,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'message': message.body,
+        'created_at': message.created_at.isoformat()
+    }
+    if attachments:
+        event['attachments'] = list(attachments)
+    return event
+
+
+def roomMessageEvent(message, sender, attachments=()):
+    # Sender details travel with the event so members don't look them up
+    event = {
+        'type': 'chat_message',
+        'id': message.pk,
+        'room_id': message.room_id,
+        'sender_id': sender.id,
+        'sender_username': sender.username,
+        'sender_avatar': sender.avatarUrl(80),  # 40px bubbles at 2x
+        'message': message.message,
+        'created_at': message.timestamp.isoformat()
+    }
+    if attachments:
+        event['attachments'] = list(attachments)
+    return event
+
+
+async def groupSend(channel_layer, group, event, batched=True):
+    """group_send, gathered into batches by chat.batching when CHAT_BATCHING is enabled."""
+    if batched and batching.ENABLED:
+        await batching.getBatcher().send(channel_layer, group, event)
+    else:
+        await channel_layer.group_send(group, event)
+
+
+async def publishDirectMessage(channel_layer, message, batched=True, attachments=()):
+    """
+    Sends a saved direct message to the conversation group and both users'
+    sockets. Pass batched=False outside a long-running event loop, e.g. from
+    a view, where a batch could be left waiting when the loop ends.
+    """
+    event = directMessageEvent(message, attachments)
+    groups = [
+        getPrivateGroupName(message.sender_id, message.recipient_id),
+        getUserGroupName(message.sender_id),
+    ]
+    if message.recipient_id != message.sender_id:
+        groups.append(getUserGroupName(message.recipient_id))
+
+    for group in groups:
+        await groupSend(channel_layer, group, event, batched)
+
+
+async def publishRoomMessage(channel_layer, message, sender, batched=True, attachments=()):
+    """Sends a saved room message to the room's group; batched as for publishDirectMessage."""
+    event = roomMessageEvent(message, sender, attachments)
+    await groupSend(channel_layer, getRoomGroupName(message.room_id), event, batched)
+
+
+async def persistDirectMessage(sender_id, recipient_id, body):
+    """Queues the message for the next batched INSERT and waits for it to commit."""
+    queue = writebehind.getQueue('direct_messages', Messages.bulkSend)
+    return await queue.submit((sender_id, recipient_id, body))
+
+
+async def persistRoomMessage(room_id, sender_id, body):
+    """Queues the message for the next batched INSERT; None if the sender isn't in the room."""
+    queue = writebehind.getQueue('room_messages', RoomMessagesModel.bulkSend)
+    return await queue.submit((room_id, sender_id, body))
+
+
+class InvalidFrame(Exception):
+    """A client frame that can't be acted on; the consumer answers with an error event."""
+
+
+async def frameAttachment(user, payload, recipient_id=None, room_id=None):
+    """
+    The finished upload a chat frame names with attachment_id, if any.
+    Raises LookupError when it isn't one of the user's unsent uploads for
+    this conversation.
+    """
+    attachment_id = payload.get("attachment_id")
+    if attachment_id is None:
+        return None
+
+    try:
+        attachment_id = int(attachment_id)
+    except (TypeError, ValueError):
+        raise LookupError(attachment_id)
+
+    attachment = await database_sync_to_async(Attachment.pendingFor)(
+        user, attachment_id, recipient_id=recipient_id, room_id=room_id
+    )
+    if attachment is None:
+        raise LookupError(attachment_id)
+    return attachment
+
+
+async def parseChatFrame(user, payload, recipient_id=None, room_id=None):
+    """
+    The text and attachment of a chat frame, for every consumer that takes
+    them. Raises InvalidFrame when the message isn't a string or the
+    attachment isn't one of the user's uploads for this conversation.
+    """
+    message = payload.get("message")
+    if message is not None and not isinstance(message, str):
+        raise InvalidFrame('Message must be a string')
+
+    try:
+        attachment = await frameAttachment(user, payload, recipient_id=recipient_id, room_id=room_id)
+    except LookupError:
+        raise InvalidFrame('Attachment not found')
+
+    # A file sent without a caption is named by its file name
+    return (message or "").strip() or (attachment.name if attachment else ""), attachment
+
+
+async def attachToMessage(attachment, message):
+    """Claims the attachment for the saved message; returns the events' attachments list."""
+    if attachment is None or not await database_sync_to_async(attachment.attachTo)(message):
+        return []
+    return [attachment.asEvent()]
+
+
+@database_sync_to_async
+def markRoomRead(user, room_id, last_read_id):
+    # Clamp to messages that exist in this room
+    if not RoomMessagesModel.objects.filter(room_id=room_id, pk=last_read_id).exists():
+        return False
+    return RoomReadWatermark.markRead(user, room_id, last_read_id)
+
+
+@database_sync_to_async
+def markDirectRead(user, partner_id, last_read_id):
+    # Clamp to messages partner actually sent to user
+    if not Messages.objects.filter(sender_id=partner_id, recipient=user, pk=last_read_id).exists():
+        return
+    Messages.markConversationRead(user, partner_id, last_read_id)
+
+
+@database_sync_to_async
+def visibleMessageIds(user, partner_id, ids):
+    """Which of these messages user can still see; replayed events are filtered like Messages.since."""
+    return set(
+        Messages.objects.filter(Messages.conversationWith(user, partner_id), pk__in=ids).values_list('pk', flat=True)
+    )
+
+
+@database_sync_to_async
+def userExists(user_id):
+    return CustomUser.objects.filter(pk=user_id).exists()
+
+
+@database_sync_to_async
+def roomIdsOf(user):
+    return list(RoomModel.participants.through.objects.filter(
+        customuser_id=user.id
+    ).values_list('roommodel_id', flat=True))
+
+
+class EventConsumer(AsyncWebsocketConsumer):
+    """
+    Sends and receives event dicts in the encoding negotiated on connect:
+    JSON text frames by default, msgpack when the client asks for
+    protocol.MSGPACK_SUBPROTOCOL.
+
+    Once accepted, events go out through a bounded outbound.OutboundQueue,
+    so a slow client only delays its own socket.
+    """
+    codec = protocol.JsonCodec()
+    send_queue = None
+    batched_frames = None  # Collects frames while an event_batch is handled
+
+    async def acceptWithCodec(self):
+        self.codec = protocol.negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.send_queue = outbound.OutboundQueue(self.sendNow, self.closeNow)
+
+    async def sendEvent(self, payload):
+        if self.batched_frames is not None:
+            self.batched_frames.append(payload)
+        elif self.send_queue is None:
+            await self.sendNow(payload)
+        else:
+            self.send_queue.put(payload)
+
+    async def sendNow(self, payload):
+        await self.send(**self.codec.encode(payload))
+
+    async def close(self, code=None, reason=None):
+        # Let events already queued go out first
+        if self.send_queue is None:
+            await self.closeNow(code, reason)
+        else:
+            self.send_queue.closeAfterSend(code)
+
+    async def closeNow(self, code=None, reason=None):
+        await super().close(code, reason)
+
+    async def websocket_disconnect(self, message):
+        if self.send_queue is not None:
+            self.send_queue.cancel()
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            payload = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            return  # Malformed frame (json.JSONDecodeError is a ValueError too)
+
+        # Frames are dispatched on their type, so it has to be a string
+        if isinstance(payload, dict) and isinstance(payload.get("type"), str):
+            await self.receiveEvent(payload)
+
+    async def receiveEvent(self, payload):
+        raise NotImplementedError
+
+    async def event_batch(self, event):
+        """
+        Group events gathered by chat.batching. Each goes to its usual handler,
+        and whatever frames they produce reach the client as one 'batch' frame.
+        """
+        self.batched_frames = []
+        try:
+            for inner in event["events"]:
+                handler = getattr(self, inner["type"].replace(".", "_"), None)
+                if handler is not None:
+                    await handler(inner)
+        finally:
+            frames, self.batched_frames = self.batched_frames, None
+
+        if len(frames) == 1:
+            await self.sendEvent(frames[0])
+        elif frames:
+            await self.sendEvent({"type": "batch", "events": frames})
+
+
+class ChatConsumer(EventConsumer):
     async def connect(self):
         self.user = self.scope["user"] # User object
-        recipient = self.scope["url_route"]["kwargs"]["to_user"]
-        self.room_group_name = getPrivateGroupName(self.user.id, recipient)
+        self.recipient_id = self.scope["url_route"]["kwargs"]["to_user"]
+
+        # Messages are persisted from here, so both ends must be real users
+        if not self.user.is_authenticated or not await userExists(self.recipient_id):
+            await self.close()
+            return
+
+        self.room_group_name = getPrivateGroupName(self.user.id, self.recipient_id)
 
         # Add this connection to the group (await directly)
         await self.channel_layer.group_add(
@@ -21,17 +283,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        await self.acceptWithCodec()
+        presence.connect(self.user.id, self.channel_name)
 
-        # Send message back to WebSocket client
-        await self.send(text_data=json.dumps({
-            'type': 'chat',
+        # Subscribed before replaying, so nothing falls between the two
+        self.replay_buffer = replay.subscribe(self.room_group_name)
+
+        # Reconnecting clients pass ?last_seq=<n> to get what they missed
+        last_seq = parse_qs(self.scope.get("query_string", b"").decode()).get("last_seq")
+        last_seq = int(last_seq[0]) if last_seq and last_seq[0].isdigit() else None
+        self.seqs = replay.SeqTracker(last_seq or 0)
+
+        await self.sendEvent({
+            'type': 'connected',
             'message': 'Connection Established'
-        }))
+        })
+
+        if last_seq is not None:
+            await self.replayMissed(last_seq)
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'user') and self.user.is_authenticated:
-            await self.update_last_active()
+        if not hasattr(self, 'room_group_name'):
+            return
+
+        # last_activity is written by the presence flusher, not per disconnect
+        presence.disconnect(self.user.id, self.channel_name)
+        replay.unsubscribe(self.room_group_name)
+
+        await typingstatus.getCoalescer().stop(self.room_group_name, self.user.id)
 
         # Remove from group when disconnecting
         await self.channel_layer.group_discard(
@@ -39,52 +318,594 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        payload = json.loads(text_data)
+    async def receiveEvent(self, payload):
         
         if payload.get("type") == "chat":
-            message = payload.get("message")
+            try:
+                message, attachment = await parseChatFrame(self.user, payload, recipient_id=self.recipient_id)
+            except InvalidFrame as error:
+                await self.sendEvent({
+                    'type': 'error',
+                    'client_id': payload.get("client_id"),
+                    'message': str(error)
+                })
+                return
+
+            if not message:
+                return
+
+            try:
+                saved = await self.persistMessage(message)
+            except Exception:
+                await self.sendEvent({
+                    'type': 'error',
+                    'client_id': payload.get("client_id"),
+                    'message': 'Message could not be saved'
+                })
+                return
+
+            attachments = await attachToMessage(attachment, saved)
+
+            presence.touch(self.user.id)
+
+            # Sending ends the typing burst
+            await typingstatus.getCoalescer().stop(self.room_group_name, self.user.id)
+
+            # Tell the sender which id their message got
+            await self.sendEvent({
+                'type': 'ack',
+                'client_id': payload.get("client_id"),
+                'id': saved.pk,
+                'seq': saved.seq,
+                'created_at': saved.created_at.isoformat()
+            })
             
-            # Broadcast to the group (await directly)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'sender_id': self.scope["user"].id,
-                    'message': message
-                }
-            )
+            # Broadcast to the group and both users' multiplexed sockets
+            await publishDirectMessage(self.channel_layer, saved, attachments=attachments)
         
         if payload.get("type") == "typing":
-            # Broadcast typing status to the group
-            await self.channel_layer.group_send(
+            # Only changes of typing state reach the group
+            await typingstatus.getCoalescer().update(
                 self.room_group_name,
-                {
-                    "type": "typing_status",
-                    "user_id": self.scope["user"].id,
-                    "is_typing": payload.get("is_typing", False),
-                }
+                self.user.id,
+                bool(payload.get("is_typing", False)),
+                self.publishTyping
             )
 
     async def chat_message(self, event):
+        replay.record(self.room_group_name, event)
+
+        # Already sent, e.g. as part of a replay; a late lower seq still goes out
+        if not self.seqs.accept(event["seq"]):
+            return
+
+        await self.sendChat(event)
+
+    async def sendChat(self, event):
         # Send message back to WebSocket client
-        await self.send(text_data=json.dumps({
+        frame = {
             'type': 'chat',
+            'id': event["id"],
+            'seq': event["seq"],
             'sender_id': event["sender_id"],
-            'message': event["message"]
-        }))
+            'message': event["message"],
+            'created_at': event["created_at"]
+        }
+        if event.get("attachments"):
+            frame['attachments'] = event["attachments"]
+        await self.sendEvent(frame)
+
+    async def replayMissed(self, last_seq):
+        """
+        Sends the messages after last_seq from the ring buffer when it reaches
+        back far enough, otherwise from the database. Clients that missed more
+        than MAX_REPLAY messages are told to reload instead.
+        """
+        events = self.replay_buffer.since(last_seq)
+        if events is not None:
+            replay.count('buffer_replays')
+
+            # The buffer keeps events as sent; drop what the user has deleted since
+            if events:
+                visible = await visibleMessageIds(self.user, self.recipient_id, [event["id"] for event in events])
+                events = [event for event in events if event["id"] in visible]
+        else:
+            missed = await database_sync_to_async(Messages.since)(
+                self.user, self.recipient_id, last_seq, replay.MAX_REPLAY + 1
+            )
+            if len(missed) > replay.MAX_REPLAY:
+                replay.count('resyncs')
+                await self.sendEvent({'type': 'resync'})
+                return
+
+            replay.count('database_replays')
+            events = [
+                directMessageEvent(message, [attachment.asEvent() for attachment in message.attachments.all()])
+                for message in missed
+            ]
+
+        events = [event for event in events if self.seqs.accept(event["seq"])]
+        for event in events:
+            await self.sendChat(event)
+
+        await self.sendEvent({
+            'type': 'replayed',
+            'count': len(events),
+            'last_seq': self.seqs.last_seq
+        })
 
     async def typing_status(self, event):
         # Send to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.sendEvent({
             "type": "typing",
             "user_id": event["user_id"],
             "is_typing": event["is_typing"]
-        }))
-
-    @database_sync_to_async
-    def update_last_active(self):
-        """Safely update last_active in the DB from async context"""
-        self.user.last_activity = timezone.now()
-        self.user.save(update_fields=["last_activity"])
-        print(self.user.last_activity)
\ No newline at end of file
+        })
+
+    async def publishTyping(self, is_typing):
+        await groupSend(
+            self.channel_layer,
+            self.room_group_name,
+            {
+                "type": "typing_status",
+                "user_id": self.user.id,
+                "is_typing": is_typing,
+            }
+        )
+
+    async def persistMessage(self, body):
+        return await persistDirectMessage(self.user.id, self.recipient_id, body)
+
+
+class RoomConsumer(EventConsumer):
+    """
+    Group chat over ws/room/<room_id>. Every event is sent to the channel
+    group once and the handlers below only forward it, so fan-out to large
+    rooms costs no database work per member.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"] # User object
+        self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
+
+        # Membership comes from the cache, not a query per connect
+        if not self.user.is_authenticated or not await membership.isMemberAsync(self.room_id, self.user.id):
+            await self.close()
+            return
+
+        self.room_group_name = getRoomGroupName(self.room_id)
+
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+
+        await self.acceptWithCodec()
+        presence.connect(self.user.id, self.channel_name)
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'room_group_name'):
+            return
+
+        presence.disconnect(self.user.id, self.channel_name)
+        await typingstatus.getCoalescer().stop(self.room_group_name, self.user.id)
+
+        await self.channel_layer.group_discard(
+            self.room_group_name,
+            self.channel_name
+        )
+
+    async def receiveEvent(self, payload):
+
+        if payload.get("type") == "chat":
+            try:
+                message, attachment = await parseChatFrame(self.user, payload, room_id=self.room_id)
+            except InvalidFrame as error:
+                await self.sendEvent({
+                    'type': 'error',
+                    'client_id': payload.get("client_id"),
+                    'message': str(error)
+                })
+                return
+
+            if not message:
+                return
+
+            try:
+                saved = await self.persistMessage(message)
+            except Exception:
+                saved = None
+
+            if saved is None:
+                await self.sendEvent({
+                    'type': 'error',
+                    'client_id': payload.get("client_id"),
+                    'message': 'Message could not be saved'
+                })
+                return
+
+            presence.touch(self.user.id)
+            await typingstatus.getCoalescer().stop(self.room_group_name, self.user.id)
+
+            await self.sendEvent({
+                'type': 'ack',
+                'client_id': payload.get("client_id"),
+                'id': saved.pk,
+                'created_at': saved.timestamp.isoformat()
+            })
+
+            await publishRoomMessage(
+                self.channel_layer, saved, self.user, attachments=await attachToMessage(attachment, saved)
+            )
+
+        if payload.get("type") == "typing":
+            # With thousands of members, repeats would be thousands of frames each
+            await typingstatus.getCoalescer().update(
+                self.room_group_name,
+                self.user.id,
+                bool(payload.get("is_typing", False)),
+                self.publishTyping
+            )
+
+        if payload.get("type") == "read":
+            try:
+                last_read_id = int(payload.get("last_read_id"))
+            except (TypeError, ValueError):
+                return
+
+            # Only broadcast when the watermark actually moved
+            if await markRoomRead(self.user, self.room_id, last_read_id):
+                await groupSend(
+                    self.channel_layer,
+                    self.room_group_name,
+                    {
+                        "type": "read_receipt",
+                        "room_id": self.room_id,
+                        "user_id": self.user.id,
+                        "last_read_id": last_read_id,
+                    }
+                )
+
+    async def chat_message(self, event):
+        frame = {
+            'type': 'chat',
+            'id': event["id"],
+            'sender_id': event["sender_id"],
+            'sender_username': event["sender_username"],
+            'sender_avatar': event["sender_avatar"],
+            'message': event["message"],
+            'created_at': event["created_at"]
+        }
+        if event.get("attachments"):
+            frame['attachments'] = event["attachments"]
+        await self.sendEvent(frame)
+
+    async def typing_status(self, event):
+        await self.sendEvent({
+            "type": "typing",
+            "user_id": event["user_id"],
+            "username": event["username"],
+            "is_typing": event["is_typing"]
+        })
+
+    async def read_receipt(self, event):
+        await self.sendEvent({
+            "type": "read",
+            "user_id": event["user_id"],
+            "last_read_id": event["last_read_id"]
+        })
+
+    async def membership_changed(self, event):
+        # Sent by chat.signals; removed members (or a deleted room) lose the socket
+        if not await membership.isMemberAsync(self.room_id, self.user.id):
+            await self.close()
+
+    async def publishTyping(self, is_typing):
+        await groupSend(
+            self.channel_layer,
+            self.room_group_name,
+            {
+                "type": "typing_status",
+                "room_id": self.room_id,
+                "user_id": self.user.id,
+                "username": self.user.username,
+                "is_typing": is_typing,
+            }
+        )
+
+    async def persistMessage(self, body):
+        return await persistRoomMessage(self.room_id, self.user.id, body)
+
+
+class UserConsumer(EventConsumer):
+    """
+    One socket per user at ws/user/ instead of one per conversation.
+
+    It joins the user's own group, which carries all of their direct
+    messages, plus the group of every room they are in. Frames name their
+    conversation as {"kind": "direct" | "room", "id": partner or room id}:
+
+        {"type": "chat", "conversation": {...}, "message": "...", "client_id": "..."}
+        {"type": "typing", "conversation": {...}, "is_typing": true}
+        {"type": "read", "conversation": {...}, "last_read_id": 123}
+        {"type": "subscribe" | "unsubscribe", "conversation": {...}}
+
+    Subscribing to a direct conversation adds its typing events (e.g. while
+    it is open); unsubscribing from a room mutes it for this socket.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"] # User object
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_group_name = getUserGroupName(self.user.id)
+        self.rooms = set()
+        self.directs = set()
+        self.direct_seqs = {}  # partner id -> replay.SeqTracker, to drop duplicates
+
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        for room_id in await roomIdsOf(self.user):
+            await self.joinRoom(room_id)
+
+        await self.acceptWithCodec()
+        presence.connect(self.user.id, self.channel_name)
+
+        await self.sendEvent({
+            'type': 'connected',
+            'rooms': sorted(self.rooms)
+        })
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'user_group_name'):
+            return
+
+        presence.disconnect(self.user.id, self.channel_name)
+
+        groups = [getRoomGroupName(room_id) for room_id in self.rooms]
+        groups += [getPrivateGroupName(self.user.id, partner_id) for partner_id in self.directs]
+        for group in groups:
+            await typingstatus.getCoalescer().stop(group, self.user.id)
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def receiveEvent(self, payload):
+        kind, conversation_id = self.parseConversation(payload.get("conversation"))
+        if kind is None:
+            await self.sendEvent({
+                'type': 'error',
+                'client_id': payload.get("client_id"),
+                'message': 'Missing or invalid conversation'
+            })
+            return
+
+        handler = {
+            "subscribe": self.subscribe,
+            "unsubscribe": self.unsubscribe,
+            "chat": self.sendChat,
+            "typing": self.sendTyping,
+            "read": self.sendRead,
+        }.get(payload.get("type"))
+
+        if handler is not None:
+            await handler(kind, conversation_id, payload)
+
+    def parseConversation(self, conversation):
+        if not isinstance(conversation, dict) or conversation.get("kind") not in ("direct", "room"):
+            return None, None
+        try:
+            return conversation["kind"], int(conversation["id"])
+        except (KeyError, TypeError, ValueError):
+            return None, None
+
+    def conversationGroup(self, kind, conversation_id):
+        if kind == "room":
+            return getRoomGroupName(conversation_id)
+        return getPrivateGroupName(self.user.id, conversation_id)
+
+    async def joinRoom(self, room_id):
+        await self.channel_layer.group_add(getRoomGroupName(room_id), self.channel_name)
+        self.rooms.add(room_id)
+
+    async def leaveRoom(self, room_id):
+        await typingstatus.getCoalescer().stop(getRoomGroupName(room_id), self.user.id)
+        await self.channel_layer.group_discard(getRoomGroupName(room_id), self.channel_name)
+        self.rooms.discard(room_id)
+
+    # Client frames
+
+    async def subscribe(self, kind, conversation_id, payload):
+        if kind == "room":
+            allowed = await membership.isMemberAsync(conversation_id, self.user.id)
+            if allowed and conversation_id not in self.rooms:
+                await self.joinRoom(conversation_id)
+        else:
+            allowed = await userExists(conversation_id)
+            if allowed and conversation_id not in self.directs:
+                await self.channel_layer.group_add(
+                    getPrivateGroupName(self.user.id, conversation_id), self.channel_name
+                )
+                self.directs.add(conversation_id)
+
+        await self.sendEvent({
+            'type': 'subscribed' if allowed else 'error',
+            'conversation': {'kind': kind, 'id': conversation_id},
+            **({} if allowed else {'message': 'Conversation not found'})
+        })
+
+    async def unsubscribe(self, kind, conversation_id, payload):
+        if kind == "room" and conversation_id in self.rooms:
+            await self.leaveRoom(conversation_id)
+        elif kind == "direct" and conversation_id in self.directs:
+            group = getPrivateGroupName(self.user.id, conversation_id)
+            await typingstatus.getCoalescer().stop(group, self.user.id)
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.directs.discard(conversation_id)
+
+        await self.sendEvent({
+            'type': 'unsubscribed',
+            'conversation': {'kind': kind, 'id': conversation_id}
+        })
+
+    async def sendChat(self, kind, conversation_id, payload):
+        try:
+            message, attachment = await parseChatFrame(
+                self.user, payload, **({'room_id': conversation_id} if kind == "room" else {'recipient_id': conversation_id})
+            )
+        except InvalidFrame as error:
+            await self.sendEvent({
+                'type': 'error',
+                'client_id': payload.get("client_id"),
+                'conversation': {'kind': kind, 'id': conversation_id},
+                'message': str(error)
+            })
+            return
+
+        if not message:
+            return
+
+        try:
+            if kind == "room":
+                saved = await persistRoomMessage(conversation_id, self.user.id, message)
+            elif await userExists(conversation_id):
+                saved = await persistDirectMessage(self.user.id, conversation_id, message)
+            else:
+                saved = None
+        except Exception:
+            saved = None
+
+        if saved is None:
+            await self.sendEvent({
+                'type': 'error',
+                'client_id': payload.get("client_id"),
+                'conversation': {'kind': kind, 'id': conversation_id},
+                'message': 'Message could not be saved'
+            })
+            return
+
+        presence.touch(self.user.id)
+        await typingstatus.getCoalescer().stop(self.conversationGroup(kind, conversation_id), self.user.id)
+
+        await self.sendEvent({
+            'type': 'ack',
+            'client_id': payload.get("client_id"),
+            'conversation': {'kind': kind, 'id': conversation_id},
+            'id': saved.pk,
+            'seq': getattr(saved, 'seq', None),
+            'created_at': (saved.timestamp if kind == "room" else saved.created_at).isoformat()
+        })
+
+        attachments = await attachToMessage(attachment, saved)
+        if kind == "room":
+            await publishRoomMessage(self.channel_layer, saved, self.user, attachments=attachments)
+        else:
+            await publishDirectMessage(self.channel_layer, saved, attachments=attachments)
+
+    async def sendTyping(self, kind, conversation_id, payload):
+        # Only conversations this socket takes part in
+        if kind == "room" and conversation_id not in self.rooms:
+            return
+
+        group = self.conversationGroup(kind, conversation_id)
+
+        async def publish(is_typing):
+            event = {
+                "type": "typing_status",
+                "user_id": self.user.id,
+                "username": self.user.username,
+                "is_typing": is_typing,
+            }
+            if kind == "room":
+                event["room_id"] = conversation_id
+            await groupSend(self.channel_layer, group, event)
+
+        await typingstatus.getCoalescer().update(
+            group, self.user.id, bool(payload.get("is_typing", False)), publish
+        )
+
+    async def sendRead(self, kind, conversation_id, payload):
+        try:
+            last_read_id = int(payload.get("last_read_id"))
+        except (TypeError, ValueError):
+            return
+
+        if kind == "direct":
+            await markDirectRead(self.user, conversation_id, last_read_id)
+            return
+
+        if conversation_id in self.rooms and await markRoomRead(self.user, conversation_id, last_read_id):
+            await groupSend(
+                self.channel_layer,
+                getRoomGroupName(conversation_id),
+                {
+                    "type": "read_receipt",
+                    "room_id": conversation_id,
+                    "user_id": self.user.id,
+                    "last_read_id": last_read_id,
+                }
+            )
+
+    # Group events
+
+    def eventConversation(self, event):
+        if event.get("room_id") is not None:
+            return {'kind': 'room', 'id': event["room_id"]}
+
+        # Direct: the conversation is named after the other participant
+        sender_id = event["sender_id"]
+        partner_id = event["recipient_id"] if sender_id == self.user.id else sender_id
+        return {'kind': 'direct', 'id': partner_id}
+
+    async def chat_message(self, event):
+        conversation = self.eventConversation(event)
+
+        # Arrives through the user group and, if subscribed, the conversation group
+        if conversation['kind'] == 'direct':
+            seqs = self.direct_seqs.setdefault(conversation['id'], replay.SeqTracker())
+            if not seqs.accept(event["seq"]):
+                return
+
+        frame = {key: value for key, value in event.items() if key not in ('type', 'room_id', 'recipient_id')}
+        await self.sendEvent(dict(frame, type='chat', conversation=conversation))
+
+    async def typing_status(self, event):
+        if event["user_id"] == self.user.id:
+            return
+
+        if event.get("room_id") is not None:
+            conversation = {'kind': 'room', 'id': event["room_id"]}
+        else:
+            conversation = {'kind': 'direct', 'id': event["user_id"]}
+
+        await self.sendEvent({
+            "type": "typing",
+            "conversation": conversation,
+            "user_id": event["user_id"],
+            "username": event.get("username"),
+            "is_typing": event["is_typing"]
+        })
+
+    async def read_receipt(self, event):
+        await self.sendEvent({
+            "type": "read",
+            "conversation": {'kind': 'room', 'id': event["room_id"]},
+            "user_id": event["user_id"],
+            "last_read_id": event["last_read_id"]
+        })
+
+    async def membership_changed(self, event):
+        # Sent by chat.signals to the room's group on removals and to the user's group on additions
+        room_id = event.get("room_id")
+        if room_id is None:
+            return
+
+        is_member = await membership.isMemberAsync(room_id, self.user.id)
+        if is_member and room_id not in self.rooms:
+            await self.joinRoom(room_id)
+            await self.sendEvent({'type': 'subscribed', 'conversation': {'kind': 'room', 'id': room_id}})
+        elif not is_member and room_id in self.rooms:
+            await self.leaveRoom(room_id)
+            await self.sendEvent({'type': 'unsubscribed', 'conversation': {'kind': 'room', 'id': room_id}})
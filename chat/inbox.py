@@ -0,0 +1,105 @@
+"""
+Per-user cache of the conversation list (Messages.getConversationsList).
+
+Entries live in a Django cache (CHAT_INBOX_CACHE["CACHE"], the local-memory
+"default" unless configured otherwise) under a key that includes a version
+token for the user:
+
+    chat:inbox:<user id>:version -> "9c1e0f..."
+    chat:inbox:<user id>:9c1e0f... -> [conversation, ...]
+
+Anything that changes a user's ConversationSummary rows calls
+invalidate([user id, ...]), which swaps in a new token once the
+transaction commits. A request that read the summaries before the commit
+stores its result under the old token, where nobody looks anymore, so it
+can't put a stale list back. Lost tokens (evicted by the cache) only cost
+a miss.
+
+Presence is not part of the entries; the view adds it to every list it serves.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+INBOX_CACHE = getattr(settings, 'CHAT_INBOX_CACHE', {})
+ENABLED = INBOX_CACHE.get('ENABLED', True)
+CACHE = INBOX_CACHE.get('CACHE', 'default')
+TIMEOUT = INBOX_CACHE.get('TIMEOUT_S', 300)  # Also bounds how long a partner's old name can show
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def versionKey(user_id):
+    return f'chat:inbox:{user_id}:version'
+
+
+def listKey(user_id, version):
+    return f'chat:inbox:{user_id}:{version}'
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def currentVersion(cache, user_id):
+    version = cache.get(versionKey(user_id))
+    if version is None:
+        # add(), so two requests starting at once agree on one token
+        cache.add(versionKey(user_id), uuid.uuid4().hex, None)
+        version = cache.get(versionKey(user_id))
+    return version
+
+
+def getConversationsList(user):
+    """Messages.getConversationsList(user), served from the cache when possible."""
+    from .models import Messages
+
+    if not ENABLED:
+        return Messages.getConversationsList(user)
+
+    cache = caches[CACHE]
+    key = listKey(user.pk, currentVersion(cache, user.pk))
+    conversations = cache.get(key)
+    if conversations is not None:
+        _count('hits')
+        return conversations
+
+    _count('misses')
+    conversations = Messages.getConversationsList(user)
+    cache.set(key, conversations, TIMEOUT)
+    return conversations
+
+
+def invalidate(user_ids):
+    """Drops the cached lists of these users, after the current transaction commits."""
+    if not ENABLED:
+        return
+
+    user_ids = set(user_ids)
+
+    def bump():
+        caches[CACHE].set_many({versionKey(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+        _count('invalidations', len(user_ids))
+
+    transaction.on_commit(bump)
+
+
+def stats():
+    """Hit and miss counters for this process."""
+    with _lock:
+        counters = dict(_counters)
+
+    lookups = counters['hits'] + counters['misses']
+    counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+    return counters
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
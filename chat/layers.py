@@ -0,0 +1,405 @@
+import asyncio
+import itertools
+import os
+import pickle
+import random
+import string
+import struct
+import time
+import weakref
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+# Frames are a 4-byte length followed by the payload. Client requests are a
+# pickled (op, request_id, *args) tuple; messages inside them are pickled
+# separately so the broker can hand the same bytes to every group member
+# without decoding them.
+HEADER = struct.Struct('!I')
+REPLY = struct.Struct('!QB')  # request id, status
+
+OK = 0
+FULL = 1
+ERROR = 2
+
+SWEEP_INTERVAL = 1  # Seconds between expiry sweeps in the broker
+
+
+def _frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def _reply(request_id, status, payload=b''):
+    return _frame(REPLY.pack(request_id, status) + payload)
+
+
+async def _readFrame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+
+class ChannelBroker(BaseChannelLayer):
+    """
+    Holds channel queues and groups for every worker process on one host.
+    Workers connect with UnixSocketChannelLayer; run it with the
+    run_channel_broker management command.
+
+    Capacity, message expiry and group expiry behave like
+    InMemoryChannelLayer, only shared across processes.
+    """
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+
+        self.channels = {}  # channel -> deque of (expires, message bytes)
+        self.waiters = {}  # channel -> deque of (writer, request id)
+        self.groups = {}  # group -> {channel: joined at}
+        self.server = None
+
+        self.handlers = {
+            'send': self.handleSend,
+            'receive': self.handleReceive,
+            'cancel': self.handleCancel,
+            'group_add': self.handleGroupAdd,
+            'group_discard': self.handleGroupDiscard,
+            'group_send': self.handleGroupSend,
+            'flush': self.handleFlush,
+        }
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        # Requests are unpickled, so only this user's processes may connect. The
+        # socket is created without group/other access; a chmod after bind would leave a window
+        umask = os.umask(0o077)
+        try:
+            self.server = await asyncio.start_unix_server(self.handleConnection, path=self.path)
+        finally:
+            os.umask(umask)
+
+        sweeper = asyncio.ensure_future(self.sweep())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            sweeper.cancel()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                op, request_id, *args = pickle.loads(await _readFrame(reader))
+                try:
+                    self.handlers[op](writer, request_id, *args)
+                except Exception as error:
+                    writer.write(_reply(request_id, ERROR, pickle.dumps(repr(error))))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.dropWaiters(writer)
+            writer.close()
+
+    def dropWaiters(self, writer):
+        for channel, waiting in list(self.waiters.items()):
+            remaining = deque(waiter for waiter in waiting if waiter[0] is not writer)
+            if remaining:
+                self.waiters[channel] = remaining
+            else:
+                del self.waiters[channel]
+
+    def deliver(self, channel, message):
+        """Hands message to a waiting receiver or queues it. False if the channel is full."""
+        waiting = self.waiters.get(channel)
+        while waiting:
+            writer, request_id = waiting.popleft()
+            if not waiting:
+                del self.waiters[channel]
+            if not writer.is_closing():
+                writer.write(_reply(request_id, OK, message))
+                return True
+
+        queue = self.channels.setdefault(channel, deque())
+        if len(queue) >= self.get_capacity(channel):
+            return False
+        queue.append((time.time() + self.expiry, message))
+        return True
+
+    def handleSend(self, writer, request_id, channel, message):
+        status = OK if self.deliver(channel, message) else FULL
+        writer.write(_reply(request_id, status))
+
+    def handleReceive(self, writer, request_id, channel):
+        queue = self.channels.get(channel)
+        now = time.time()
+        while queue:
+            expires, message = queue.popleft()
+            if expires >= now:
+                if not queue:
+                    del self.channels[channel]
+                writer.write(_reply(request_id, OK, message))
+                return
+            self.removeFromGroups(channel)
+
+        self.channels.pop(channel, None)
+        self.waiters.setdefault(channel, deque()).append((writer, request_id))
+
+    def handleCancel(self, writer, request_id, channel, cancelled_id):
+        waiting = self.waiters.get(channel)
+        if waiting:
+            remaining = deque(waiter for waiter in waiting if waiter != (writer, cancelled_id))
+            if remaining:
+                self.waiters[channel] = remaining
+            else:
+                del self.waiters[channel]
+        writer.write(_reply(request_id, OK))
+
+    def handleGroupAdd(self, writer, request_id, group, channel):
+        self.groups.setdefault(group, {})[channel] = time.time()
+        writer.write(_reply(request_id, OK))
+
+    def handleGroupDiscard(self, writer, request_id, group, channel):
+        members = self.groups.get(group)
+        if members:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        writer.write(_reply(request_id, OK))
+
+    def handleGroupSend(self, writer, request_id, group, message):
+        # Full channels are skipped, as with every other layer
+        for channel in list(self.groups.get(group, ())):
+            self.deliver(channel, message)
+        writer.write(_reply(request_id, OK))
+
+    def handleFlush(self, writer, request_id):
+        self.channels = {}
+        self.groups = {}
+        writer.write(_reply(request_id, OK))
+
+    def removeFromGroups(self, channel):
+        for members in self.groups.values():
+            members.pop(channel, None)
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            now = time.time()
+
+            for channel, queue in list(self.channels.items()):
+                expired = False
+                while queue and queue[0][0] < now:
+                    queue.popleft()
+                    expired = True
+                if expired:
+                    # Nobody is reading it, same rule as InMemoryChannelLayer
+                    self.removeFromGroups(channel)
+                if not queue:
+                    del self.channels[channel]
+
+            joined_before = now - self.group_expiry
+            for group, members in list(self.groups.items()):
+                for channel, joined in list(members.items()):
+                    if joined < joined_before:
+                        del members[channel]
+                if not members:
+                    del self.groups[group]
+
+
+class BrokerConnection:
+    """One connection to the broker, owned by a single event loop."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> future
+        self.orphans = {}  # channel -> messages whose receive() was cancelled
+        self.receiving = {}  # request id -> channel
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        try:
+            while True:
+                payload = await _readFrame(self.reader)
+                request_id, status = REPLY.unpack_from(payload)
+                body = payload[REPLY.size:]
+
+                channel = self.receiving.pop(request_id, None)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((status, body))
+                elif channel is not None and status == OK:
+                    # Delivered just as the receiver gave up; keep it for the next receive()
+                    self.orphans.setdefault(channel, deque()).append(body)
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            self.fail(ConnectionError(f'Channel broker connection lost: {error}'))
+        except asyncio.CancelledError:
+            self.fail(ConnectionError('Channel broker connection closed'))
+            raise
+
+    def fail(self, error):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.writer.close()
+
+    @property
+    def closed(self):
+        return self.listener.done() or self.writer.is_closing()
+
+    async def request(self, op, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(_frame(pickle.dumps((op, request_id) + args, pickle.HIGHEST_PROTOCOL)))
+        await self.writer.drain()
+
+        status, body = await future
+        if status == ERROR:
+            raise RuntimeError(f'Channel broker error: {pickle.loads(body)}')
+        return status, body
+
+    async def receive(self, channel):
+        orphans = self.orphans.get(channel)
+        if orphans:
+            body = orphans.popleft()
+            if not orphans:
+                del self.orphans[channel]
+            return body
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.receiving[request_id] = channel
+        self.writer.write(_frame(pickle.dumps(('receive', request_id, channel), pickle.HIGHEST_PROTOCOL)))
+
+        try:
+            status, body = await future
+        except asyncio.CancelledError:
+            # Consumer went away; stop the broker from delivering to this request
+            self.pending.pop(request_id, None)
+            if future.done() and not future.cancelled() and future.exception() is None:
+                status, body = future.result()
+                self.orphans.setdefault(channel, deque()).append(body)
+            elif not self.closed:
+                self.writer.write(_frame(pickle.dumps(
+                    ('cancel', next(self.request_ids), channel, request_id), pickle.HIGHEST_PROTOCOL
+                )))
+            raise
+        return body
+
+    async def close(self):
+        self.listener.cancel()
+        try:
+            await self.listener
+        except asyncio.CancelledError:
+            pass
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer for several worker processes on one host, backed by the
+    broker started with `manage.py run_channel_broker`. Configure it with
+    the same CONFIG the broker reads:
+
+        CHANNEL_LAYERS = {
+            "default": {
+                "BACKEND": "chat.layers.UnixSocketChannelLayer",
+                "CONFIG": {"path": "/run/nexchat/channels.sock"},
+            }
+        }
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+        # Channel names from new_channel() are unique to this process
+        self.client_prefix = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        # async_to_sync may run us on short-lived loops, so connect per loop
+        self.connections = weakref.WeakKeyDictionary()
+        self.locks = weakref.WeakKeyDictionary()
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+
+        lock = self.locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            connection = self.connections.get(loop)
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                connection = BrokerConnection(reader, writer)
+                self.connections[loop] = connection
+        return connection
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+
+        connection = await self.connection()
+        status, _ = await connection.request('send', channel, pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        if status == FULL:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+
+        connection = await self.connection()
+        return pickle.loads(await connection.receive(channel))
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s%s!%s' % (
+            prefix,
+            self.client_prefix,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def flush(self):
+        connection = await self.connection()
+        await connection.request('flush')
+
+    async def close(self):
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+
+        connection = await self.connection()
+        await connection.request('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+
+        connection = await self.connection()
+        await connection.request('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+
+        # Pickled once here, however many members the group has
+        connection = await self.connection()
+        await connection.request('group_send', group, pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
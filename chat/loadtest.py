@@ -0,0 +1,257 @@
+"""
+In-process WebSocket load tests.
+
+Drives many simulated clients against the project's ASGI application with
+channels' WebsocketCommunicator: real cookies and sessions, the real
+consumers, the configured channel layer and database. Used by
+`manage.py bench_websockets` and by chat.tests.
+
+    report = loadtest.run('dm', clients=1000, messages=5)
+    print(report.summary())
+
+Scenarios:
+
+    dm     clients/2 pairs, each on ws/socket-server/<partner>; every
+           client sends `messages` to its partner.
+    group  every client in one room on ws/room/<id>; `senders` of them
+           send `messages` each, which every other member receives.
+
+Users, sessions and the room are created for the run and deleted after it.
+"""
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+import uuid
+from importlib import import_module
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.hashers import make_password
+
+from .models import RoomModel
+from userauths.models import CustomUser
+
+SCENARIOS = ('dm', 'group')
+RECEIVE_TIMEOUT = 3600  # Receives are cancelled by the run's deadline instead; a timeout would kill the consumer
+
+
+class LoadReport:
+    def __init__(self, scenario, clients):
+        self.scenario = scenario
+        self.clients = clients
+        self.connect_seconds = 0
+        self.memory_per_connection = 0  # Bytes allocated in this process per open socket
+        self.sent = 0
+        self.expected = 0  # Deliveries to clients other than the sender
+        self.delivered = 0
+        self.latencies = []  # Seconds from send to delivery
+        self.frames = 0  # WebSocket frames received, including batches and other events
+        self.elapsed = 0
+        self.cpu_seconds = 0  # Process CPU time while messages were in flight
+
+    @property
+    def throughput(self):
+        """Deliveries per second."""
+        return self.delivered / self.elapsed if self.elapsed else 0
+
+    @property
+    def cpu_per_delivery(self):
+        """Seconds of CPU time per delivered message: the fan-out cost."""
+        return self.cpu_seconds / self.delivered if self.delivered else 0
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0
+        samples = sorted(self.latencies)
+        if fraction == 0.5:
+            return statistics.median(samples)
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def asDict(self):
+        return {
+            'scenario': self.scenario,
+            'clients': self.clients,
+            'connect_seconds': self.connect_seconds,
+            'memory_per_connection': self.memory_per_connection,
+            'sent': self.sent,
+            'expected': self.expected,
+            'delivered': self.delivered,
+            'frames': self.frames,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p95_ms': self.percentile(0.95) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'throughput': self.throughput,
+            'cpu_us_per_delivery': self.cpu_per_delivery * 1_000_000,
+        }
+
+    def summary(self):
+        return (
+            '{scenario}: {clients} clients connected in {connect_seconds:.2f}s, '
+            '{memory_per_connection:,.0f} B/connection; '
+            '{delivered}/{expected} deliveries of {sent} messages in {frames} frames, {throughput:,.0f}/s, '
+            '{cpu_us_per_delivery:.0f} µs CPU each; '
+            'latency p50 {p50_ms:.1f} ms, p95 {p95_ms:.1f} ms, p99 {p99_ms:.1f} ms'
+        ).format(**self.asDict())
+
+
+class SimulatedClient:
+    def __init__(self, application, user, session_key, path):
+        self.user = user
+        cookie = f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode()
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b'cookie', cookie)])
+        self.latencies = []
+        self.frames = 0
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=RECEIVE_TIMEOUT)
+        if not connected:
+            raise RuntimeError(f'{self.user} was refused by {self.communicator.scope["path"]}')
+
+    async def send(self, token):
+        await self.communicator.send_to(text_data=json.dumps({'type': 'chat', 'message': token, 'client_id': token}))
+
+    async def listen(self, sent_at, expected):
+        """Records the latency of chat frames from other clients until `expected` have arrived."""
+        while len(self.latencies) < expected:
+            frame = json.loads(await self.communicator.receive_from(timeout=RECEIVE_TIMEOUT))
+            self.frames += 1
+
+            received = time.perf_counter()
+            for event in frame['events'] if frame.get('type') == 'batch' else [frame]:
+                if event.get('type') != 'chat' or event.get('sender_id') == self.user.pk:
+                    continue
+
+                started = sent_at.get(event['message'])
+                if started is not None:
+                    self.latencies.append(received - started)
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+def createFixtures(scenario, clients):
+    """Throwaway users with sessions, plus a room for the group scenario."""
+    run = uuid.uuid4().hex[:6]
+    CustomUser.objects.bulk_create([
+        CustomUser(
+            username=f'lt{run}_{index}',
+            email=f'lt{run}_{index}@loadtest.invalid',
+            password=make_password(None)
+        )
+        for index in range(clients)
+    ], batch_size=500)
+    users = list(CustomUser.objects.filter(username__startswith=f'lt{run}_').order_by('pk'))
+
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    session_keys = []
+    for user in users:
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        session_keys.append(session.session_key)
+
+    room = None
+    if scenario == 'group':
+        room = RoomModel.objects.create(name=f'Load test {run}', admin=users[0])
+        room.participants.add(*users)
+    return users, session_keys, room
+
+
+def deleteFixtures(users, session_keys, room):
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    SessionStore.get_model_class().objects.filter(session_key__in=session_keys).delete()
+    if room is not None:
+        room.delete()
+    CustomUser.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+
+def paths(scenario, users, room):
+    if scenario == 'group':
+        return [f'/ws/room/{room.pk}' for _ in users]
+
+    # Pair 0 with 1, 2 with 3...
+    return [f'/ws/socket-server/{users[index ^ 1].pk}' for index in range(len(users))]
+
+
+async def drive(scenario, application, users, session_keys, room, messages, senders, rate, timeout):
+    report = LoadReport(scenario, len(users))
+    clients = [
+        SimulatedClient(application, user, session_key, path)
+        for user, session_key, path in zip(users, session_keys, paths(scenario, users, room))
+    ]
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for client in clients:
+        await client.connect()
+    report.connect_seconds = time.perf_counter() - started
+    report.memory_per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / len(clients)
+    tracemalloc.stop()
+
+    sending = clients[:senders] if scenario == 'group' else clients
+    report.sent = len(sending) * messages
+    if scenario == 'group':
+        expected = {client: report.sent - (messages if client in sending else 0) for client in clients}
+    else:
+        expected = {client: messages for client in clients}
+    report.expected = sum(expected.values())
+
+    sent_at = {}
+    interval = len(sending) / rate if rate else 0
+
+    async def sender(client):
+        for index in range(messages):
+            token = f'{client.user.pk}:{index}'
+            sent_at[token] = time.perf_counter()
+            await client.send(token)
+            await asyncio.sleep(interval)
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    listeners = [asyncio.ensure_future(client.listen(sent_at, expected[client])) for client in clients]
+    await asyncio.gather(*(sender(client) for client in sending))
+    done, pending = await asyncio.wait(listeners, timeout=timeout)
+    report.elapsed = time.perf_counter() - started
+    report.cpu_seconds = time.process_time() - cpu_started
+
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()  # Raise what a listener ran into
+
+    for client in clients:
+        report.latencies.extend(client.latencies)
+        report.frames += client.frames
+        await client.disconnect()
+    report.delivered = len(report.latencies)
+    return report
+
+
+def run(scenario, clients=100, messages=5, senders=10, rate=0, timeout=60):
+    """
+    Runs one scenario and returns its LoadReport. rate caps the messages sent
+    per second across all senders (0 sends as fast as the server takes them);
+    deliveries still missing after timeout seconds are left out of the report.
+    """
+    if scenario not in SCENARIOS:
+        raise ValueError(f'Unknown scenario {scenario!r}, expected one of {SCENARIOS}')
+    if scenario == 'dm' and clients % 2:
+        clients += 1  # Everyone needs a partner
+
+    from NexChat.asgi import application
+
+    users, session_keys, room = createFixtures(scenario, clients)
+    try:
+        return async_to_sync(drive)(
+            scenario, application, users, session_keys, room,
+            messages, min(senders, clients), rate, timeout
+        )
+    finally:
+        deleteFixtures(users, session_keys, room)
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from chat import batching, loadtest
+
+
+class Command(BaseCommand):
+    help = 'Compare group fan-out with and without micro-batched group_send, using the WebSocket load-test harness'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=loadtest.SCENARIOS, default='group')
+        parser.add_argument('--clients', type=int, default=300, help='Concurrent sockets')
+        parser.add_argument('--messages', type=int, default=20, help='Messages per sending client')
+        parser.add_argument('--senders', type=int, default=10, help='Sending clients in the group scenario')
+        parser.add_argument('--rate', type=float, default=0, help='Messages per second across all senders (0: unthrottled)')
+        parser.add_argument('--windows', type=int, nargs='+', default=[10, 20], help='Batching windows to try, in ms')
+        parser.add_argument('--max-batch', type=int, default=batching.MAX_BATCH)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{"delivery":<14}{"group_sends":>12}{"frames":>9}{"deliv/s":>10}{"CPU µs/deliv":>14}'
+            f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+        )
+
+        runs = [('unbatched', False, 0)] + [(f'{window} ms window', True, window) for window in options['windows']]
+        enabled, window, max_batch = batching.ENABLED, batching.WINDOW, batching.MAX_BATCH
+        try:
+            for name, enable, window_ms in runs:
+                batching.ENABLED = enable
+                batching.WINDOW = window_ms / 1000
+                batching.MAX_BATCH = options['max_batch']
+                batching.resetStats()
+
+                report = loadtest.run(
+                    options['scenario'],
+                    clients=options['clients'],
+                    messages=options['messages'],
+                    senders=options['senders'],
+                    rate=options['rate'],
+                    timeout=300,
+                )
+                group_sends = batching.stats()['group_sends'] if enable else report.sent
+                self.stdout.write(
+                    f'{name:<14}{group_sends:>12}{report.frames:>9}{report.throughput:>10,.0f}'
+                    f'{report.cpu_per_delivery * 1_000_000:>14.0f}{report.percentile(0.5) * 1000:>9.1f}'
+                    f'{report.percentile(0.95) * 1000:>9.1f}{report.percentile(0.99) * 1000:>9.1f}'
+                )
+        finally:
+            batching.ENABLED, batching.WINDOW, batching.MAX_BATCH = enabled, window, max_batch
@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.layers import ChannelBroker, UnixSocketChannelLayer
+
+
+def runBroker(path, capacity):
+    asyncio.run(ChannelBroker(path, capacity=capacity).serve())
+
+
+def runGroupWorker(path, group, members, messages, ready, results):
+    """A separate worker process with its own connection and group members."""
+
+    async def main():
+        layer = UnixSocketChannelLayer(path)
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        ready.put(True)
+
+        async def member(channel):
+            latencies = []
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.time() - message['sent_at'])
+            return latencies
+
+        per_member = await asyncio.gather(*(member(channel) for channel in channels))
+        results.put([latency for latencies in per_member for latency in latencies])
+        await layer.close()
+
+    asyncio.run(main())
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda fraction: samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    return statistics.median(samples), pick(0.95), pick(0.99)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark UnixSocketChannelLayer (through a broker process) against InMemoryChannelLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Messages per point-to-point run')
+        parser.add_argument('--members', type=int, default=100, help='Channels in the fan-out group')
+        parser.add_argument('--group-messages', type=int, default=100, help='group_send calls per fan-out run')
+        parser.add_argument('--processes', type=int, default=4, help='Worker processes for the cross-process run')
+
+    def handle(self, *args, **options):
+        capacity = max(options['messages'], options['group_messages']) + 1
+
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, 'channels.sock')
+            broker = multiprocessing.Process(target=runBroker, args=(path, capacity), daemon=True)
+            broker.start()
+
+            try:
+                self.waitForSocket(path)
+
+                layers = [
+                    ('in-memory', lambda: InMemoryChannelLayer(capacity=capacity)),
+                    ('unix socket', lambda: UnixSocketChannelLayer(path, capacity=capacity)),
+                ]
+
+                self.stdout.write(
+                    f'{"layer":<14}{"scenario":<22}{"msg/s":>12}{"p50 µs":>10}{"p95 µs":>10}{"p99 µs":>10}'
+                )
+                for name, makeLayer in layers:
+                    for scenario, run in [
+                        ('send+receive', self.roundTrip),
+                        ('pipelined', self.pipelined),
+                        (f'group x{options["members"]}', self.fanOut),
+                    ]:
+                        rate, latencies = asyncio.run(run(makeLayer(), options))
+                        self.report(name, scenario, rate, latencies)
+
+                rate, latencies = self.crossProcess(path, options)
+                self.report('unix socket', f'group x{options["members"]} / {options["processes"]} proc', rate, latencies)
+            finally:
+                broker.terminate()
+                broker.join()
+
+    def waitForSocket(self, path, timeout=10):
+        deadline = time.time() + timeout
+        while not os.path.exists(path):
+            if time.time() > deadline:
+                raise RuntimeError('Channel broker did not start')
+            time.sleep(0.01)
+
+    def report(self, layer, scenario, rate, latencies):
+        p50, p95, p99 = (value * 1_000_000 for value in percentiles(latencies))
+        self.stdout.write(f'{layer:<14}{scenario:<22}{rate:>12,.0f}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}')
+
+    async def roundTrip(self, layer, options):
+        """One message at a time: send, then wait for it on the other end."""
+        channel = await layer.new_channel()
+        latencies = []
+
+        started = time.perf_counter()
+        for index in range(options['messages']):
+            sent = time.perf_counter()
+            await layer.send(channel, {'type': 'chat.message', 'index': index})
+            await layer.receive(channel)
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+
+        await layer.flush()
+        return options['messages'] / elapsed, latencies
+
+    async def pipelined(self, layer, options):
+        """A sender and a receiver running concurrently, as under load."""
+        channel = await layer.new_channel()
+        count = options['messages']
+        latencies = []
+
+        async def receiver():
+            for _ in range(count):
+                message = await layer.receive(channel)
+                latencies.append(time.time() - message['sent_at'])
+
+        started = time.perf_counter()
+        task = asyncio.ensure_future(receiver())
+        for index in range(count):
+            await layer.send(channel, {'type': 'chat.message', 'index': index, 'sent_at': time.time()})
+        await task
+        elapsed = time.perf_counter() - started
+
+        await layer.flush()
+        return count / elapsed, latencies
+
+    async def fanOut(self, layer, options):
+        """group_send to every member of one group, all in this process."""
+        channels = [await layer.new_channel() for _ in range(options['members'])]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        latencies = []
+
+        async def member(channel):
+            for _ in range(options['group_messages']):
+                message = await layer.receive(channel)
+                latencies.append(time.time() - message['sent_at'])
+
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(member(channel)) for channel in channels]
+        for index in range(options['group_messages']):
+            await layer.group_send('bench', {'type': 'chat.message', 'index': index, 'sent_at': time.time()})
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        await layer.flush()
+        return len(latencies) / elapsed, latencies
+
+    def crossProcess(self, path, options):
+        """The same fan-out with members spread over separate worker processes."""
+        processes = options['processes']
+        per_process = max(1, options['members'] // processes)
+
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=runGroupWorker,
+                args=(path, 'bench-cross', per_process, options['group_messages'], ready, results)
+            )
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for _ in workers:
+            ready.get(timeout=30)
+
+        async def publish():
+            layer = UnixSocketChannelLayer(path)
+            for index in range(options['group_messages']):
+                await layer.group_send('bench-cross', {'type': 'chat.message', 'index': index, 'sent_at': time.time()})
+            await layer.close()
+
+        started = time.perf_counter()
+        asyncio.run(publish())
+        latencies = []
+        for _ in workers:
+            latencies.extend(results.get(timeout=60))
+        elapsed = time.perf_counter() - started
+
+        for worker in workers:
+            worker.join()
+        return len(latencies) / elapsed, latencies
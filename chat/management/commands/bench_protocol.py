@@ -0,0 +1,83 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import protocol
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes on the wire and encode/decode cost of the JSON and msgpack WebSocket codecs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20_000, help='Encodes and decodes per event')
+        parser.add_argument('--long-message', type=int, default=4000, help='Characters in the long chat message')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if protocol.msgpack is None:
+            raise CommandError('msgpack is not installed (pip install msgpack)')
+
+        random.seed(options['seed'])
+        codecs = [
+            ('json', protocol.JsonCodec()),
+            ('msgpack', protocol.MsgpackCodec(compress_min_bytes=None)),
+            ('msgpack+deflate', protocol.MsgpackCodec()),
+        ]
+
+        self.stdout.write(
+            f'{"event":<12}{"codec":<18}{"bytes":>8}{"vs json":>9}{"encode µs":>11}{"decode µs":>11}'
+        )
+        for name, event in self.sampleEvents(options['long_message']):
+            json_size = None
+            for codec_name, codec in codecs:
+                size, encode_us, decode_us = self.measure(codec, event, options['iterations'])
+                json_size = json_size or size
+                self.stdout.write(
+                    f'{name:<12}{codec_name:<18}{size:>8}{size / json_size:>9.0%}{encode_us:>11.2f}{decode_us:>11.2f}'
+                )
+
+    def sampleEvents(self, long_length):
+        words = ['the', 'meeting', 'tomorrow', 'sounds', 'good', 'can', 'you', 'send', 'me', 'notes',
+                 'from', 'last', 'week', 'project', 'deadline', 'moved', 'to', 'friday', 'thanks', 'ok']
+        long_message = ''
+        while len(long_message) < long_length:
+            long_message += random.choice(words) + ' '
+
+        chat = {
+            'type': 'chat',
+            'id': 1_284_551,
+            'seq': 4821,
+            'sender_id': 42,
+            'message': 'hey, are we still on for tonight?',
+            'created_at': '2026-10-17T18:47:00.626237+00:00',
+        }
+        return [
+            ('chat', chat),
+            ('chat long', dict(chat, message=long_message.strip())),
+            ('group chat', dict(
+                chat, sender_username='gwen_r', sender_avatar='/media/users/gwen_r/avatar.jpg'
+            )),
+            ('typing', {'type': 'typing', 'user_id': 42, 'is_typing': True}),
+            ('ack', {'type': 'ack', 'client_id': '1760726820626', 'id': 1_284_551, 'seq': 4821,
+                     'created_at': '2026-10-17T18:47:00.626237+00:00'}),
+            ('read', {'type': 'read', 'user_id': 42, 'last_read_id': 1_284_551}),
+        ]
+
+    def measure(self, codec, event, iterations):
+        frame = codec.encode(event)
+        data = frame.get('bytes_data') or frame['text_data'].encode()
+
+        assert codec.decode(**frame) == event, 'round trip changed the event'
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            codec.encode(event)
+        encode_us = (time.perf_counter() - started) / iterations * 1_000_000
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            codec.decode(**frame)
+        decode_us = (time.perf_counter() - started) / iterations * 1_000_000
+
+        return len(data), encode_us, decode_us
@@ -0,0 +1,136 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.search import SNIPPET_TOKENS, buildMatchQuery, createFtsSql
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark FTS5 message search against icontains (LIKE) on a synthetic '
+        'corpus in a scratch SQLite database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000, help='Corpus size')
+        parser.add_argument('--users', type=int, default=1000, help='Distinct senders/recipients')
+        parser.add_argument('--queries', type=int, default=50, help='Queries per strategy')
+        parser.add_argument('--vocabulary', type=int, default=20_000, help='Distinct words')
+        parser.add_argument('--db', help='Scratch database path (default: temporary file)')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        sqlite_version = tuple(map(int, sqlite3.sqlite_version.split('.')))
+        if sqlite_version < (3, 20, 0):
+            raise CommandError(f'SQLite {sqlite3.sqlite_version} is too old for FTS5')
+
+        random.seed(options['seed'])
+        words = [f'w{index}' for index in range(options['vocabulary'])]
+
+        with tempfile.TemporaryDirectory() as scratch:
+            path = options['db'] or os.path.join(scratch, 'bench_search.sqlite3')
+            connection = sqlite3.connect(path)
+
+            try:
+                self.buildCorpus(connection, words, options['messages'], options['users'])
+                self.compare(connection, words, options['queries'], options['users'])
+            finally:
+                connection.close()
+
+    def buildCorpus(self, connection, words, message_count, user_count):
+        connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE chat_messages (
+                id INTEGER PRIMARY KEY,
+                sender_id INTEGER NOT NULL,
+                recipient_id INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                sender_deleted INTEGER NOT NULL DEFAULT 0,
+                recipient_deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX chat_messages_sender_recipient ON chat_messages (sender_id, recipient_id);
+        ''')
+
+        # Same external-content index and triggers as the application schema
+        for statement in createFtsSql('chat_messages_fts', 'chat_messages', 'body')[:-1]:
+            connection.execute(statement)
+
+        self.stdout.write(f'Inserting {message_count:,} messages...')
+        started = time.perf_counter()
+        base_time = datetime(2024, 1, 1)
+
+        # Zipf-like word frequencies, like real chat text
+        cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+        def rows():
+            for index in range(message_count):
+                sender = random.randrange(user_count)
+                recipient = random.randrange(user_count)
+                body = ' '.join(random.choices(words, cum_weights=cum_weights, k=random.randint(3, 20)))
+                created_at = (base_time + timedelta(seconds=index)).isoformat(' ')
+                yield (sender, recipient, body, created_at)
+
+        with connection:
+            connection.executemany(
+                'INSERT INTO chat_messages (sender_id, recipient_id, body, created_at) VALUES (?, ?, ?, ?)',
+                rows()
+            )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'  done in {elapsed:.1f}s ({message_count / elapsed:,.0f} rows/s with FTS triggers)')
+
+    def compare(self, connection, words, query_count, user_count):
+        # Mid-frequency words: not stop-word common, not vanishingly rare
+        terms = random.sample(words[50:2000], query_count)
+        users = [random.randrange(user_count) for _ in terms]
+
+        like_sql = '''
+            SELECT id, body FROM chat_messages
+            WHERE ((sender_id = ? AND NOT sender_deleted) OR (recipient_id = ? AND NOT recipient_deleted))
+              AND body LIKE ? ESCAPE '\\'
+            ORDER BY created_at DESC
+            LIMIT 20
+        '''
+
+        fts_sql = f'''
+            SELECT m.id, snippet(chat_messages_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}),
+                   bm25(chat_messages_fts) AS rank
+            FROM chat_messages_fts
+            JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+            WHERE chat_messages_fts MATCH ?
+              AND ((m.sender_id = ? AND NOT m.sender_deleted) OR (m.recipient_id = ? AND NOT m.recipient_deleted))
+            ORDER BY rank
+            LIMIT 20
+        '''
+
+        strategies = [
+            ('icontains (LIKE)', lambda term, user: connection.execute(
+                like_sql, (user, user, f'%{term}%')
+            ).fetchall()),
+            ('fts5 MATCH', lambda term, user: connection.execute(
+                fts_sql, (buildMatchQuery(term), user, user)
+            ).fetchall()),
+        ]
+
+        self.stdout.write(f'\n{"strategy":<18}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}')
+        for name, run in strategies:
+            timings = []
+            for term, user in zip(terms, users):
+                started = time.perf_counter()
+                run(term, user)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f'{name:<18}{statistics.median(timings):>10.2f}{p95:>10.2f}{timings[-1]:>10.2f}'
+            )
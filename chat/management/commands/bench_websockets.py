@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from chat import loadtest
+
+
+class Command(BaseCommand):
+    help = 'Load-test the WebSocket consumers in-process with simulated clients (creates and removes throwaway users)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=[*loadtest.SCENARIOS, 'all'], default='all')
+        parser.add_argument('--clients', type=int, default=1000, help='Concurrent sockets')
+        parser.add_argument('--messages', type=int, default=5, help='Messages per sending client')
+        parser.add_argument('--senders', type=int, default=10, help='Sending clients in the group scenario')
+        parser.add_argument('--rate', type=float, default=0, help='Messages per second across all senders (0: unthrottled)')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for deliveries')
+
+    def handle(self, *args, **options):
+        scenarios = loadtest.SCENARIOS if options['scenario'] == 'all' else [options['scenario']]
+
+        self.stdout.write(
+            f'{"scenario":<10}{"clients":>8}{"connect s":>11}{"KiB/conn":>10}{"delivered":>16}'
+            f'{"deliv/s":>10}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+        )
+        for scenario in scenarios:
+            report = loadtest.run(
+                scenario,
+                clients=options['clients'],
+                messages=options['messages'],
+                senders=options['senders'],
+                rate=options['rate'],
+                timeout=options['timeout'],
+            ).asDict()
+            self.stdout.write(
+                f'{scenario:<10}{report["clients"]:>8}{report["connect_seconds"]:>11.2f}'
+                f'{report["memory_per_connection"] / 1024:>10.1f}'
+                f'{report["delivered"]:>9}/{report["expected"]:<6}{report["throughput"]:>10,.0f}'
+                f'{report["p50_ms"]:>9.1f}{report["p95_ms"]:>9.1f}{report["p99_ms"]:>9.1f}'
+            )
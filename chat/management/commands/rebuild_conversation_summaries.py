@@ -0,0 +1,42 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from chat.models import Messages, ConversationSummary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the inbox conversation summaries from message history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            help='Only rebuild the summaries of this user id'
+        )
+
+    def handle(self, *args, **options):
+        user_id = options.get('user')
+
+        pairs = Messages.objects.values_list('sender_id', 'recipient_id').distinct()
+
+        # Every stored message can appear in both participants' inboxes
+        conversations = set()
+        for sender_id, recipient_id in pairs:
+            conversations.add((sender_id, recipient_id))
+            conversations.add((recipient_id, sender_id))
+
+        if user_id is not None:
+            conversations = {pair for pair in conversations if pair[0] == user_id}
+
+        with transaction.atomic():
+            stale = ConversationSummary.objects.all()
+            if user_id is not None:
+                stale = stale.filter(user_id=user_id)
+            stale.delete()
+
+            rebuilt = 0
+            for owner_id, partner_id in sorted(conversations):
+                if ConversationSummary.rebuild(owner_id, partner_id):
+                    rebuilt += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} conversation summaries'))
@@ -0,0 +1,36 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = 'Run the channel broker that UnixSocketChannelLayer workers on this host connect to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layer',
+            default='default',
+            help='CHANNEL_LAYERS alias to read the socket path, expiry and capacity from'
+        )
+        parser.add_argument('--path', help='Socket path (overrides the layer CONFIG)')
+
+    def handle(self, *args, **options):
+        config = dict(settings.CHANNEL_LAYERS.get(options['layer'], {}).get('CONFIG', {}))
+        if options['path']:
+            config['path'] = options['path']
+
+        if not config.get('path'):
+            raise CommandError(
+                f"No socket path: set CHANNEL_LAYERS['{options['layer']}']['CONFIG']['path'] or pass --path"
+            )
+
+        broker = ChannelBroker(**config)
+        self.stdout.write(self.style.SUCCESS(f"Channel broker listening on {config['path']}"))
+
+        try:
+            asyncio.run(broker.serve())
+        except KeyboardInterrupt:
+            pass
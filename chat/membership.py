@@ -0,0 +1,90 @@
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+from channels.db import database_sync_to_async
+
+
+CACHE_TIMEOUT = 300  # Seconds; signals invalidate earlier on any change
+MISSING = 'missing'  # Cached marker for rooms that don't exist
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def cacheKey(room_id):
+    return f'chat:room:{room_id}:members'
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def getRoomEntry(room_id):
+    """
+    Returns {'name': ..., 'members': frozenset(user ids)} for a room,
+    or None if the room doesn't exist. Served from the cache when possible.
+    """
+    entry = cache.get(cacheKey(room_id))
+    if entry is not None:
+        _count('hits')
+        return None if entry == MISSING else entry
+
+    _count('misses')
+
+    from .models import RoomModel
+
+    room = RoomModel.objects.filter(pk=room_id).values('name').first()
+    if room is None:
+        cache.set(cacheKey(room_id), MISSING, CACHE_TIMEOUT)
+        return None
+
+    entry = {
+        'name': room['name'],
+        'members': frozenset(
+            RoomModel.participants.through.objects.filter(
+                roommodel_id=room_id
+            ).values_list('customuser_id', flat=True)
+        ),
+    }
+    cache.set(cacheKey(room_id), entry, CACHE_TIMEOUT)
+    return entry
+
+
+def isMember(room_id, user_id):
+    entry = getRoomEntry(room_id)
+    return entry is not None and user_id in entry['members']
+
+
+# For WebSocket consumers; a cache miss still needs the database
+isMemberAsync = database_sync_to_async(isMember)
+getRoomEntryAsync = database_sync_to_async(getRoomEntry)
+
+
+def invalidate(room_ids):
+    """
+    Drops the cached entries now, for reads later in this transaction, and
+    again once it commits: an isMember() on another connection in between
+    still sees the old members and may have cached them.
+    """
+    keys = [cacheKey(room_id) for room_id in room_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+    _count('invalidations', len(keys))
+
+
+def stats():
+    """Hit and miss counters for this process."""
+    with _lock:
+        counters = dict(_counters)
+
+    lookups = counters['hits'] + counters['misses']
+    counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+    return counters
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
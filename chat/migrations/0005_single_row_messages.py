@@ -0,0 +1,133 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:34
+
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Copies written by the old sendMessage were created back to back
+PAIR_WINDOW = timedelta(seconds=5)
+BATCH_SIZE = 500
+
+
+def pairCopies(rows):
+    """
+    Split the rows of one (sender, recipient, body) group into
+    (sender_copy, recipient_copy) pairs. Either side may be None
+    when one participant already deleted their copy.
+    """
+    if rows[0].sender_id == rows[0].recipient_id:
+        # Messages to self: both copies have the same owner
+        sender_copies, recipient_copies = rows[0::2], rows[1::2]
+    else:
+        sender_copies = [row for row in rows if row.user_id == row.sender_id]
+        recipient_copies = [row for row in rows if row.user_id == row.recipient_id]
+
+    pairs = []
+    remaining = list(recipient_copies)
+    for sender_copy in sender_copies:
+        match = None
+        for candidate in remaining:
+            if abs(candidate.created_at - sender_copy.created_at) <= PAIR_WINDOW:
+                match = candidate
+                break
+        if match:
+            remaining.remove(match)
+        pairs.append((sender_copy, match))
+
+    pairs.extend((None, recipient_copy) for recipient_copy in remaining)
+    return pairs
+
+
+def mergeDuplicatePairs(apps, schema_editor):
+    Messages = apps.get_model('chat', 'Messages')
+
+    rows = Messages.objects.order_by('sender_id', 'recipient_id', 'body', 'created_at', 'id')
+    group_key = lambda row: (row.sender_id, row.recipient_id, row.body)
+
+    to_update = []
+    to_delete = []
+
+    for _, group in groupby(rows.iterator(), key=group_key):
+        for sender_copy, recipient_copy in pairCopies(list(group)):
+            if sender_copy and recipient_copy:
+                # Keep one row, carry over the recipient's read state
+                sender_copy.is_read = recipient_copy.is_read
+                to_update.append(sender_copy)
+                to_delete.append(recipient_copy.pk)
+            elif sender_copy:
+                sender_copy.recipient_deleted = True
+                to_update.append(sender_copy)
+            else:
+                recipient_copy.sender_deleted = True
+                to_update.append(recipient_copy)
+
+    Messages.objects.bulk_update(
+        to_update,
+        ['is_read', 'sender_deleted', 'recipient_deleted'],
+        batch_size=BATCH_SIZE
+    )
+    for start in range(0, len(to_delete), BATCH_SIZE):
+        Messages.objects.filter(pk__in=to_delete[start:start + BATCH_SIZE]).delete()
+
+
+def splitIntoCopies(apps, schema_editor):
+    Messages = apps.get_model('chat', 'Messages')
+
+    recipient_copies = []
+    for message in Messages.objects.iterator():
+        if message.sender_deleted:
+            message.user_id = message.recipient_id
+            message.save(update_fields=['user'])
+            continue
+
+        message.user_id = message.sender_id
+        message.save(update_fields=['user'])
+
+        if not message.recipient_deleted:
+            recipient_copies.append(Messages(
+                user_id=message.recipient_id,
+                sender_id=message.sender_id,
+                recipient_id=message.recipient_id,
+                body=message.body,
+                created_at=message.created_at,
+                is_read=message.is_read,
+            ))
+
+    Messages.objects.bulk_create(recipient_copies, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_rename_messagesmodel_messages_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messages',
+            name='recipient_deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='sender_deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mergeDuplicatePairs, splitIntoCopies),
+        migrations.RemoveIndex(
+            model_name='messages',
+            name='chat_messag_user_id_b7194c_idx',
+        ),
+        migrations.RemoveField(
+            model_name='messages',
+            name='user',
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(fields=['sender', 'recipient'], name='chat_messag_sender__ae30ce_idx'),
+        ),
+    ]
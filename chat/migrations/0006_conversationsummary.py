@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def buildSummaries(apps, schema_editor):
+    Messages = apps.get_model('chat', 'Messages')
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+
+    summaries = {}
+
+    # Newest first, so the first message seen per pair is the last one
+    for message in Messages.objects.order_by('-created_at', '-id').iterator():
+        sides = []
+        if not message.sender_deleted:
+            sides.append((message.sender_id, message.recipient_id))
+        if not message.recipient_deleted and message.sender_id != message.recipient_id:
+            sides.append((message.recipient_id, message.sender_id))
+
+        for user_id, partner_id in sides:
+            summary = summaries.get((user_id, partner_id))
+            if summary is None:
+                summary = summaries[(user_id, partner_id)] = ConversationSummary(
+                    user_id=user_id,
+                    partner_id=partner_id,
+                    last_message_id=message.pk,
+                    last_message_preview=message.body[:100],
+                    last_message_at=message.created_at,
+                    is_sent_last=message.sender_id == user_id,
+                )
+            if message.recipient_id == user_id and not message.is_read:
+                summary.unread_count += 1
+
+    ConversationSummary.objects.bulk_create(summaries.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_single_row_messages'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=100)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('is_sent_last', models.BooleanField(default=False)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.messages')),
+                ('partner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_message_at'], name='chat_conver_user_id_644a20_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'partner'), name='unique_conversation_summary')],
+            },
+        ),
+        migrations.RunPython(buildSummaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(fields=['sender', 'recipient', 'created_at', 'id'], name='chat_messag_sender__9272f3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='roommessagesmodel',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_roomme_room_id_8dc5c6_idx'),
+        ),
+    ]
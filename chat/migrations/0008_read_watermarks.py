@@ -0,0 +1,114 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+
+def buildWatermarks(apps, schema_editor):
+    """
+    One watermark per (recipient, sender) pair. It stops just before the
+    oldest unread message, so nothing that was unread becomes read.
+    """
+    Messages = apps.get_model('chat', 'Messages')
+    ReadWatermark = apps.get_model('chat', 'ReadWatermark')
+
+    pairs = Messages.objects.values('recipient_id', 'sender_id').annotate(
+        last_id=Max('id')
+    )
+    first_unread = {
+        (row['recipient_id'], row['sender_id']): row['first_unread_id']
+        for row in Messages.objects.filter(is_read=False).values(
+            'recipient_id', 'sender_id'
+        ).annotate(first_unread_id=Min('id'))
+    }
+
+    watermarks = []
+    for row in pairs:
+        key = (row['recipient_id'], row['sender_id'])
+        last_read_id = first_unread[key] - 1 if key in first_unread else row['last_id']
+        if last_read_id > 0:
+            watermarks.append(ReadWatermark(
+                user_id=row['recipient_id'],
+                partner_id=row['sender_id'],
+                last_read_id=last_read_id,
+            ))
+
+    ReadWatermark.objects.bulk_create(watermarks, batch_size=500)
+
+
+def restoreReadFlags(apps, schema_editor):
+    Messages = apps.get_model('chat', 'Messages')
+    ReadWatermark = apps.get_model('chat', 'ReadWatermark')
+
+    for watermark in ReadWatermark.objects.iterator():
+        Messages.objects.filter(
+            recipient_id=watermark.user_id,
+            sender_id=watermark.partner_id,
+            id__lte=watermark.last_read_id
+        ).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_cursor_pagination_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RoomReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='readwatermark',
+            name='partner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='readwatermark',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='roomreadwatermark',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to='chat.roommodel'),
+        ),
+        migrations.AddField(
+            model_name='roomreadwatermark',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_read_watermarks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readwatermark',
+            constraint=models.UniqueConstraint(fields=('user', 'partner'), name='unique_read_watermark'),
+        ),
+        migrations.AddConstraint(
+            model_name='roomreadwatermark',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_room_read_watermark'),
+        ),
+        migrations.RunPython(buildWatermarks, restoreReadFlags),
+        migrations.RemoveIndex(
+            model_name='messages',
+            name='chat_messag_is_read_6e9c3b_idx',
+        ),
+        migrations.RemoveField(
+            model_name='messages',
+            name='is_read',
+        ),
+    ]
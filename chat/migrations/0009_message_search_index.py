@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:45
+
+from django.db import migrations
+
+
+class SQLiteRunSQL(migrations.RunSQL):
+    """RunSQL that only runs on SQLite; other databases search with icontains."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+# External-content FTS5 indexes over the message text, kept in sync by
+# triggers. Only body/message edits touch the index, not flag updates.
+CREATE_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5("
+    "body, content='chat_messages', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF body ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END",
+
+    "INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')",
+
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_roommessagesmodel_fts USING fts5("
+    "message, content='chat_roommessagesmodel', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_roommessagesmodel_fts_ai AFTER INSERT ON chat_roommessagesmodel BEGIN "
+    "INSERT INTO chat_roommessagesmodel_fts(rowid, message) VALUES (new.id, new.message); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_roommessagesmodel_fts_ad AFTER DELETE ON chat_roommessagesmodel BEGIN "
+    "INSERT INTO chat_roommessagesmodel_fts(chat_roommessagesmodel_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_roommessagesmodel_fts_au AFTER UPDATE OF message ON chat_roommessagesmodel BEGIN "
+    "INSERT INTO chat_roommessagesmodel_fts(chat_roommessagesmodel_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); "
+    "INSERT INTO chat_roommessagesmodel_fts(rowid, message) VALUES (new.id, new.message); END",
+
+    "INSERT INTO chat_roommessagesmodel_fts(chat_roommessagesmodel_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS chat_messages_fts_ai",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_au",
+    "DROP TABLE IF EXISTS chat_messages_fts",
+    "DROP TRIGGER IF EXISTS chat_roommessagesmodel_fts_ai",
+    "DROP TRIGGER IF EXISTS chat_roommessagesmodel_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_roommessagesmodel_fts_au",
+    "DROP TABLE IF EXISTS chat_roommessagesmodel_fts",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_read_watermarks'),
+    ]
+
+    operations = [
+        SQLiteRunSQL(CREATE_SEARCH_INDEX, DROP_SEARCH_INDEX),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfillRoomPointers(apps, schema_editor):
+    RoomModel = apps.get_model('chat', 'RoomModel')
+    RoomMessagesModel = apps.get_model('chat', 'RoomMessagesModel')
+
+    for room in RoomModel.objects.iterator():
+        last_message = RoomMessagesModel.objects.filter(
+            room_id=room.pk
+        ).order_by('-timestamp', '-id').first()
+
+        RoomModel.objects.filter(pk=room.pk).update(
+            last_message=last_message,
+            last_message_at=last_message.timestamp if last_message else None,
+            participant_count=room.participants.count()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommodel',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.roommessagesmodel'),
+        ),
+        migrations.AddField(
+            model_name='roommodel',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='roommodel',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfillRoomPointers, migrations.RunPython.noop),
+    ]
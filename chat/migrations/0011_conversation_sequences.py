@@ -0,0 +1,102 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def numberMessages(apps, schema_editor):
+    """Numbers existing messages 1, 2, 3... per conversation in send order."""
+    Messages = apps.get_model('chat', 'Messages')
+    ConversationSequence = apps.get_model('chat', 'ConversationSequence')
+
+    last_seq = {}
+    numbered = []
+    for message in Messages.objects.order_by('created_at', 'id').only('id', 'sender_id', 'recipient_id').iterator():
+        key = (min(message.sender_id, message.recipient_id), max(message.sender_id, message.recipient_id))
+        last_seq[key] = message.seq = last_seq.get(key, 0) + 1
+        numbered.append(message)
+
+        if len(numbered) >= 500:
+            Messages.objects.bulk_update(numbered, ['seq'])
+            numbered = []
+    Messages.objects.bulk_update(numbered, ['seq'])
+
+    ConversationSequence.objects.bulk_create([
+        ConversationSequence(low_user_id=low, high_user_id=high, last_seq=seq)
+        for (low, high), seq in last_seq.items()
+    ], batch_size=500)
+
+
+class SQLiteRunSQL(migrations.RunSQL):
+    """RunSQL that only runs on SQLite, where the search index exists."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+# Adding seq rebuilds chat_messages on SQLite, which drops the FTS triggers
+# migration 0009 put on it
+REINSTALL_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF body ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END",
+
+    "INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_room_last_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Reversed last, after the field removal has rebuilt the table again
+        SQLiteRunSQL(migrations.RunSQL.noop, REINSTALL_SEARCH_TRIGGERS),
+        migrations.CreateModel(
+            name='ConversationSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_seq', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(fields=['sender', 'recipient', 'seq'], name='chat_messag_sender__35c578_idx'),
+        ),
+        migrations.AddField(
+            model_name='conversationsequence',
+            name='high_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversationsequence',
+            name='low_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsequence',
+            constraint=models.UniqueConstraint(fields=('low_user', 'high_user'), name='unique_conversation_sequence'),
+        ),
+        migrations.RunPython(numberMessages, migrations.RunPython.noop),
+        SQLiteRunSQL(REINSTALL_SEARCH_TRIGGERS, migrations.RunSQL.noop),
+    ]
@@ -1,59 +1,128 @@
 import os
-from PIL import Image
-from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction
+from django.urls import reverse
 from django.utils import timezone
-from django.db.models import Q, Max, Count
+from django.db.models import Q, F, Max, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 
 from userauths.models import CustomUser
+from userauths import avatars
+from . import attachments, inbox, membership
+from .pagination import PAGE_SIZE, paginateByCursor
 
 
 class Messages(models.Model):  # Changed to singular form (convention for model naming)
-    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='message_owner')
+    # A direct message is stored once; each participant has their own visibility flag
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='sent_messages')
     recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='received_messages')
     body = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)  # More explicit than 'date'
-    is_read = models.BooleanField(default=False)
+    sender_deleted = models.BooleanField(default=False)  # Hidden from the sender
+    recipient_deleted = models.BooleanField(default=False)  # Hidden from the recipient
+    seq = models.PositiveBigIntegerField(default=0)  # 1, 2, 3... within the conversation
 
     class Meta:
         ordering = ['-created_at']  # Default ordering for queries
         indexes = [
-            models.Index(fields=['user', 'recipient']),  # For faster lookups
-            models.Index(fields=['is_read']),
+            models.Index(fields=['sender', 'recipient']),  # For faster lookups
+            models.Index(fields=['sender', 'recipient', 'created_at', 'id']),  # Cursor pagination
+            models.Index(fields=['sender', 'recipient', 'seq']),  # Reconnect replay
         ]
 
     def __str__(self):
         return f"Message from {self.sender} to {self.recipient}"
 
+    @property
+    def is_read(self):
+        """
+        Whether the recipient has read the message, derived from their read
+        watermark. ReadWatermark.annotate() sets it for a whole batch with
+        one query; reading it on a message that wasn't annotated raises
+        instead of querying once per message.
+        """
+        try:
+            return self._is_read
+        except AttributeError:
+            raise RuntimeError(
+                f"is_read of message {self.pk} isn't loaded; pass the messages through ReadWatermark.annotate()"
+            ) from None
+
+    @is_read.setter
+    def is_read(self, value):
+        self._is_read = value
+
+    @staticmethod
+    def visibleTo(user):
+        """Filter for messages the user is a participant of and has not deleted."""
+        return (
+            Q(sender=user, sender_deleted=False) |
+            Q(recipient=user, recipient_deleted=False)
+        )
+
+    @staticmethod
+    def conversationWith(user, partner):
+        """Filter for the messages between user and partner that user can still see."""
+        return (
+            Q(sender=user, recipient=partner, sender_deleted=False) |
+            Q(sender=partner, recipient=user, recipient_deleted=False)
+        )
+
     # Custom model method
     @classmethod
     def sendMessage(cls, from_user, to_user, body):
         """
-        Creates and saves both sender and recipient copies of a message.
-        Returns a tuple of (sender_message, recipient_message)
+        Creates and saves a single message row shared by both participants
+        and updates both participants' conversation summaries.
         """
-        # Create sender copy
-        sender_msg = cls.objects.create(
-            user=from_user,
-            sender=from_user,
-            recipient=to_user,
-            body=body,
-            is_read=True
-        )
+        with transaction.atomic():
+            key = ConversationSequence.key(from_user.pk, to_user.pk)
+            message = cls.objects.create(
+                sender=from_user,
+                recipient=to_user,
+                body=body,
+                seq=ConversationSequence.allocate({key: 1})[key]
+            )
+            ConversationSummary.recordMessages([message])
 
-        # Create recipient copy
-        recipient_msg = cls.objects.create(
-            user=to_user,
-            sender=from_user,
-            recipient=to_user,
-            body=body,
-            is_read=False
-        )
+        return message
 
-        return sender_msg, recipient_msg
+    @classmethod
+    def bulkSend(cls, items):
+        """
+        Stores a batch of (sender_id, recipient_id, body) messages with one INSERT
+        and updates the conversation summaries and sequences in the same transaction.
+        Returns the saved messages in the same order.
+        """
+        counts = {}
+        for sender_id, recipient_id, _ in items:
+            key = ConversationSequence.key(sender_id, recipient_id)
+            counts[key] = counts.get(key, 0) + 1
+
+        with transaction.atomic():
+            next_seq = ConversationSequence.allocate(counts)
+
+            messages = []
+            for sender_id, recipient_id, body in items:
+                key = ConversationSequence.key(sender_id, recipient_id)
+                messages.append(cls(sender_id=sender_id, recipient_id=recipient_id, body=body, seq=next_seq[key]))
+                next_seq[key] += 1
+
+            sent = cls.objects.bulk_create(messages)
+            ConversationSummary.recordMessages(sent)
+
+        return sent
+
+    @classmethod
+    def since(cls, user, partner, last_seq, limit):
+        """Messages in the conversation after last_seq that user can see, oldest first."""
+        return list(
+            cls.objects.filter(
+                cls.conversationWith(user, partner),
+                seq__gt=last_seq
+            ).prefetch_related('attachments').order_by('seq')[:limit]
+        )
 
     @classmethod
     def getConversationsList(cls, user):
@@ -61,98 +130,375 @@ class Messages(models.Model):  # Changed to singular form (convention for model
         Returns all conversations for a user with the latest message info
         and unread counts for each conversation partner.
         """
-        # Get all unique conversation partners
-        partners = CustomUser.objects.filter(
-            Q(received_messages__sender=user) | 
-            Q(sent_messages__recipient=user)
-        ).distinct()
-        
-        conversations = []
-        
-        for partner in partners:
-            # Get the last message in the conversation
-            last_message = cls.objects.filter(
-                Q(sender=user, recipient=partner) | 
-                Q(sender=partner, recipient=user)
-            ).order_by('-created_at').first()
-
-            # Skip if no messages exist with this partner
-            if not last_message:
-                continue
-
-            # Count unread messages from this partner
-            unread_count = cls.objects.filter(
-                recipient=user,
-                sender=partner,
-                is_read=False
-            ).count()
-
-            conversations.append({
-                'partner': partner,
-                'last_message': last_message,
-                'last_message_body': last_message.body if last_message else '',
-                'unread_count': unread_count,
-                'is_sent_last': last_message.sender == user if last_message else False,
-                'last_message_time': last_message.created_at if last_message else None
-            })
-        
-        # Sort by last message time (newest first)
-        conversations.sort(
-            key=lambda x: x['last_message_time'] or timezone.datetime.min, 
-            reverse=True
-        )
-        
-        return conversations
+        summaries = ConversationSummary.objects.filter(
+            user=user
+        ).select_related('partner', 'last_message').order_by('-last_message_at')
+
+        return [
+            {
+                'partner': summary.partner,
+                'last_message': summary.last_message,
+                'last_message_body': summary.last_message_preview,
+                'unread_count': summary.unread_count,
+                'is_sent_last': summary.is_sent_last,
+                'last_message_time': summary.last_message_at
+            }
+            for summary in summaries
+        ]
 
     @classmethod
-    def getConversation(cls, user, partner_id):
+    def getConversation(cls, user, partner_id, before=None, after=None, limit=PAGE_SIZE):
+        """
+        Returns one page of the conversation with partner, oldest first.
+        Without a cursor this is the latest page; see chat.pagination.
+        """
         partner = CustomUser.objects.get(pk=partner_id)
 
-        cls.objects.filter(
-            user=user,          # Messages belonging to the current user (recipient's copy)
-            sender=partner,     # Messages from this specific conversation partner
-            recipient=user,     # Confirms these are received messages (not sent)
-            is_read=False       # Only unread messages
-        ).update(is_read=True)  # Marks them as read
+        # Paging back through history does not change read state
+        if not before:
+            cls.markConversationRead(user, partner)
         
-        # Get all messages where user is involved (both sent and received)
+        # Messages between the two users that are still visible to the user
         messages = cls.objects.filter(
-            Q(user=user) &  # Only fetch messages belonging to current user
-            (
-                (Q(sender=user) & Q(recipient=partner)) |
-                (Q(sender=partner) & Q(recipient=user))
-            )
-        ).order_by('created_at')
+            cls.conversationWith(user, partner)
+        ).select_related('sender', 'recipient').prefetch_related('attachments')
+
+        page = paginateByCursor(messages, 'created_at', before=before, after=after, limit=limit)
         
-        # Annotate each message with whether the recipient has read their copy
-        for message in messages:
-            if message.sender == user:
-                # For sent messages, check if recipient's copy is read
-                recipient_copy = cls.objects.filter(
-                    user=partner,
-                    sender=user,
-                    recipient=partner,
-                    body=message.body,
-                    created_at__range=(
-                        message.created_at - timedelta(seconds=5),  # 5-second window before
-                        message.created_at + timedelta(seconds=5)   # 5-second window after
-                    )
-                ).first()
-                
-                message.recipient_has_read = recipient_copy.is_read if recipient_copy else False
+        cls.annotateReadReceipts(page['items'], user)
         
         return {
             'partner': partner,
-            'messages': messages
+            'messages': page['items'],
+            'older_cursor': page['older'],
+            'newer_cursor': page['newer'],
+            'has_older': page['has_older'],
+            'has_newer': page['has_newer'],
         }
+
+    @staticmethod
+    def annotateReadReceipts(messages, user):
+        """
+        Sets is_read on every message and recipient_has_read on the ones user sent.
+        Both participants share one row, so a whole page is resolved with a
+        single watermark query.
+        """
+        ReadWatermark.annotate(messages)
+        for message in messages:
+            if message.sender_id == user.id:
+                message.recipient_has_read = message.is_read
+        return messages
+
+    @classmethod
+    def markConversationRead(cls, user, partner, up_to_id=None):
+        """
+        Marks every message partner sent to user as read by moving the user's
+        watermark forward. Earlier messages are read too, once it has moved.
+        """
+        with transaction.atomic():
+            if up_to_id is None:
+                up_to_id = cls.objects.filter(
+                    sender=partner,     # Messages from this specific conversation partner
+                    recipient=user      # Confirms these are received messages (not sent)
+                ).aggregate(last_id=Max('id'))['last_id']
+
+            if not up_to_id or up_to_id <= ReadWatermark.lastReadId(user, partner):
+                return
+
+            ReadWatermark.advance(user, partner, up_to_id)
+
+            ConversationSummary.objects.filter(
+                user=user, partner=partner
+            ).update(
+                unread_count=cls.unreadCount(user, partner),
+                updated_at=timezone.now()
+            )
+            inbox.invalidate([getattr(user, 'pk', user)])
+
+    @classmethod
+    def unreadCount(cls, user, partner):
+        """Range count of partner's messages past the user's watermark."""
+        return cls.objects.filter(
+            sender=partner,
+            recipient=user,
+            recipient_deleted=False,
+            id__gt=ReadWatermark.lastReadId(user, partner)
+        ).count()
     
     def mark_as_read(self):
-        """Marks the message as read if it isn't already."""
+        """Marks the message, and everything before it in the thread, as read."""
+        if not hasattr(self, '_is_read'):
+            ReadWatermark.annotate([self])
         if not self.is_read:
+            self.__class__.markConversationRead(self.recipient_id, self.sender_id, up_to_id=self.pk)
             self.is_read = True
-            self.save(update_fields=['is_read'])
+
+    def deleteFor(self, user):
+        """
+        Hides the message from one participant.
+        The row is only removed once both participants have deleted it.
+        """
+        if user.id not in (self.sender_id, self.recipient_id):
+            raise ValidationError("Only the sender or the recipient can delete a message")
+
+        partner_id = self.recipient_id if user.id == self.sender_id else self.sender_id
+        if user.id == self.sender_id:
+            self.sender_deleted = True
+        if user.id == self.recipient_id:
+            self.recipient_deleted = True
+
+        with transaction.atomic():
+            if self.sender_deleted and self.recipient_deleted:
+                self.delete()
+            else:
+                self.save(update_fields=['sender_deleted', 'recipient_deleted'])
+
+            ConversationSummary.rebuild(user.id, partner_id)
+
+    @classmethod
+    def deleteConversation(cls, user, partner):
+        """
+        Hides every message between user and partner from user only.
+        Returns the number of messages removed from the user's view.
+        """
+        with transaction.atomic():
+            hidden_count = cls.objects.filter(
+                sender=user, recipient=partner, sender_deleted=False
+            ).update(sender_deleted=True)
+            hidden_count += cls.objects.filter(
+                sender=partner, recipient=user, recipient_deleted=False
+            ).update(recipient_deleted=True)
+
+            # Drop rows neither participant can see anymore
+            cls.objects.filter(
+                Q(sender=user, recipient=partner) | Q(sender=partner, recipient=user),
+                sender_deleted=True,
+                recipient_deleted=True
+            ).delete()
+
+            ConversationSummary.objects.filter(user=user, partner=partner).delete()
+            inbox.invalidate([user.pk])
+
+        return hidden_count
+
+
+class ConversationSummary(models.Model):
+    """
+    Denormalized inbox row for one (user, partner) pair.
+    Kept up to date by Messages so the conversation list is a single query.
+    """
+    PREVIEW_LENGTH = 100
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='conversation_summaries')
+    partner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(
+        Messages,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    is_sent_last = models.BooleanField(default=False)  # Direction of the last message
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'partner'], name='unique_conversation_summary'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at']),  # Inbox ordering
+        ]
+
+    def __str__(self):
+        return f"Conversation of {self.user} with {self.partner}"
+
+    @classmethod
+    def recordMessages(cls, messages):
+        """
+        Applies newly sent messages to both participants' summaries,
+        with one UPDATE per affected (user, partner) row.
+        """
+        # (user, partner) -> [last message, number of new unread]
+        sides = {}
+        for message in messages:
+            sender_side = sides.setdefault((message.sender_id, message.recipient_id), [message, 0])
+            sender_side[0] = message
+
+            if message.sender_id != message.recipient_id:
+                recipient_side = sides.setdefault((message.recipient_id, message.sender_id), [message, 0])
+                recipient_side[0] = message
+                recipient_side[1] += 1
+
+        now = timezone.now()
+        for (user_id, partner_id), (last_message, new_unread) in sides.items():
+            updated = cls.objects.filter(
+                user_id=user_id, partner_id=partner_id
+            ).update(
+                last_message=last_message,
+                last_message_preview=last_message.body[:cls.PREVIEW_LENGTH],
+                last_message_at=last_message.created_at,
+                is_sent_last=last_message.sender_id == user_id,
+                unread_count=F('unread_count') + new_unread,
+                updated_at=now
+            )
+            if not updated:
+                cls.rebuild(user_id, partner_id)
+
+        inbox.invalidate(user_id for user_id, _ in sides)
+
+    @classmethod
+    def rebuild(cls, user_id, partner_id):
+        """
+        Recomputes one summary row from message history.
+        Removes the row when the user has no visible messages left with partner.
+        """
+        inbox.invalidate([user_id])
+
+        visible = Messages.objects.filter(
+            Messages.conversationWith(user_id, partner_id)
+        )
+        last_message = visible.order_by('-created_at', '-id').first()
+
+        if not last_message:
+            cls.objects.filter(user_id=user_id, partner_id=partner_id).delete()
+            return None
+
+        unread_count = Messages.unreadCount(user_id, partner_id)
+
+        summary, _ = cls.objects.update_or_create(
+            user_id=user_id,
+            partner_id=partner_id,
+            defaults={
+                'last_message': last_message,
+                'last_message_preview': last_message.body[:cls.PREVIEW_LENGTH],
+                'last_message_at': last_message.created_at,
+                'is_sent_last': last_message.sender_id == user_id,
+                'unread_count': unread_count,
+            }
+        )
+        return summary
+
+    @classmethod
+    def touch(cls, message):
+        """
+        Marks both participants' rows as changed without changing what they
+        show, for things the conversation page shows but the inbox doesn't.
+        """
+        cls.objects.filter(
+            Q(user_id=message.sender_id, partner_id=message.recipient_id) |
+            Q(user_id=message.recipient_id, partner_id=message.sender_id)
+        ).update(updated_at=timezone.now())
+
 
 
+class ConversationSequence(models.Model):
+    """
+    Last sequence number handed out in the conversation between two users,
+    stored once per pair with the lower user id first.
+    """
+    low_user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    high_user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['low_user', 'high_user'], name='unique_conversation_sequence'),
+        ]
+
+    def __str__(self):
+        return f"Conversation of {self.low_user} and {self.high_user} at {self.last_seq}"
+
+    @staticmethod
+    def key(user_id, partner_id):
+        return (min(user_id, partner_id), max(user_id, partner_id))
+
+    @classmethod
+    def allocate(cls, counts):
+        """
+        Reserves counts[key] consecutive numbers for each conversation key and
+        returns the first number of each range. Must run inside a transaction;
+        the UPDATE locks the row until it commits.
+        """
+        cls.objects.bulk_create(
+            [cls(low_user_id=low, high_user_id=high) for low, high in counts],
+            ignore_conflicts=True
+        )
+
+        first_seq = {}
+        for (low, high), count in counts.items():
+            rows = cls.objects.filter(low_user_id=low, high_user_id=high)
+            rows.update(last_seq=F('last_seq') + count)
+            first_seq[(low, high)] = rows.values_list('last_seq', flat=True).get() - count + 1
+        return first_seq
+
+
+class ReadWatermark(models.Model):
+    """
+    Highest message id a user has read in their conversation with partner.
+    Everything from partner at or below it counts as read.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='read_watermarks')
+    partner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'partner'], name='unique_read_watermark'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} read {self.partner} up to {self.last_read_id}"
+
+    @classmethod
+    def lastReadId(cls, user, partner):
+        last_read_id = cls.objects.filter(
+            user=user, partner=partner
+        ).values_list('last_read_id', flat=True).first()
+        return last_read_id or 0
+
+    @classmethod
+    def advance(cls, user, partner, last_read_id):
+        """Single-row upsert of the watermark."""
+        cls.objects.bulk_create(
+            [cls(
+                user_id=getattr(user, 'pk', user),
+                partner_id=getattr(partner, 'pk', partner),
+                last_read_id=last_read_id,
+                updated_at=timezone.now()
+            )],
+            update_conflicts=True,
+            unique_fields=['user', 'partner'],
+            update_fields=['last_read_id', 'updated_at']
+        )
+
+    @classmethod
+    def annotate(cls, messages):
+        """Sets is_read on a batch of messages with one query."""
+        pairs = {(message.recipient_id, message.sender_id) for message in messages}
+        if not pairs:
+            return messages
+
+        pair_filter = Q()
+        for user_id, partner_id in pairs:
+            pair_filter |= Q(user_id=user_id, partner_id=partner_id)
+
+        watermarks = {
+            (user_id, partner_id): last_read_id
+            for user_id, partner_id, last_read_id in cls.objects.filter(
+                pair_filter
+            ).values_list('user_id', 'partner_id', 'last_read_id')
+        }
+
+        for message in messages:
+            message.is_read = message.pk <= watermarks.get(
+                (message.recipient_id, message.sender_id), 0
+            )
+        return messages
+
 
 # from chat.models import *
 # k = CustomUser.objects.get(pk=1)
@@ -192,10 +538,23 @@ class RoomModel(models.Model):
         default='default.jpg',
         help_text='Profile picture (300x300 recommended)'
     )
+    # Resized copies of the avatar, filled in by userauths.avatars
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     is_active = models.BooleanField(default=True)
     description = models.TextField(blank=True, null=True)
 
+    # Denormalized for the group list, kept in sync by chat.signals
+    last_message = models.ForeignKey(
+        'RoomMessagesModel',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    participant_count = models.PositiveIntegerField(default=0)
+
     class Meta:
         ordering = ['-updated_at']
 
@@ -206,11 +565,12 @@ class RoomModel(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
-        img = Image.open(self.avatar.path)
-        if img.height > 300 or img.width > 300:
-            output_size = (300, 300) # (height, width)
-            img.thumbnail(output_size)
-            img.save(self.avatar.path)
+        # Resized copies are made in the background, and only when the file changed
+        avatars.avatarSaved(self, kwargs.get('update_fields'))
+
+    def avatarUrl(self, size=48, webp=False):
+        """The avatar sized for a size-pixel slot (see userauths.avatars)."""
+        return avatars.variantUrl(self, size, webp)
 
     def handleUsernameChange(self, old_username):
         """Handle avatar file movement when username changes"""
@@ -227,7 +587,51 @@ class RoomModel(models.Model):
         if self.name:
             return self.name
         
-        return f"Group Chat ({self.participants.count()} members)"
+        return f"Group Chat ({self.participant_count} members)"
+
+    # updated_at doubles as the room's version for conditional GET (see
+    # chat.conditional), so every update below moves it too
+
+    @classmethod
+    def recordMessage(cls, message):
+        """Points the room at a new message unless a newer one is already recorded."""
+        updated = cls.objects.filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp),
+            pk=message.room_id
+        ).update(last_message=message, last_message_at=message.timestamp, updated_at=timezone.now())
+
+        if not updated:
+            cls.touch([message.room_id])
+
+    @classmethod
+    def touch(cls, room_ids):
+        """Marks rooms as changed, e.g. when a message other than the last one is deleted."""
+        cls.objects.filter(pk__in=room_ids).update(updated_at=timezone.now())
+
+    @classmethod
+    def refreshLastMessage(cls, room_id):
+        """Recomputes the last message pointer from history."""
+        last_message = RoomMessagesModel.objects.filter(
+            room_id=room_id
+        ).order_by('-timestamp', '-id').first()
+
+        cls.objects.filter(pk=room_id).update(
+            last_message=last_message,
+            last_message_at=last_message.timestamp if last_message else None,
+            updated_at=timezone.now()
+        )
+
+    @classmethod
+    def refreshParticipantCount(cls, room_ids):
+        """Recounts participants for the given rooms in a single UPDATE."""
+        member_count = cls.participants.through.objects.filter(
+            roommodel_id=OuterRef('pk')
+        ).order_by().values('roommodel_id').annotate(count=Count('pk')).values('count')
+
+        cls.objects.filter(pk__in=room_ids).update(
+            participant_count=Coalesce(Subquery(member_count), 0),
+            updated_at=timezone.now()
+        )
 
 
 class RoomMessagesModel(models.Model):
@@ -247,22 +651,217 @@ class RoomMessagesModel(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id']),  # Cursor pagination
+        ]
 
     def __str__(self):
         return f"Message from {self.sender} in {self.room}"
 
     def save(self, *args, **kwargs):
         # Verify sender is a room participant before saving
-        if not self.room.participants.filter(pk=self.sender.pk).exists():
+        if not membership.isMember(self.room_id, self.sender_id):
             raise ValidationError("Sender must be a room participant")
         super().save(*args, **kwargs)
 
+    @classmethod
+    def bulkSend(cls, items):
+        """
+        Stores a batch of (room_id, sender_id, message) items with one INSERT.
+        bulk_create skips save() and the post_save signal, so membership is
+        checked here and each room's last message is recorded explicitly.
+        Returns one saved message per item, or None where the sender isn't
+        a participant of the room.
+        """
+        allowed = [
+            membership.isMember(room_id, sender_id)
+            for room_id, sender_id, _ in items
+        ]
 
+        with transaction.atomic():
+            sent = iter(cls.objects.bulk_create([
+                cls(room_id=room_id, sender_id=sender_id, message=message)
+                for (room_id, sender_id, message), ok in zip(items, allowed) if ok
+            ]))
+            results = [next(sent) if ok else None for ok in allowed]
+
+            latest = {}
+            for message in results:
+                if message is not None:
+                    latest[message.room_id] = message
+            for message in latest.values():
+                RoomModel.recordMessage(message)
+
+        return results
+
+
+class Attachment(models.Model):
+    """
+    A file sent with a direct or group message. It is uploaded for one
+    conversation (see chat.attachments), then claimed by the message its
+    uploader sends there with attachment_id.
+    """
+    uploader = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='attachments')
+    # The conversation it was uploaded for: one of the two
+    recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    room = models.ForeignKey(RoomModel, on_delete=models.CASCADE, null=True, blank=True, related_name='attachments')
+    # Set once it is sent
+    message = models.ForeignKey(Messages, on_delete=models.CASCADE, null=True, blank=True, related_name='attachments')
+    room_message = models.ForeignKey(
+        RoomMessagesModel,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='attachments'
+    )
 
+    name = models.CharField(max_length=255)  # As uploaded, offered again on download
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)  # Bytes stored so far; an upload resumes here
+    path = models.CharField(max_length=100, unique=True)  # Under CHAT_ATTACHMENTS["ROOT"]
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} from {self.uploader}"
+
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+
+    @property
+    def is_image(self):
+        """Shown in the chat rather than as a file link."""
+        return self.content_type.startswith('image/') and self.content_type in attachments.INLINE_TYPES
+
+    def isVisibleTo(self, user_id):
+        """The uploader, and once it is sent, whoever can see the message."""
+        if self.uploader_id == user_id:
+            return True
 
+        if self.room_message_id is not None:
+            return membership.isMember(self.room_id, user_id)
+
+        message = self.message
+        return message is not None and (
+            (message.sender_id == user_id and not message.sender_deleted) or
+            (message.recipient_id == user_id and not message.recipient_deleted)
+        )
+
+    def advance(self, offset):
+        """
+        Records that every byte before offset is stored and returns the
+        stored offset, which another request may have moved further.
+        """
+        now = timezone.now()
+        self.__class__.objects.filter(pk=self.pk, received__lt=offset).update(received=offset)
+        if offset >= self.size:
+            self.__class__.objects.filter(pk=self.pk, completed_at__isnull=True).update(completed_at=now)
 
+        self.received, self.completed_at = self.__class__.objects.filter(
+            pk=self.pk
+        ).values_list('received', 'completed_at').get()
+        return self.received
 
+    @classmethod
+    def pendingFor(cls, user, attachment_id, recipient_id=None, room_id=None):
+        """The user's finished, not yet sent upload for this conversation, or None."""
+        return cls.objects.filter(
+            pk=attachment_id,
+            uploader=user,
+            recipient_id=recipient_id,
+            room_id=room_id,
+            message__isnull=True,
+            room_message__isnull=True,
+            completed_at__isnull=False
+        ).first()
+
+    def attachTo(self, message):
+        """Claims the attachment for a saved message; False if another message got it first."""
+        is_room = isinstance(message, RoomMessagesModel)
+        claimed = bool(self.__class__.objects.filter(
+            pk=self.pk, message__isnull=True, room_message__isnull=True
+        ).update(**{'room_message' if is_room else 'message': message}))
+
+        # Pages rendered between the message and this have gone stale
+        if claimed and is_room:
+            RoomModel.touch([message.room_id])
+        elif claimed:
+            ConversationSummary.touch(message)
+        return claimed
+
+    def asEvent(self):
+        """What clients are told about it, in events and message lists."""
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'size': self.size,
+            'content_type': self.content_type,
+            'url': reverse('attachment', args=[self.pk]),
+        }
+
+
+class RoomReadWatermark(models.Model):
+    """Highest room message id a participant has read in that room."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='room_read_watermarks')
+    room = models.ForeignKey(RoomModel, on_delete=models.CASCADE, related_name='read_watermarks')
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='unique_room_read_watermark'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} read {self.room} up to {self.last_read_id}"
+
+    @classmethod
+    def lastReadId(cls, user, room):
+        last_read_id = cls.objects.filter(
+            user=user, room=room
+        ).values_list('last_read_id', flat=True).first()
+        return last_read_id or 0
+
+    @classmethod
+    def markRead(cls, user, room, up_to_id):
+        """
+        Moves the watermark forward with a single-row upsert.
+        Returns True if it moved.
+        """
+        if not up_to_id or up_to_id <= cls.lastReadId(user, room):
+            return False
+
+        cls.objects.bulk_create(
+            [cls(
+                user_id=getattr(user, 'pk', user),
+                room_id=getattr(room, 'pk', room),
+                last_read_id=up_to_id,
+                updated_at=timezone.now()
+            )],
+            update_conflicts=True,
+            unique_fields=['user', 'room'],
+            update_fields=['last_read_id', 'updated_at']
+        )
+        return True
+
+    @classmethod
+    def annotateUnreadCount(cls, rooms, user):
+        """
+        Adds unread_count to a RoomModel queryset as a correlated range count
+        over messages past the user's watermark.
+        """
+        last_read = cls.objects.filter(
+            user=user, room=OuterRef(OuterRef('pk'))
+        ).values('last_read_id')[:1]
 
+        unread = RoomMessagesModel.objects.filter(
+            room=OuterRef('pk'),
+            id__gt=Coalesce(Subquery(last_read), 0)
+        ).exclude(
+            sender=user
+        ).order_by().values('room').annotate(count=Count('id')).values('count')
 
+        return rooms.annotate(unread_count=Coalesce(Subquery(unread), 0))
 
-         
\ No newline at end of file
@@ -0,0 +1,143 @@
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+
+OUTBOUND = getattr(settings, 'CHAT_OUTBOUND', {})
+MAX_QUEUE = OUTBOUND.get('MAX_QUEUE', 256)  # Frames waiting for one socket before the policy kicks in
+POLICY = OUTBOUND.get('POLICY', 'coalesce')
+
+POLICIES = ('drop_typing', 'coalesce', 'disconnect')
+
+# Tells the client it was too slow; it reconnects (with ?last_seq) rather than giving up
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+_queues = set()  # Live OutboundQueues, for stats()
+_counters = {'enqueued': 0, 'sent': 0, 'coalesced': 0, 'dropped_typing': 0, 'slow_disconnects': 0}
+
+
+def _supersedeKey(payload):
+    """Frames with the same key only matter in their newest version: who is typing, how far they read."""
+    if payload.get('type') not in ('typing', 'read'):
+        return None
+
+    conversation = payload.get('conversation')
+    if isinstance(conversation, dict):
+        conversation = (conversation.get('kind'), conversation.get('id'))
+    return (payload['type'], conversation, payload.get('user_id'))
+
+
+class OutboundQueue:
+    """
+    The frames waiting to go out on one socket, drained by their own task so
+    group handlers return at once and a slow client never holds up the
+    channel layer.
+
+    Past max_size frames the policy decides what to shed:
+
+        drop_typing  drop typing frames, which are only ever a hint
+        coalesce     first keep only the newest typing/read frame per user
+                     and conversation, then drop typing frames
+        disconnect   close the socket straight away
+
+    Chat frames are never dropped. If shedding doesn't bring the queue back
+    under max_size the socket is closed with SLOW_CONSUMER_CLOSE_CODE and the
+    client catches up on reconnect.
+
+    send(payload) and close(code) are the coroutines doing the real work.
+    """
+
+    def __init__(self, send, close, max_size=MAX_QUEUE, policy=POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown outbound policy {policy!r}, expected one of {POLICIES}')
+
+        self.send = send
+        self.close = close
+        self.max_size = max_size
+        self.policy = policy
+        self.frames = deque()
+        self.high_water = 0
+        self.closing = False
+        self.close_code = None
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        _queues.add(self)
+
+    def put(self, payload):
+        if self.closing:
+            return
+
+        _counters['enqueued'] += 1
+        self.frames.append(payload)
+        if len(self.frames) > self.max_size:
+            self.shed()
+
+        self.high_water = max(self.high_water, len(self.frames))
+        self.ready.set()
+
+    def shed(self):
+        if self.policy == 'coalesce':
+            self.coalesce()
+        if len(self.frames) > self.max_size and self.policy != 'disconnect':
+            self.dropTyping()
+
+        if len(self.frames) > self.max_size:
+            _counters['slow_disconnects'] += 1
+            self.frames.clear()
+            self.closeAfterSend(SLOW_CONSUMER_CLOSE_CODE)
+
+    def coalesce(self):
+        seen = set()
+        kept = deque()
+        for payload in reversed(self.frames):
+            key = _supersedeKey(payload)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.appendleft(payload)
+
+        _counters['coalesced'] += len(self.frames) - len(kept)
+        self.frames = kept
+
+    def dropTyping(self):
+        kept = deque(payload for payload in self.frames if payload.get('type') != 'typing')
+        _counters['dropped_typing'] += len(self.frames) - len(kept)
+        self.frames = kept
+
+    def closeAfterSend(self, code=None):
+        """Closes the socket once the frames already queued are out."""
+        self.closing = True
+        self.close_code = code
+        self.ready.set()
+
+    def cancel(self):
+        self.task.cancel()
+        _queues.discard(self)
+
+    async def run(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.frames:
+                    await self.send(self.frames.popleft())
+                    _counters['sent'] += 1
+
+                if self.closing:
+                    await self.close(self.close_code)
+                    return
+                self.ready.clear()
+        finally:
+            _queues.discard(self)
+
+
+def stats():
+    """Outbound queue counters and current depths for this process."""
+    counters = dict(_counters)
+    depths = [len(queue.frames) for queue in _queues]
+    counters['connections'] = len(depths)
+    counters['queued'] = sum(depths)
+    counters['deepest'] = max(depths, default=0)
+    counters['high_water'] = max((queue.high_water for queue in _queues), default=0)
+    return counters
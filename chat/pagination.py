@@ -0,0 +1,82 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encodeCursor(timestamp, pk):
+    """Encode a (timestamp, id) position as an opaque url-safe token."""
+    raw = json.dumps([timestamp.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decodeCursor(cursor):
+    """Decode a token from encodeCursor, raising ValueError if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = json.loads(base64.urlsafe_b64decode(padded))
+        timestamp = parse_datetime(timestamp)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+    if timestamp is None or not isinstance(pk, int):
+        raise ValueError('Invalid cursor')
+    return timestamp, pk
+
+
+def parseLimit(value, default=PAGE_SIZE):
+    """Clamp a user supplied page size to [1, MAX_PAGE_SIZE]."""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginateByCursor(queryset, time_field, before=None, after=None, limit=PAGE_SIZE):
+    """
+    Keyset pagination over (time_field, id).
+
+    Without a cursor the latest page is returned. `before` walks back to older
+    messages and `after` fetches newer ones. Items are always returned oldest
+    first so templates can render them as-is.
+    """
+    if before:
+        timestamp, pk = decodeCursor(before)
+        rows = list(queryset.filter(
+            Q(**{f'{time_field}__lt': timestamp}) |
+            Q(**{time_field: timestamp, 'id__lt': pk})
+        ).order_by(f'-{time_field}', '-id')[:limit + 1])
+        has_older, has_newer = len(rows) > limit, True
+        items = rows[:limit][::-1]
+
+    elif after:
+        timestamp, pk = decodeCursor(after)
+        rows = list(queryset.filter(
+            Q(**{f'{time_field}__gt': timestamp}) |
+            Q(**{time_field: timestamp, 'id__gt': pk})
+        ).order_by(time_field, 'id')[:limit + 1])
+        has_older, has_newer = True, len(rows) > limit
+        items = rows[:limit]
+
+    else:
+        rows = list(queryset.order_by(f'-{time_field}', '-id')[:limit + 1])
+        has_older, has_newer = len(rows) > limit, False
+        items = rows[:limit][::-1]
+
+    def cursorFor(item):
+        return encodeCursor(getattr(item, time_field), item.pk)
+
+    return {
+        'items': items,
+        'has_older': has_older,
+        'has_newer': has_newer,
+        'older': cursorFor(items[0]) if items and has_older else None,
+        # Always hand back a newer cursor so clients can poll for new messages
+        'newer': cursorFor(items[-1]) if items else after,
+    }
@@ -0,0 +1,251 @@
+"""
+Who is online, and when users were last active.
+
+Each process registers its open sockets here and publishes them to a
+shared Django cache (CHAT_PRESENCE["CACHE"]): a user is online while a key
+for them exists there. Processes refresh the keys of their connected users
+every HEARTBEAT_S seconds and the keys expire ONLINE_TTL_S seconds after
+the last refresh, so a worker that dies takes its users offline with it.
+Closing a user's last socket in a process drops the key right away; if
+they're still connected to another worker, its next heartbeat puts it back.
+
+last_activity changes are collected in _pending and written in batches
+every FLUSH_INTERVAL_S seconds (and, with FLUSH_AT_EXIT, once more when the
+process exits), not on every message or disconnect. Until then the latest
+value is published to the cache too, on connect and disconnect and with
+each heartbeat, so every worker shows the same last activity. A process
+that is killed without exiting normally (SIGKILL, a crash) loses up to
+FLUSH_INTERVAL_S seconds of activity.
+
+isOnline(), onlineAmong() and latestActivity() only read the cache, never
+this process's own registry, so all workers answer the same way (the
+conversation ETags include them). With several workers the cache has to be
+shared between them; see chat.checks.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+from channels.db import database_sync_to_async
+
+from userauths.models import CustomUser
+
+
+logger = logging.getLogger(__name__)
+
+PRESENCE = getattr(settings, 'CHAT_PRESENCE', {})
+FLUSH_INTERVAL = PRESENCE.get('FLUSH_INTERVAL_S', 30)
+FLUSH_AT_EXIT = PRESENCE.get('FLUSH_AT_EXIT', True)
+HEARTBEAT = PRESENCE.get('HEARTBEAT_S', 10)
+ONLINE_TTL = PRESENCE.get('ONLINE_TTL_S', 3 * HEARTBEAT)
+CACHE = PRESENCE.get('CACHE', 'default')
+ACTIVITY_TIMEOUT = 2 * FLUSH_INTERVAL  # Flushed to the database well before this
+FLUSH_BATCH = 500  # Users per UPDATE statement
+
+_lock = threading.Lock()
+_sessions = {}  # user id -> set of channel names (one per open socket)
+_pending = {}  # user id -> last activity not yet written to the database
+_unpublished = set()  # user ids whose _pending value the cache doesn't have yet
+_counters = {'flushes': 0, 'users_written': 0}
+
+# One flusher task per event loop
+_flushers = weakref.WeakKeyDictionary()
+
+
+def onlineKey(user_id):
+    return f'chat:presence:{user_id}:online'
+
+
+def activityKey(user_id):
+    return f'chat:presence:{user_id}:activity'
+
+
+def connect(user_id, session):
+    """Registers an open socket. session is anything unique to it, e.g. the channel name."""
+    now = timezone.now()
+    with _lock:
+        _sessions.setdefault(user_id, set()).add(session)
+        _pending[user_id] = now
+        _unpublished.discard(user_id)
+
+    cache = caches[CACHE]
+    cache.set(onlineKey(user_id), True, ONLINE_TTL)
+    cache.set(activityKey(user_id), now, ACTIVITY_TIMEOUT)
+    _ensureFlusher()
+
+
+def disconnect(user_id, session):
+    now = timezone.now()
+    with _lock:
+        sessions = _sessions.get(user_id)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del _sessions[user_id]
+        offline = user_id not in _sessions
+        _pending[user_id] = now
+        _unpublished.discard(user_id)
+
+    cache = caches[CACHE]
+    if offline:
+        cache.delete(onlineKey(user_id))
+    cache.set(activityKey(user_id), now, ACTIVITY_TIMEOUT)
+
+
+def touch(user_id):
+    """
+    Records activity (e.g. a sent message) without touching the database or
+    the cache; the next heartbeat publishes it.
+    """
+    with _lock:
+        _pending[user_id] = timezone.now()
+        _unpublished.add(user_id)
+
+
+def heartbeat():
+    """Refreshes the online keys of this process's users and publishes their recent activity."""
+    with _lock:
+        online = list(_sessions)
+        activity = {user_id: _pending[user_id] for user_id in _unpublished if user_id in _pending}
+        _unpublished.clear()
+
+    cache = caches[CACHE]
+    if online:
+        cache.set_many({onlineKey(user_id): True for user_id in online}, ONLINE_TTL)
+    if activity:
+        cache.set_many({activityKey(user_id): seen for user_id, seen in activity.items()}, ACTIVITY_TIMEOUT)
+
+
+heartbeatAsync = sync_to_async(heartbeat, thread_sensitive=False)
+
+
+def isOnline(user_id):
+    return caches[CACHE].get(onlineKey(user_id)) is not None
+
+
+def onlineAmong(user_ids):
+    """The subset of user_ids with at least one open socket on any worker."""
+    keys = {onlineKey(user_id): user_id for user_id in user_ids}
+    return {keys[key] for key in caches[CACHE].get_many(list(keys))}
+
+
+def onlineCount():
+    """Users with an open socket in this process."""
+    with _lock:
+        return len(_sessions)
+
+
+def lastActivity(user):
+    """Most recent activity for a user, including what hasn't been flushed yet."""
+    return latestActivity(user.pk, user.last_activity)
+
+
+def latestActivity(user_id, stored):
+    """The later of stored (the user's last_activity column) and what hasn't been flushed yet."""
+    published = caches[CACHE].get(activityKey(user_id))
+    if published is None or (stored and stored > published):
+        return stored
+    return published
+
+
+def flush():
+    """
+    Writes pending last_activity values in batched UPDATEs, one per
+    FLUSH_BATCH users, instead of a save() per disconnect. Users who are
+    still connected are written as active now.
+    """
+    now = timezone.now()
+    with _lock:
+        for user_id in _sessions:
+            _pending[user_id] = now
+        pending = dict(_pending)
+        _pending.clear()
+
+    if not pending:
+        return 0
+
+    user_ids = list(pending)
+    try:
+        with transaction.atomic():
+            for start in range(0, len(user_ids), FLUSH_BATCH):
+                batch = user_ids[start:start + FLUSH_BATCH]
+                CustomUser.objects.filter(pk__in=batch).update(last_activity=Case(
+                    *[When(pk=user_id, then=Value(pending[user_id])) for user_id in batch],
+                    output_field=DateTimeField()
+                ))
+    except Exception:
+        # Put them back so the next flush retries, keeping anything newer
+        with _lock:
+            for user_id, seen in pending.items():
+                if user_id not in _pending or _pending[user_id] < seen:
+                    _pending[user_id] = seen
+        raise
+
+    with _lock:
+        _counters['flushes'] += 1
+        _counters['users_written'] += len(user_ids)
+    return len(user_ids)
+
+
+flushAsync = database_sync_to_async(flush)
+
+
+def flushOnExit():
+    # The server has stopped its event loop by now, so the ORM can be used directly
+    try:
+        flush()
+    except Exception:
+        logger.exception('Presence flush at exit failed')
+
+
+if FLUSH_AT_EXIT:
+    atexit.register(flushOnExit)
+
+
+async def _runFlusher():
+    flushed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(HEARTBEAT)
+        try:
+            await heartbeatAsync()
+        except Exception:
+            logger.exception('Presence heartbeat failed')
+
+        if time.monotonic() - flushed_at < FLUSH_INTERVAL:
+            continue
+        flushed_at = time.monotonic()
+        try:
+            await flushAsync()
+        except Exception:
+            logger.exception('Presence flush failed')
+
+
+def _ensureFlusher():
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # Not on an event loop; heartbeat() and flush() have to be called explicitly
+
+    flusher = _flushers.get(loop)
+    if flusher is None or flusher.done():
+        _flushers[loop] = loop.create_task(_runFlusher())
+
+
+def stats():
+    """Online and flush counters for this process."""
+    with _lock:
+        counters = dict(_counters)
+        counters['online_users'] = len(_sessions)
+        counters['sessions'] = sum(len(sessions) for sessions in _sessions.values())
+        counters['pending'] = len(_pending)
+    return counters
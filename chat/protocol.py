@@ -0,0 +1,152 @@
+import json
+import zlib
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # Optional; without it only JSON is offered
+    msgpack = None
+
+
+PROTOCOL = getattr(settings, 'CHAT_PROTOCOL', {})
+COMPRESS_MIN_BYTES = PROTOCOL.get('COMPRESS_MIN_BYTES', 1024)  # Smaller frames aren't worth compressing
+COMPRESS_LEVEL = PROTOCOL.get('COMPRESS_LEVEL', 6)
+MAX_DECOMPRESSED_BYTES = 1024 * 1024  # Guards against deflate bombs from clients
+
+MSGPACK_SUBPROTOCOL = 'nexchat.msgpack.v1'
+
+# Binary frames start with one of these, followed by the msgpack payload
+PLAIN = b'\x00'
+DEFLATED = b'\x01'
+
+# Short tags for the keys and event types every frame repeats
+FIELD_TAGS = {
+    'type': 't',
+    'id': 'i',
+    'seq': 's',
+    'sender_id': 'f',
+    'sender_username': 'n',
+    'sender_avatar': 'a',
+    'user_id': 'u',
+    'username': 'un',
+    'message': 'm',
+    'created_at': 'c',
+    'client_id': 'k',
+    'is_typing': 'y',
+    'last_read_id': 'r',
+    'last_seq': 'l',
+    'count': 'x',
+    'recipient_id': 'to',
+    'conversation': 'cv',
+    'rooms': 'rs',
+    'events': 'ev',
+    'attachments': 'at',
+    'attachment_id': 'ai',
+}
+TYPE_TAGS = {
+    'chat': 1,
+    'typing': 2,
+    'ack': 3,
+    'read': 4,
+    'error': 5,
+    'connected': 6,
+    'replayed': 7,
+    'resync': 8,
+    'subscribe': 9,
+    'unsubscribe': 10,
+    'subscribed': 11,
+    'unsubscribed': 12,
+    'batch': 13,
+}
+
+FIELDS_BY_TAG = {tag: field for field, tag in FIELD_TAGS.items()}
+TYPES_BY_TAG = {tag: name for name, tag in TYPE_TAGS.items()}
+
+
+class JsonCodec:
+    """The default: one JSON text frame per event."""
+    subprotocol = None
+
+    def encode(self, payload):
+        return {'text_data': json.dumps(payload)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackCodec:
+    """
+    Binary frames: msgpack with short field tags and numeric event types,
+    deflated when the encoded frame is at least COMPRESS_MIN_BYTES.
+    Unknown keys and types pass through untouched.
+    """
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def __init__(self, compress_min_bytes=COMPRESS_MIN_BYTES, compress_level=COMPRESS_LEVEL):
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+
+    def encode(self, payload):
+        packed = msgpack.packb(self.tag(payload), use_bin_type=True)
+        if self.compress_min_bytes is not None and len(packed) >= self.compress_min_bytes:
+            compressed = zlib.compress(packed, self.compress_level)
+            if len(compressed) < len(packed):
+                return {'bytes_data': DEFLATED + compressed}
+        return {'bytes_data': PLAIN + packed}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # A client on this subprotocol may still send the odd JSON frame
+            return json.loads(text_data)
+
+        marker, packed = bytes_data[:1], bytes_data[1:]
+        if marker == DEFLATED:
+            decompressor = zlib.decompressobj()
+            try:
+                packed = decompressor.decompress(packed, MAX_DECOMPRESSED_BYTES)
+            except zlib.error as error:
+                raise ValueError(f'Bad compressed frame: {error}')
+            if decompressor.unconsumed_tail:
+                raise ValueError('Compressed frame is too large')
+        elif marker != PLAIN:
+            raise ValueError('Unknown frame marker')
+
+        tagged = msgpack.unpackb(packed, raw=False)
+        if not isinstance(tagged, dict):
+            raise ValueError('Frame is not a map')
+
+        return self.untag(tagged)
+
+    def tag(self, payload):
+        tagged = {FIELD_TAGS.get(key, key): value for key, value in payload.items()}
+        if 't' in tagged:
+            tagged['t'] = TYPE_TAGS.get(tagged['t'], tagged['t'])
+        if isinstance(tagged.get('ev'), list):
+            # The events of a batch frame are tagged the same way
+            tagged['ev'] = [self.tag(event) if isinstance(event, dict) else event for event in tagged['ev']]
+        return tagged
+
+    def untag(self, tagged):
+        payload = {FIELDS_BY_TAG.get(key, key): value for key, value in tagged.items()}
+        if 'type' in payload:
+            payload['type'] = TYPES_BY_TAG.get(payload['type'], payload['type'])
+        if isinstance(payload.get('events'), list):
+            payload['events'] = [self.untag(event) if isinstance(event, dict) else event for event in payload['events']]
+        return payload
+
+
+def availableSubprotocols():
+    """The subprotocols this server accepts: msgpack only if the package is installed."""
+    return [MSGPACK_SUBPROTOCOL] if msgpack is not None else []
+
+
+def negotiate(requested):
+    """
+    Picks the codec for the subprotocols a client offered; JSON unless it
+    asked for one in availableSubprotocols(). A JSON socket is accepted
+    without a subprotocol, so clients fall back to sending JSON.
+    """
+    if MSGPACK_SUBPROTOCOL in availableSubprotocols() and MSGPACK_SUBPROTOCOL in (requested or []):
+        return MsgpackCodec()
+    return JsonCodec()
@@ -0,0 +1,124 @@
+from collections import deque
+
+from django.conf import settings
+
+
+REPLAY = getattr(settings, 'CHAT_REPLAY', {})
+BUFFER_SIZE = REPLAY.get('BUFFER_SIZE', 200)  # Recent events kept per conversation
+MAX_REPLAY = REPLAY.get('MAX_REPLAY', 500)  # Past this, the client reloads over HTTP
+
+_buffers = {}  # group name -> ReplayBuffer
+_counters = {'buffer_replays': 0, 'database_replays': 0, 'resyncs': 0}
+
+
+class ReplayBuffer:
+    """
+    The last BUFFER_SIZE chat events of one conversation, in seq order.
+
+    It only exists while this process has a socket in the conversation's
+    group, so it has seen every event since it was created and a run of
+    consecutive seqs in it is complete.
+    """
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.events = deque(maxlen=size)
+        self.subscribers = 0
+
+    def record(self, event):
+        # Publishers in other processes can deliver a lower seq after a higher one
+        index = len(self.events)
+        while index and self.events[index - 1]['seq'] > event['seq']:
+            index -= 1
+
+        # Every socket in the group sees the same event; keep it once
+        if index and self.events[index - 1]['seq'] == event['seq']:
+            return
+
+        if len(self.events) == self.events.maxlen:
+            if index == 0:
+                return  # Older than everything kept
+            self.events.popleft()
+            index -= 1
+        self.events.insert(index, event)
+
+    def since(self, last_seq):
+        """Events after last_seq, or None if the buffer doesn't reach back that far."""
+        if not self.events or self.events[0]['seq'] > last_seq + 1:
+            return None
+
+        events = [event for event in self.events if event['seq'] > last_seq]
+        expected = last_seq + 1
+        for event in events:
+            if event['seq'] != expected:
+                return None  # A gap; only the database has the full history
+            expected += 1
+        return events
+
+
+class SeqTracker:
+    """
+    The seqs of one conversation a socket has been sent.
+
+    SendMessageView, the write-behind flush and other workers publish on
+    their own, so a lower seq can arrive after a higher one. Only exact
+    repeats are dropped, such as an event that is both replayed and
+    delivered live, or that comes through two groups. A skipped seq is
+    remembered until it arrives, for as long as it is within BUFFER_SIZE
+    of the newest one.
+    """
+
+    def __init__(self, last_seq=0):
+        self.last_seq = last_seq  # Highest seq sent
+        self.missing = set()  # Lower seqs not sent yet
+
+    def accept(self, seq):
+        """True if seq hasn't been sent on this socket; it counts as sent from now on."""
+        if seq > self.last_seq:
+            # Nothing to wait for before the first event of a socket that didn't say where it was
+            if self.last_seq:
+                self.missing.update(range(max(self.last_seq + 1, seq - BUFFER_SIZE), seq))
+            self.last_seq = seq
+            self.missing = {missing for missing in self.missing if missing > seq - BUFFER_SIZE}
+            return True
+
+        if seq in self.missing:
+            self.missing.discard(seq)
+            return True
+        return False
+
+
+def subscribe(group):
+    buffer = _buffers.get(group)
+    if buffer is None:
+        buffer = _buffers[group] = ReplayBuffer()
+    buffer.subscribers += 1
+    return buffer
+
+
+def unsubscribe(group):
+    buffer = _buffers.get(group)
+    if buffer is None:
+        return
+
+    buffer.subscribers -= 1
+    if buffer.subscribers <= 0:
+        # Nobody here to see new events, so it can't stay complete
+        del _buffers[group]
+
+
+def record(group, event):
+    buffer = _buffers.get(group)
+    if buffer is not None:
+        buffer.record(event)
+
+
+def count(name):
+    _counters[name] += 1
+
+
+def stats():
+    """Replay counters for this process."""
+    counters = dict(_counters)
+    counters['buffers'] = len(_buffers)
+    counters['buffered_events'] = sum(len(buffer.events) for buffer in _buffers.values())
+    return counters
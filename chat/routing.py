@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     path('ws/socket-server/<int:to_user>', consumers.ChatConsumer.as_asgi()),
+    path('ws/room/<int:room_id>', consumers.RoomConsumer.as_asgi()),
+    path('ws/user/', consumers.UserConsumer.as_asgi()),
 ]
\ No newline at end of file
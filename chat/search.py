@@ -0,0 +1,258 @@
+import re
+from datetime import timezone as dt_timezone
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils import timezone
+from django.utils.html import escape
+from django.utils.dateparse import parse_datetime
+
+from .models import Messages, RoomMessagesModel
+
+
+PAGE_SIZE = 20
+SNIPPET_TOKENS = 12
+
+# FTS5 indexes kept in sync with their content tables by triggers; migration
+# 0009 creates them with its own copy of the SQL below, as it was then
+MESSAGES_FTS = 'chat_messages_fts'
+ROOM_MESSAGES_FTS = 'chat_roommessagesmodel_fts'
+SEARCH_MIGRATION = ('chat', '0009_message_search_index')
+
+# Everything installSearchIndex creates; search needs all of it
+SEARCH_OBJECTS = [
+    name
+    for fts_table in (MESSAGES_FTS, ROOM_MESSAGES_FTS)
+    for name in (fts_table, f'{fts_table}_ai', f'{fts_table}_ad', f'{fts_table}_au')
+]
+
+# Unprintable markers, swapped for <mark> after the snippet has been escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+_fts5_available = None
+
+
+def createFtsSql(fts_table, content_table, column):
+    """
+    Statements that create an external-content FTS5 index over
+    content_table.column and the triggers that keep it in sync.
+    """
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+        f"{column}, content='{content_table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {content_table} BEGIN "
+        f"INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END",
+
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {content_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+
+        # Only body edits touch the index, not read or visibility flag updates
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {content_table} BEGIN "
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END",
+
+        f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')",
+    ]
+
+
+def installSearchIndex(schema_editor):
+    """
+    Creates (or re-creates) the FTS5 indexes and their triggers.
+    SQLite drops triggers when a migration remakes a table, so
+    ensureSearchIndex calls this again after migrate.
+    """
+    # FTS5 is SQLite only; other databases use the icontains fallback
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    statements = (
+        createFtsSql(MESSAGES_FTS, 'chat_messages', 'body') +
+        createFtsSql(ROOM_MESSAGES_FTS, 'chat_roommessagesmodel', 'message')
+    )
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def searchIndexComplete(db_connection):
+    """Whether both FTS5 tables and all six triggers exist."""
+    with db_connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type IN ('table', 'trigger') AND name IN (%s)"
+            % ', '.join(['%s'] * len(SEARCH_OBJECTS)),
+            SEARCH_OBJECTS
+        )
+        return cursor.fetchone()[0] == len(SEARCH_OBJECTS)
+
+
+def ensureSearchIndex(using=DEFAULT_DB_ALIAS):
+    """
+    Re-creates the index after a migrate that dropped part of it. On SQLite,
+    migrations of other apps remake chat_messages and chat_roommessagesmodel
+    whenever they alter a table those reference (the user model, say), and
+    remaking a table drops its triggers. Returns True if it had to.
+    """
+    global _fts5_available
+    db_connection = connections[using]
+    if db_connection.vendor != 'sqlite':
+        return False
+
+    # Not when chat has been migrated back to before the index
+    if SEARCH_MIGRATION not in MigrationRecorder(db_connection).applied_migrations():
+        return False
+
+    _fts5_available = None
+    if searchIndexComplete(db_connection):
+        return False
+
+    with db_connection.schema_editor() as schema_editor:
+        installSearchIndex(schema_editor)
+    return True
+
+
+def ftsAvailable():
+    """
+    True when the database is SQLite and the FTS5 tables and their triggers
+    exist. Without the triggers new messages aren't indexed, so search falls
+    back to icontains rather than miss them.
+    """
+    global _fts5_available
+    if connection.vendor != 'sqlite':
+        return False
+
+    if _fts5_available is None:
+        _fts5_available = searchIndexComplete(connection)
+    return _fts5_available
+
+
+def buildMatchQuery(text):
+    """
+    Turns free text into a safe FTS5 query: every word is quoted so user input
+    can't use FTS5 operators, and the last word matches as a prefix.
+    """
+    words = re.findall(r'\w+', text, flags=re.UNICODE)
+    if not words:
+        return ''
+
+    terms = ['"{}"'.format(word.replace('"', '""')) for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    """Escape a snippet and turn the FTS5 markers into <mark> tags."""
+    return escape(snippet).replace(
+        HIGHLIGHT_START, '<mark>'
+    ).replace(
+        HIGHLIGHT_END, '</mark>'
+    )
+
+
+def searchMessages(user, text, page=1, page_size=PAGE_SIZE):
+    """
+    Ranked search over the direct and group messages the user can see.
+    Returns a page of results, best match first.
+    """
+    page = max(1, page)
+    offset = (page - 1) * page_size
+
+    if ftsAvailable():
+        results = _searchFts(user, text, page_size + 1, offset)
+    else:
+        results = _searchContains(user, text, page_size + 1, offset)
+
+    return {
+        'results': results[:page_size],
+        'page': page,
+        'has_next': len(results) > page_size,
+    }
+
+
+def _searchFts(user, text, limit, offset):
+    match = buildMatchQuery(text)
+    if not match:
+        return []
+
+    snippet_args = f"'{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', {SNIPPET_TOKENS}"
+
+    sql = f"""
+        SELECT 'direct', m.id, m.sender_id, m.recipient_id, NULL, m.created_at,
+               snippet({MESSAGES_FTS}, 0, {snippet_args}), bm25({MESSAGES_FTS}) AS rank
+        FROM {MESSAGES_FTS}
+        JOIN chat_messages m ON m.id = {MESSAGES_FTS}.rowid
+        WHERE {MESSAGES_FTS} MATCH %s
+          AND ((m.sender_id = %s AND NOT m.sender_deleted)
+            OR (m.recipient_id = %s AND NOT m.recipient_deleted))
+
+        UNION ALL
+
+        SELECT 'group', rm.id, rm.sender_id, NULL, rm.room_id, rm.timestamp,
+               snippet({ROOM_MESSAGES_FTS}, 0, {snippet_args}), bm25({ROOM_MESSAGES_FTS}) AS rank
+        FROM {ROOM_MESSAGES_FTS}
+        JOIN chat_roommessagesmodel rm ON rm.id = {ROOM_MESSAGES_FTS}.rowid
+        WHERE {ROOM_MESSAGES_FTS} MATCH %s
+          AND rm.room_id IN (
+            SELECT roommodel_id FROM chat_roommodel_participants WHERE customuser_id = %s
+          )
+
+        ORDER BY rank, 6 DESC
+        LIMIT %s OFFSET %s
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match, user.pk, user.pk, match, user.pk, limit, offset])
+        rows = cursor.fetchall()
+
+    results = []
+    for kind, pk, sender_id, recipient_id, room_id, created_at, snippet, rank in rows:
+        # Raw queries skip the model field converters; SQLite stores naive UTC
+        if isinstance(created_at, str):
+            created_at = parse_datetime(created_at)
+        if created_at is not None and timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at, dt_timezone.utc)
+
+        results.append({
+            'kind': kind,
+            'id': pk,
+            'sender_id': sender_id,
+            'recipient_id': recipient_id,
+            'room_id': room_id,
+            'created_at': created_at,
+            'snippet': highlight(snippet),
+            'rank': rank,
+        })
+    return results
+
+
+def _searchContains(user, text, limit, offset):
+    """Fallback for databases without FTS5: unranked, newest first."""
+    text = text.strip()
+    if not text:
+        return []
+
+    direct = Messages.objects.filter(
+        Messages.visibleTo(user), body__icontains=text
+    ).order_by('-created_at').values_list('id', 'sender_id', 'recipient_id', 'created_at', 'body')
+
+    group = RoomMessagesModel.objects.filter(
+        room__participants=user, message__icontains=text
+    ).order_by('-timestamp').values_list('id', 'sender_id', 'room_id', 'timestamp', 'message')
+
+    results = [
+        {
+            'kind': 'direct', 'id': pk, 'sender_id': sender_id, 'recipient_id': recipient_id,
+            'room_id': None, 'created_at': created_at, 'snippet': escape(body), 'rank': None,
+        }
+        for pk, sender_id, recipient_id, created_at, body in direct[:offset + limit]
+    ] + [
+        {
+            'kind': 'group', 'id': pk, 'sender_id': sender_id, 'recipient_id': None,
+            'room_id': room_id, 'created_at': created_at, 'snippet': escape(body), 'rank': None,
+        }
+        for pk, sender_id, room_id, created_at, body in group[:offset + limit]
+    ]
+
+    results.sort(key=lambda result: result['created_at'], reverse=True)
+    return results[offset:offset + limit]
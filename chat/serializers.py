@@ -1,20 +1,37 @@
 from rest_framework import serializers
 
-from .models import Messages
+from .models import Attachment, Messages, RoomMessagesModel
 from userauths.models import CustomUser
 
 class CustomUserSerializer(serializers.ModelSerializer):
+    # The resized variant, for the 40px avatars the pages draw at 2x
+    avatar = serializers.SerializerMethodField()
+
     class Meta:
         model = CustomUser
-        fields = ['id', 'username', 'email']
+        fields = ['id', 'username', 'email', 'avatar']
+
+    def get_avatar(self, user):
+        return user.avatarUrl(80)
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Attachment
+        fields = ['id', 'name', 'size', 'content_type', 'url']
+
+    def get_url(self, attachment):
+        return attachment.asEvent()['url']
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = CustomUserSerializer()
     recipient = CustomUserSerializer()
+    attachments = AttachmentSerializer(many=True, read_only=True)
 
     class Meta:
         model = Messages
-        fields = ['id', 'body', 'created_at', 'is_read', 'sender', 'recipient']
+        fields = ['id', 'body', 'created_at', 'is_read', 'sender', 'recipient', 'attachments']
 
 class ConversationSerializer(serializers.Serializer):
     partner = CustomUserSerializer()
@@ -22,3 +39,11 @@ class ConversationSerializer(serializers.Serializer):
     last_message_body = serializers.CharField()
     unread_count = serializers.IntegerField()
     is_sent_last = serializers.BooleanField()
+
+class RoomMessageSerializer(serializers.ModelSerializer):
+    sender = CustomUserSerializer()
+    attachments = AttachmentSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = RoomMessagesModel
+        fields = ['id', 'message', 'timestamp', 'sender', 'attachments']
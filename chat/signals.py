@@ -0,0 +1,138 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete, m2m_changed, post_migrate
+
+from userauths import avatars
+
+from . import attachments, inbox, membership, search
+from .models import Attachment, ConversationSummary, CustomUser, RoomModel, RoomMessagesModel
+
+
+def notifyMembershipChanged(room_ids, user_ids=()):
+    """
+    Asks open sockets to re-check membership once the change commits: those
+    in the rooms' groups, and the multiplexed sockets of user_ids (people
+    who were just added and aren't in the room groups yet).
+    """
+    from .consumers import getRoomGroupName, getUserGroupName
+
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+
+        for room_id in room_ids:
+            event = {'type': 'membership_changed', 'room_id': room_id}
+            groups = [getUserGroupName(user_id) for user_id in user_ids] or [getRoomGroupName(room_id)]
+            for group in groups:
+                async_to_sync(channel_layer.group_send)(group, event)
+
+    transaction.on_commit(send)
+
+
+@receiver(post_save, sender=RoomMessagesModel)
+def roomMessageSaved(sender, instance, created, **kwargs):
+    if created:
+        RoomModel.recordMessage(instance)
+
+
+@receiver(post_delete, sender=RoomMessagesModel)
+def roomMessageDeleted(sender, instance, origin=None, **kwargs):
+    # The whole room is going away, nothing to keep in sync
+    if isinstance(origin, RoomModel):
+        return
+
+    # on_delete=SET_NULL has already cleared the pointer if it was this message
+    if RoomModel.objects.filter(pk=instance.room_id, last_message__isnull=True).exists():
+        RoomModel.refreshLastMessage(instance.room_id)
+    else:
+        RoomModel.touch([instance.room_id])
+
+
+@receiver(m2m_changed, sender=RoomModel.participants.through)
+def roomParticipantsChanged(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # user.room_participants.clear() doesn't say which rooms it left
+        instance._cleared_room_ids = list(instance.room_participants.values_list('pk', flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        # room.participants.add(...) etc.
+        room_ids = [instance.pk]
+    else:
+        # user.room_participants.add(...) etc.
+        room_ids = pk_set if action != 'post_clear' else instance.__dict__.pop('_cleared_room_ids', [])
+
+    if room_ids:
+        RoomModel.refreshParticipantCount(room_ids)
+        membership.invalidate(room_ids)
+
+        # Removals are checked by the sockets in the room; additions by the new members' sockets
+        if action != 'post_add':
+            notifyMembershipChanged(list(room_ids))
+        elif not reverse:
+            notifyMembershipChanged([instance.pk], user_ids=list(pk_set))
+        else:
+            notifyMembershipChanged(list(pk_set), user_ids=[instance.pk])
+
+
+@receiver(post_save, sender=RoomModel)
+def roomChanged(sender, instance, **kwargs):
+    # The cached entry holds the room name and doubles as an existence check
+    membership.invalidate([instance.pk])
+
+
+@receiver(post_delete, sender=RoomModel)
+def roomDeleted(sender, instance, **kwargs):
+    membership.invalidate([instance.pk])
+    notifyMembershipChanged([instance.pk])
+
+
+@receiver(post_delete, sender=Attachment)
+def attachmentDeleted(sender, instance, **kwargs):
+    # Also when its message or conversation is deleted; no other row names the file
+    path = instance.path
+    transaction.on_commit(lambda: attachments.deleteFile(path))
+
+
+def userShownChanged(user_id):
+    """Drops cached lists and page validators that show the user's name or avatar."""
+    summaries = ConversationSummary.objects.filter(partner_id=user_id)
+    inbox.invalidate(summaries.values_list('user_id', flat=True))
+
+    # Pages that show the user have changed too (see chat.conditional)
+    summaries.update(updated_at=timezone.now())
+    RoomModel.touch(RoomModel.objects.filter(participants=user_id).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=CustomUser)
+def userChanged(sender, instance, update_fields=None, **kwargs):
+    # Cached conversation lists hold the partner's name and avatar; last_login etc. don't show
+    if update_fields is not None and not {'username', 'avatar'} & set(update_fields):
+        return
+
+    userShownChanged(instance.pk)
+
+
+@receiver(avatars.variantsRecorded, sender=CustomUser)
+def userVariantsRecorded(sender, pk, **kwargs):
+    # Lists cached before this still point at the original avatar
+    userShownChanged(pk)
+
+
+@receiver(avatars.variantsRecorded, sender=RoomModel)
+def roomVariantsRecorded(sender, pk, **kwargs):
+    RoomModel.touch([pk])
+
+
+@receiver(post_migrate)
+def migrated(sender, using, **kwargs):
+    # Sent once per app after all migrations ran; chat's copy is enough
+    if sender.label == 'chat':
+        search.ensureSearchIndex(using)
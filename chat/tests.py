@@ -1,3 +1,1680 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.messages import get_messages
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from . import attachments, batching, checks, inbox, loadtest, membership, outbound, presence, protocol, replay, search, typingstatus
+from .models import ConversationSummary, Messages, ReadWatermark, RoomModel, RoomMessagesModel, RoomReadWatermark
+from .layers import ChannelBroker
+from .consumers import directMessageEvent, getPrivateGroupName, getRoomGroupName, publishDirectMessage
+from .routing import websocket_urlpatterns
+from userauths import avatars
+from userauths.models import CustomUser
+
+
+def createUser(username):
+    return CustomUser.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        password='password'
+    )
+
+
+class ConversationReadReceiptTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+
+    def sendMany(self, count):
+        for index in range(count):
+            Messages.sendMessage(self.alice, self.bob, f'message {index}')
+            Messages.sendMessage(self.bob, self.alice, f'reply {index}')
+
+    def countConversationQueries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('conversation', args=[self.bob.pk]))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_is_constant_for_thread_length(self):
+        self.client.force_login(self.alice)
+
+        self.sendMany(2)
+        short_thread = self.countConversationQueries()
+
+        self.sendMany(50)
+        long_thread = self.countConversationQueries()
+
+        self.assertEqual(short_thread, long_thread)
+
+    def test_receipts_for_repeated_text(self):
+        first = Messages.sendMessage(self.alice, self.bob, 'same text')
+        second = Messages.sendMessage(self.alice, self.bob, 'same text')
+        first.mark_as_read()
+
+        conversation = Messages.getConversation(self.alice, self.bob.pk)
+        receipts = {
+            message.pk: message.recipient_has_read
+            for message in conversation['messages']
+        }
+
+        self.assertEqual(receipts, {first.pk: True, second.pk: False})
+
+
+
+def createRoom(name, *members):
+    room = RoomModel.objects.create(name=name, admin=members[0])
+    room.participants.add(*members)
+    return room
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def page(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def walkBack(self, url):
+        """Ids of every message, oldest first, fetched two at a time from the latest page back."""
+        page = self.page(url, limit=2)
+        ids = [message['id'] for message in page['messages']]
+        while page['has_older']:
+            page = self.page(url, limit=2, before=page['older'])
+            ids = [message['id'] for message in page['messages']] + ids
+        return ids
+
+    def test_direct_history_with_equal_timestamps(self):
+        sent = [Messages.sendMessage(self.alice, self.bob, f'message {index}').pk for index in range(5)]
+        # Ties on created_at are broken by id, so no message is skipped or repeated
+        Messages.objects.update(created_at=Messages.objects.get(pk=sent[0]).created_at)
+
+        self.assertEqual(self.walkBack(reverse('conversation-messages', args=[self.bob.pk])), sent)
+
+    def test_group_history(self):
+        sent = [
+            RoomMessagesModel.objects.create(room=self.room, sender=self.bob, message=f'message {index}').pk
+            for index in range(5)
+        ]
+        self.assertEqual(self.walkBack(reverse('group-messages', args=[self.room.pk])), sent)
+
+    def test_newer_cursor_returns_only_new_messages(self):
+        url = reverse('conversation-messages', args=[self.bob.pk])
+        Messages.sendMessage(self.alice, self.bob, 'first')
+        latest = self.page(url)
+        self.assertFalse(latest['has_newer'])
+
+        self.assertEqual(self.page(url, after=latest['newer'])['messages'], [])
+        reply = Messages.sendMessage(self.bob, self.alice, 'reply')
+
+        newer = self.page(url, after=latest['newer'])
+        self.assertEqual([message['id'] for message in newer['messages']], [reply.pk])
+
+    def test_bad_cursor_and_limit(self):
+        url = reverse('conversation-messages', args=[self.bob.pk])
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 400)
+
+        for index in range(3):
+            Messages.sendMessage(self.alice, self.bob, f'message {index}')
+        self.assertEqual(len(self.page(url, limit='lots')['messages']), 3)
+        self.assertEqual(len(self.page(url, limit=0)['messages']), 1)
+
+    def test_group_history_needs_membership(self):
+        self.client.force_login(createUser('carol'))
+        response = self.client.get(reverse('group-messages', args=[self.room.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+
+    def summaryUnread(self):
+        return ConversationSummary.objects.get(user=self.alice, partner=self.bob).unread_count
+
+    def test_unread_counts_follow_the_watermark(self):
+        sent = [Messages.sendMessage(self.bob, self.alice, f'message {index}') for index in range(3)]
+        Messages.sendMessage(self.alice, self.bob, 'mine')
+        self.assertEqual(Messages.unreadCount(self.alice, self.bob), 3)
+        self.assertEqual(self.summaryUnread(), 3)
+
+        # Reading one message reads everything before it too
+        Messages.objects.get(pk=sent[1].pk).mark_as_read()
+        self.assertEqual(Messages.unreadCount(self.alice, self.bob), 1)
+        self.assertEqual(self.summaryUnread(), 1)
+        reloaded = ReadWatermark.annotate(list(Messages.objects.filter(pk__in=[message.pk for message in sent]).order_by('pk')))
+        self.assertEqual([message.is_read for message in reloaded], [True, True, False])
+
+        # Unannotated, it would take a query per message
+        with self.assertRaises(RuntimeError):
+            Messages.objects.get(pk=sent[0].pk).is_read
+
+        Messages.markConversationRead(self.alice, self.bob)
+        self.assertEqual(self.summaryUnread(), 0)
+
+        Messages.sendMessage(self.bob, self.alice, 'later')
+        self.assertEqual(Messages.unreadCount(self.alice, self.bob), 1)
+        self.assertEqual(self.summaryUnread(), 1)
+
+    def test_watermark_never_moves_back(self):
+        sent = [Messages.sendMessage(self.bob, self.alice, f'message {index}') for index in range(2)]
+        Messages.markConversationRead(self.alice, self.bob)
+        Messages.markConversationRead(self.alice, self.bob, up_to_id=sent[0].pk)
+
+        self.assertEqual(ReadWatermark.lastReadId(self.alice, self.bob), sent[1].pk)
+        self.assertEqual(Messages.unreadCount(self.alice, self.bob), 0)
+
+    def test_deleted_messages_are_not_unread(self):
+        message = Messages.sendMessage(self.bob, self.alice, 'oops')
+        Messages.objects.filter(pk=message.pk).update(recipient_deleted=True)
+        self.assertEqual(Messages.unreadCount(self.alice, self.bob), 0)
+
+    def test_room_unread_counts(self):
+        room = createRoom('planning', self.alice, self.bob)
+        sent = [RoomMessagesModel.objects.create(room=room, sender=self.bob, message=f'{index}') for index in range(3)]
+
+        def unread():
+            return RoomReadWatermark.annotateUnreadCount(RoomModel.objects.filter(pk=room.pk), self.alice).get().unread_count
+
+        self.assertEqual(unread(), 3)
+        self.assertTrue(RoomReadWatermark.markRead(self.alice, room, sent[1].pk))
+        self.assertEqual(unread(), 1)
+        self.assertFalse(RoomReadWatermark.markRead(self.alice, room, sent[0].pk))
+        self.assertEqual(unread(), 1)
+
+
+class DeleteViewTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.carol = createUser('carol')
+        self.hello = Messages.sendMessage(self.alice, self.bob, 'hello')
+        self.reply = Messages.sendMessage(self.bob, self.alice, 'hi')
+
+    def get(self, user, name, arg):
+        self.client.force_login(user)
+        response = self.client.get(reverse(name, args=[arg]), HTTP_REFERER='/chat/')
+        self.assertRedirects(response, '/chat/', fetch_redirect_response=False)
+        return [str(message) for message in get_messages(response.wsgi_request)]
+
+    def flags(self, message):
+        return tuple(Messages.objects.filter(pk=message.pk).values_list('sender_deleted', 'recipient_deleted').first() or ())
+
+    def test_deleting_a_message_hides_it_from_one_side(self):
+        self.assertEqual(self.get(self.bob, 'delete-message', self.hello.pk), ['Message deleted.'])
+        self.assertEqual(self.flags(self.hello), (False, True))
+        self.assertEqual(ConversationSummary.objects.get(user=self.bob, partner=self.alice).last_message_id, self.reply.pk)
+
+    def test_message_deleted_by_both_sides_is_removed(self):
+        self.get(self.bob, 'delete-message', self.hello.pk)
+        self.get(self.alice, 'delete-message', self.hello.pk)
+        self.assertFalse(Messages.objects.filter(pk=self.hello.pk).exists())
+
+    def test_non_participant_cannot_delete_a_message(self):
+        self.assertEqual(self.get(self.carol, 'delete-message', self.hello.pk), ['Message not found'])
+        self.assertEqual(self.flags(self.hello), (False, False))
+
+        with self.assertRaises(ValidationError):
+            self.hello.deleteFor(self.carol)
+
+    def test_deleting_a_conversation_hides_it_from_one_side(self):
+        self.assertEqual(self.get(self.alice, 'delete-conversation', self.bob.pk), ['Deleted 2 messages'])
+        self.assertEqual(self.flags(self.hello), (True, False))
+        self.assertEqual(self.flags(self.reply), (False, True))
+        self.assertFalse(ConversationSummary.objects.filter(user=self.alice, partner=self.bob).exists())
+        self.assertTrue(ConversationSummary.objects.filter(user=self.bob, partner=self.alice).exists())
+
+    def test_conversation_deleted_by_both_sides_is_removed(self):
+        self.get(self.alice, 'delete-conversation', self.bob.pk)
+        self.get(self.bob, 'delete-conversation', self.alice.pk)
+        self.assertFalse(Messages.objects.exists())
+
+    def test_non_participant_deletes_nothing_of_others(self):
+        self.assertEqual(self.get(self.carol, 'delete-conversation', self.bob.pk), ['Deleted 0 messages'])
+        self.assertEqual(self.flags(self.hello), (False, False))
+        self.assertEqual(self.flags(self.reply), (False, False))
+
+
+class RebuildSummariesCommandTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        Messages.sendMessage(self.alice, self.bob, 'hello')
+        self.last = Messages.sendMessage(self.alice, self.bob, 'are you there?')
+        self.fields = ('last_message_id', 'last_message_preview', 'is_sent_last', 'unread_count')
+
+    def summary(self, user, partner):
+        return ConversationSummary.objects.filter(user=user, partner=partner).values(*self.fields).first()
+
+    def test_corrupted_summaries_are_restored(self):
+        self.assertEqual(self.summary(self.bob, self.alice), {
+            'last_message_id': self.last.pk,
+            'last_message_preview': 'are you there?',
+            'is_sent_last': False,
+            'unread_count': 2,
+        })
+        expected = {pair: self.summary(*pair) for pair in [(self.alice, self.bob), (self.bob, self.alice)]}
+
+        ConversationSummary.objects.filter(user=self.bob).update(last_message=None, last_message_preview='', unread_count=7)
+        ConversationSummary.objects.filter(user=self.alice).delete()
+
+        output = io.StringIO()
+        call_command('rebuild_conversation_summaries', stdout=output)
+        self.assertIn('Rebuilt 2 conversation summaries', output.getvalue())
+        self.assertEqual({pair: self.summary(*pair) for pair in expected}, expected)
+
+    def test_one_user_only(self):
+        ConversationSummary.objects.update(unread_count=7)
+
+        call_command('rebuild_conversation_summaries', user=self.bob.pk, stdout=io.StringIO())
+        self.assertEqual(self.summary(self.bob, self.alice)['unread_count'], 2)
+        self.assertEqual(self.summary(self.alice, self.bob)['unread_count'], 7)
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Runs each test with chat migrated back to migrate_from; migrate() moves it to migrate_to."""
+    migrate_from = migrate_to = None
+
+    def setUp(self):
+        self.addCleanup(self.migrateTo, None)
+        self.apps = self.migrateTo(self.migrate_from)
+
+    def migrateTo(self, name):
+        executor = MigrationExecutor(connection)
+        targets = [('chat', name)] if name else executor.loader.graph.leaf_nodes()
+        executor.migrate(targets)
+        if name is None:
+            # What the post_migrate handler does after manage.py migrate
+            search.ensureSearchIndex()
+        return executor.loader.project_state(targets).apps
+
+    def migrate(self):
+        return self.migrateTo(self.migrate_to)
+
+
+class SingleRowMigrationTests(MigrationTestCase):
+    migrate_from = '0004_rename_messagesmodel_messages_and_more'
+    migrate_to = '0005_single_row_messages'
+
+    def setUp(self):
+        # Saving a user touches their conversation summaries, which 0004 doesn't have
+        self.alice, self.bob = createUser('alice'), createUser('bob')
+        super().setUp()
+
+    def test_copies_become_one_row(self):
+        OldMessages = self.apps.get_model('chat', 'Messages')
+        alice, bob = self.alice, self.bob
+        start = timezone.now()
+
+        def copy(owner, sender, recipient, body, seconds, is_read=False):
+            message = OldMessages.objects.create(
+                user_id=owner.pk, sender_id=sender.pk, recipient_id=recipient.pk, body=body, is_read=is_read
+            )
+            OldMessages.objects.filter(pk=message.pk).update(created_at=start + timedelta(seconds=seconds))
+            return message
+
+        # Both copies: one row, with the recipient's read state
+        paired = copy(alice, alice, bob, 'hello', 0)
+        copy(bob, alice, bob, 'hello', 1, is_read=True)
+        # One side deleted their copy before the migration
+        kept_by_sender = copy(alice, alice, bob, 'secret', 10)
+        kept_by_recipient = copy(bob, alice, bob, 'oops', 20)
+        # Orphans: the same text again, but the copies are too far apart to be one message
+        sender_orphan = copy(bob, bob, alice, 'ok', 30)
+        recipient_orphan = copy(alice, bob, alice, 'ok', 90)
+        # A note to self has two copies with the same owner
+        note = copy(alice, alice, alice, 'note', 40)
+        copy(alice, alice, alice, 'note', 40)
+
+        rows = self.migrate().get_model('chat', 'Messages').objects.values_list(
+            'pk', 'is_read', 'sender_deleted', 'recipient_deleted'
+        )
+        self.assertEqual({pk: flags for pk, *flags in rows}, {
+            paired.pk: [True, False, False],
+            kept_by_sender.pk: [False, False, True],
+            kept_by_recipient.pk: [False, True, False],
+            sender_orphan.pk: [False, False, True],
+            recipient_orphan.pk: [False, True, False],
+            note.pk: [False, False, False],
+        })
+
+
+class ConversationSummaryMigrationTests(MigrationTestCase):
+    migrate_from = '0005_single_row_messages'
+    migrate_to = '0006_conversationsummary'
+
+    def setUp(self):
+        # Saving a user touches their conversation summaries, which 0005 doesn't have
+        self.alice, self.bob, self.carol = createUser('alice'), createUser('bob'), createUser('carol')
+        super().setUp()
+
+    def test_summaries_are_backfilled(self):
+        OldMessages = self.apps.get_model('chat', 'Messages')
+        alice, bob, carol = self.alice, self.bob, self.carol
+        start = timezone.now()
+
+        def send(sender, recipient, body, seconds, is_read=False, **deleted):
+            message = OldMessages.objects.create(
+                sender_id=sender.pk, recipient_id=recipient.pk, body=body, is_read=is_read, **deleted
+            )
+            OldMessages.objects.filter(pk=message.pk).update(created_at=start + timedelta(seconds=seconds))
+            return message
+
+        send(bob, alice, 'one', 0)
+        send(bob, alice, 'two', 1, is_read=True)
+        last = send(alice, bob, 'three', 2)
+        # alice deleted it, so only carol has the conversation
+        hidden = send(carol, alice, 'psst', 3, recipient_deleted=True)
+
+        summaries = self.migrate().get_model('chat', 'ConversationSummary').objects.values_list(
+            'user_id', 'partner_id', 'last_message_id', 'last_message_preview', 'is_sent_last', 'unread_count'
+        )
+        self.assertEqual(
+            {(user_id, partner_id): rest for user_id, partner_id, *rest in summaries},
+            {
+                (alice.pk, bob.pk): [last.pk, 'three', True, 1],
+                (bob.pk, alice.pk): [last.pk, 'three', False, 1],
+                (carol.pk, alice.pk): [hidden.pk, 'psst', True, 0],
+            }
+        )
+
+
+class ReadWatermarkMigrationTests(MigrationTestCase):
+    migrate_from = '0007_cursor_pagination_indexes'
+    migrate_to = '0008_read_watermarks'
+
+    def test_read_flags_become_watermarks(self):
+        OldMessages = self.apps.get_model('chat', 'Messages')
+        alice, bob = createUser('alice'), createUser('bob')
+
+        def send(sender, recipient, is_read):
+            return OldMessages.objects.create(sender_id=sender.pk, recipient_id=recipient.pk, body='hi', is_read=is_read)
+
+        read = send(bob, alice, True)
+        send(bob, alice, False)
+        # Read after an unread one: the watermark stops before the unread message
+        send(bob, alice, True)
+        answered = send(alice, bob, True)
+
+        apps = self.migrate()
+        watermarks = {
+            (watermark.user_id, watermark.partner_id): watermark.last_read_id
+            for watermark in apps.get_model('chat', 'ReadWatermark').objects.all()
+        }
+        self.assertEqual(watermarks, {(alice.pk, bob.pk): read.pk, (bob.pk, alice.pk): answered.pk})
+
+
+class RoomPointerTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    def send(self, text, room=None):
+        return RoomMessagesModel.objects.create(room=room or self.room, sender=self.bob, message=text)
+
+    def lastMessageId(self):
+        return RoomModel.objects.values_list('last_message_id', flat=True).get(pk=self.room.pk)
+
+    def test_last_message_follows_sends_and_deletes(self):
+        first, second = self.send('first'), self.send('second')
+        self.assertEqual(self.lastMessageId(), second.pk)
+
+        first.delete()
+        self.assertEqual(self.lastMessageId(), second.pk)
+
+        third = self.send('third')
+        third.delete()
+        self.assertEqual(self.lastMessageId(), second.pk)
+
+        second.delete()
+        room = RoomModel.objects.get(pk=self.room.pk)
+        self.assertIsNone(room.last_message_id)
+        self.assertIsNone(room.last_message_at)
+
+    def test_participant_count_follows_membership(self):
+        carol = createUser('carol')
+
+        def count():
+            return RoomModel.objects.values_list('participant_count', flat=True).get(pk=self.room.pk)
+
+        self.assertEqual(count(), 2)
+        self.room.participants.add(carol)
+        self.assertEqual(count(), 3)
+        self.room.participants.remove(self.bob)
+        self.assertEqual(count(), 2)
+        carol.room_participants.clear()
+        self.assertEqual(count(), 1)
+
+    def test_group_list_is_ordered_by_last_message(self):
+        quiet = createRoom('quiet', self.alice, self.bob)
+        busy = createRoom('busy', self.alice, self.bob)
+        self.send('old news', room=busy)
+        self.send('news', room=self.room)
+
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('groups'))
+
+        groups = list(response.context['groups'])
+        self.assertEqual([group.pk for group in groups], [self.room.pk, busy.pk, quiet.pk])
+        self.assertEqual(groups[0].last_message.message, 'news')
+
+
+class RoomPointerMigrationTests(MigrationTestCase):
+    migrate_from = '0009_message_search_index'
+    migrate_to = '0010_room_last_message'
+
+    def test_pointers_are_backfilled(self):
+        OldRooms = self.apps.get_model('chat', 'RoomModel')
+        OldRoomMessages = self.apps.get_model('chat', 'RoomMessagesModel')
+        alice, bob = createUser('alice'), createUser('bob')
+
+        room = OldRooms.objects.create(name='planning', admin_id=alice.pk)
+        room.participants.add(alice.pk, bob.pk)
+        OldRoomMessages.objects.create(room=room, sender_id=bob.pk, message='first')
+        last = OldRoomMessages.objects.create(room=room, sender_id=alice.pk, message='last')
+        empty = OldRooms.objects.create(name='empty', admin_id=alice.pk)
+
+        rooms = self.migrate().get_model('chat', 'RoomModel').objects
+        self.assertEqual(
+            rooms.values('last_message_id', 'last_message_at', 'participant_count').get(pk=room.pk),
+            {'last_message_id': last.pk, 'last_message_at': last.timestamp, 'participant_count': 2},
+        )
+        self.assertEqual(
+            rooms.values('last_message_id', 'participant_count').get(pk=empty.pk),
+            {'last_message_id': None, 'participant_count': 0},
+        )
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.carol = createUser('carol')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    def search(self, user, text):
+        self.client.force_login(user)
+        response = self.client.get(reverse('search-messages'), {'q': text})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_index_is_complete_after_migrate(self):
+        self.assertTrue(search.searchIndexComplete(connection))
+        self.assertTrue(search.ftsAvailable())
+
+    def test_finds_direct_and_group_messages(self):
+        direct = Messages.sendMessage(self.bob, self.alice, 'pineapple delivery at noon')
+        group = RoomMessagesModel.objects.create(room=self.room, sender=self.bob, message='pineapple party')
+        Messages.sendMessage(self.bob, self.alice, 'something else')
+
+        results = self.search(self.alice, 'pineap')
+
+        self.assertEqual(
+            {(result['kind'], result['id']) for result in results},
+            {('direct', direct.pk), ('group', group.pk)}
+        )
+        self.assertIn('<mark>pineapple</mark>', results[0]['snippet'])
+
+    def test_only_finds_what_the_user_can_see(self):
+        hidden = Messages.sendMessage(self.bob, self.alice, 'pineapple one')
+        Messages.sendMessage(self.bob, self.alice, 'pineapple two')
+        RoomMessagesModel.objects.create(room=self.room, sender=self.bob, message='pineapple three')
+        hidden.deleteFor(self.alice)
+
+        self.assertEqual(len(self.search(self.alice, 'pineapple')), 2)
+        self.assertEqual(len(self.search(self.bob, 'pineapple')), 3)
+        self.assertEqual(self.search(self.carol, 'pineapple'), [])
+
+
+# Remaking the index uses the schema editor, which SQLite won't run in a transaction
+class SearchIndexRepairTests(TransactionTestCase):
+    def test_dropped_triggers_are_reinstalled(self):
+        self.addCleanup(search.ensureSearchIndex)
+        alice, bob = createUser('alice'), createUser('bob')
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {search.MESSAGES_FTS}_ai')
+        search._fts5_available = None
+
+        # New messages would go unindexed, so search doesn't use the index
+        self.assertFalse(search.ftsAvailable())
+        missed = Messages.sendMessage(bob, alice, 'pineapple')
+
+        self.assertTrue(search.ensureSearchIndex())
+        self.assertTrue(search.ftsAvailable())
+        self.assertFalse(search.ensureSearchIndex())
+
+        found = Messages.sendMessage(bob, alice, 'pineapple again')
+        results = search.searchMessages(alice, 'pineapple')['results']
+        self.assertEqual({result['id'] for result in results}, {missed.pk, found.pk})
+
+
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    def test_changes_are_seen_right_away(self):
+        self.assertTrue(membership.isMember(self.room.pk, self.bob.pk))
+
+        self.room.participants.remove(self.bob)
+        self.assertFalse(membership.isMember(self.room.pk, self.bob.pk))
+
+        self.bob.room_participants.add(self.room)
+        self.assertTrue(membership.isMember(self.room.pk, self.bob.pk))
+
+    def test_entry_cached_before_commit_is_dropped_on_commit(self):
+        stale = membership.getRoomEntry(self.room.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.participants.remove(self.bob)
+            # Another connection reads the old members and caches them before the commit
+            cache.set(membership.cacheKey(self.room.pk), stale)
+            self.assertTrue(membership.isMember(self.room.pk, self.bob.pk))
+
+        self.assertFalse(membership.isMember(self.room.pk, self.bob.pk))
+
+    def test_deleted_room_has_no_members(self):
+        self.assertTrue(membership.isMember(self.room.pk, self.alice.pk))
+        room_id = self.room.pk
+        self.room.delete()
+        self.assertIsNone(membership.getRoomEntry(room_id))
+
+
+# Stands in for another worker: a separate interpreter that shares nothing
+# with the test process but the cache at sys.argv[1], then runs sys.argv[2]
+OTHER_WORKER = """
+import sys
+import django
+from django.conf import settings
+
+settings.DATABASES['default']['NAME'] = ':memory:'
+settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': sys.argv[1]}}
+django.setup()
+
+exec(sys.argv[2])
+"""
+
+
+def runInOtherWorker(location, code):
+    subprocess.run(
+        [sys.executable, '-c', OTHER_WORKER, location, code],
+        cwd=settings.BASE_DIR,
+        env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'NexChat.settings'},
+        check=True,
+        capture_output=True,
+    )
+
+
+class SharedMembershipCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = directory.name
+
+        shared = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': self.location,
+        }})
+        shared.enable()
+        self.addCleanup(shared.disable)
+
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    def test_removal_in_another_process_is_seen_here(self):
+        self.assertTrue(membership.isMember(self.room.pk, self.bob.pk))
+
+        # The other worker removes bob; the row is gone for everyone, the
+        # cached entry only once its handler drops it from the shared cache
+        RoomModel.participants.through.objects.filter(roommodel=self.room, customuser=self.bob).delete()
+        self.assertTrue(membership.isMember(self.room.pk, self.bob.pk))
+
+        runInOtherWorker(self.location, f'from chat import membership; membership.invalidate([{self.room.pk}])')
+        self.assertFalse(membership.isMember(self.room.pk, self.bob.pk))
+        self.assertTrue(membership.isMember(self.room.pk, self.alice.pk))
+
+    def test_several_processes_need_a_shared_cache(self):
+        broker = {'default': {'BACKEND': 'chat.layers.UnixSocketChannelLayer', 'CONFIG': {'path': '/tmp/chat.sock'}}}
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+        checks.checkSharedCache()
+        with override_settings(CHANNEL_LAYERS=broker):
+            checks.checkSharedCache()
+            with override_settings(CACHES=local):
+                with self.assertRaises(ImproperlyConfigured):
+                    checks.checkSharedCache()
+
+        with override_settings(CACHES=local):
+            checks.checkSharedCache()
+
+
+async def connectSocket(path, user):
+    """A connected WebsocketCommunicator for path, signed in as user."""
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected, f'{path} refused {user}'
+    return communicator
+
+
+async def receiveType(communicator, frame_type):
+    """The next frame of frame_type, skipping broadcasts and other frames before it."""
+    while True:
+        frame = await communicator.receive_json_from(timeout=5)
+        if frame['type'] == frame_type:
+            return frame
+
+
+# The consumers reach the database from other threads, so data has to be committed
+class ChatFrameTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    async def assertRejectsBadMessages(self, path, **frame):
+        communicator = await connectSocket(path, self.alice)
+        try:
+            await communicator.send_json_to(dict(frame, type='chat', message=123, client_id='bad'))
+            error = await receiveType(communicator, 'error')
+            self.assertEqual(error['client_id'], 'bad')
+            self.assertEqual(error['message'], 'Message must be a string')
+
+            # Frames without a string type are ignored, so the first ack is for the next one
+            await communicator.send_json_to(dict(frame, type=['chat'], message='hello', client_id='ignored'))
+
+            # The socket is still up and sends the next message
+            await communicator.send_json_to(dict(frame, type='chat', message='  hello  ', client_id='good'))
+            ack = await receiveType(communicator, 'ack')
+            self.assertEqual(ack['client_id'], 'good')
+        finally:
+            await communicator.disconnect()
+
+    async def test_direct_socket(self):
+        await self.assertRejectsBadMessages(f'/ws/socket-server/{self.bob.pk}')
+        self.assertEqual(await Messages.objects.filter(sender=self.alice).values_list('body', flat=True).aget(), 'hello')
+
+    async def test_room_socket(self):
+        await self.assertRejectsBadMessages(f'/ws/room/{self.room.pk}')
+        self.assertEqual(await RoomMessagesModel.objects.values_list('message', flat=True).aget(), 'hello')
+
+    async def test_multiplexed_socket(self):
+        await self.assertRejectsBadMessages('/ws/user/', conversation={'kind': 'room', 'id': self.room.pk})
+        await self.assertRejectsBadMessages('/ws/user/', conversation={'kind': 'direct', 'id': self.bob.pk})
+        self.assertEqual(await Messages.objects.acount() + await RoomMessagesModel.objects.acount(), 2)
+
+
+class RoomConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+        self.path = f'/ws/room/{self.room.pk}'
+
+    async def test_non_members_are_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), self.path)
+        communicator.scope['user'] = await sync_to_async(createUser)('carol')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_message_is_saved_and_broadcast(self):
+        alice = await connectSocket(self.path, self.alice)
+        bob = await connectSocket(self.path, self.bob)
+        try:
+            await alice.send_json_to({'type': 'chat', 'message': 'hello', 'client_id': 'c1'})
+            ack = await receiveType(alice, 'ack')
+            self.assertEqual(ack['client_id'], 'c1')
+
+            for communicator in (alice, bob):
+                chat = await receiveType(communicator, 'chat')
+                self.assertEqual((chat['id'], chat['sender_id'], chat['message']), (ack['id'], self.alice.pk, 'hello'))
+
+            room = await RoomModel.objects.aget(pk=self.room.pk)
+            self.assertEqual(room.last_message_id, ack['id'])
+        finally:
+            await alice.disconnect()
+            await bob.disconnect()
+
+    async def test_read_receipt_only_when_watermark_moves(self):
+        message = await RoomMessagesModel.objects.acreate(room=self.room, sender=self.alice, message='hello')
+        alice = await connectSocket(self.path, self.alice)
+        bob = await connectSocket(self.path, self.bob)
+        try:
+            await bob.send_json_to({'type': 'read', 'last_read_id': message.pk})
+            receipt = await receiveType(alice, 'read')
+            self.assertEqual((receipt['user_id'], receipt['last_read_id']), (self.bob.pk, message.pk))
+
+            await bob.send_json_to({'type': 'read', 'last_read_id': message.pk})
+            await bob.send_json_to({'type': 'read', 'last_read_id': 'not a number'})
+            self.assertTrue(await alice.receive_nothing(timeout=0.2))
+        finally:
+            await alice.disconnect()
+            await bob.disconnect()
+
+    async def test_removed_member_is_disconnected(self):
+        bob = await connectSocket(self.path, self.bob)
+        await sync_to_async(self.room.participants.remove)(self.bob)
+
+        self.assertEqual((await bob.receive_output(timeout=5))['type'], 'websocket.close')
+
+
+class TypingCoalescerTests(TestCase):
+    def setUp(self):
+        self.published = []
+
+    async def publish(self, is_typing):
+        self.published.append(is_typing)
+
+    async def test_only_changes_are_published(self):
+        coalescer = typingstatus.TypingCoalescer(timeout=60)
+        for is_typing in (True, True, True, False, False, True):
+            await coalescer.update('room', 1, is_typing, self.publish)
+        await coalescer.stop('room', 1)
+        await coalescer.stop('room', 1)
+
+        self.assertEqual(self.published, [True, False, True, False])
+
+    async def test_users_and_groups_are_separate(self):
+        coalescer = typingstatus.TypingCoalescer(timeout=60)
+        await coalescer.update('room', 1, True, self.publish)
+        await coalescer.update('room', 2, True, self.publish)
+        await coalescer.update('other', 1, True, self.publish)
+        self.assertEqual(self.published, [True, True, True])
+
+        for group, user_id in (('room', 1), ('room', 2), ('other', 1)):
+            await coalescer.stop(group, user_id)
+
+    async def test_silence_stops_typing(self):
+        coalescer = typingstatus.TypingCoalescer(timeout=0.1)
+        await coalescer.update('room', 1, True, self.publish)
+
+        # Each repeat pushes the automatic stop further out
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            await coalescer.update('room', 1, True, self.publish)
+        self.assertEqual(self.published, [True])
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.published, [True, False])
+        self.assertEqual(coalescer.typing, {})
+
+
+class UserConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    async def test_connected_lists_rooms(self):
+        communicator = await connectSocket('/ws/user/', self.alice)
+        try:
+            self.assertEqual((await receiveType(communicator, 'connected'))['rooms'], [self.room.pk])
+        finally:
+            await communicator.disconnect()
+
+    async def test_direct_message_arrives_once_tagged_with_partner(self):
+        alice = await connectSocket('/ws/user/', self.alice)
+        bob = await connectSocket('/ws/user/', self.bob)
+        try:
+            # Subscribed too, so the message comes through two groups
+            await bob.send_json_to({'type': 'subscribe', 'conversation': {'kind': 'direct', 'id': self.alice.pk}})
+            await receiveType(bob, 'subscribed')
+
+            await alice.send_json_to({
+                'type': 'chat', 'conversation': {'kind': 'direct', 'id': self.bob.pk},
+                'message': 'hello', 'client_id': 'c1'
+            })
+            ack = await receiveType(alice, 'ack')
+
+            received = await receiveType(bob, 'chat')
+            self.assertEqual(received['id'], ack['id'])
+            self.assertEqual(received['conversation'], {'kind': 'direct', 'id': self.alice.pk})
+            self.assertTrue(await bob.receive_nothing(timeout=0.2))
+
+            echoed = await receiveType(alice, 'chat')
+            self.assertEqual(echoed['conversation'], {'kind': 'direct', 'id': self.bob.pk})
+        finally:
+            await alice.disconnect()
+            await bob.disconnect()
+
+    async def test_room_typing_reaches_other_members(self):
+        alice = await connectSocket('/ws/user/', self.alice)
+        bob = await connectSocket('/ws/user/', self.bob)
+        try:
+            await alice.send_json_to({'type': 'typing', 'conversation': {'kind': 'room', 'id': self.room.pk}, 'is_typing': True})
+
+            typing = await receiveType(bob, 'typing')
+            self.assertEqual(typing['conversation'], {'kind': 'room', 'id': self.room.pk})
+            self.assertEqual((typing['user_id'], typing['is_typing']), (self.alice.pk, True))
+
+            await receiveType(alice, 'connected')
+            self.assertTrue(await alice.receive_nothing(timeout=0.2))
+        finally:
+            await alice.disconnect()
+            await bob.disconnect()
+
+    async def test_bad_conversations_are_errors(self):
+        other = await sync_to_async(createRoom)('private', self.bob)
+        communicator = await connectSocket('/ws/user/', self.alice)
+        try:
+            await communicator.send_json_to({'type': 'subscribe', 'conversation': {'kind': 'room', 'id': other.pk}})
+            self.assertEqual((await receiveType(communicator, 'error'))['message'], 'Conversation not found')
+
+            await communicator.send_json_to({'type': 'chat', 'conversation': {'kind': 'group', 'id': 1}, 'message': 'hi'})
+            self.assertEqual((await receiveType(communicator, 'error'))['message'], 'Missing or invalid conversation')
+        finally:
+            await communicator.disconnect()
+
+    async def test_rooms_joined_while_connected(self):
+        other = await sync_to_async(createRoom)('later', self.bob)
+        communicator = await connectSocket('/ws/user/', self.alice)
+        try:
+            await sync_to_async(other.participants.add)(self.alice)
+            subscribed = await receiveType(communicator, 'subscribed')
+            self.assertEqual(subscribed['conversation'], {'kind': 'room', 'id': other.pk})
+
+            await sync_to_async(other.participants.remove)(self.alice)
+            unsubscribed = await receiveType(communicator, 'unsubscribed')
+            self.assertEqual(unsubscribed['conversation'], {'kind': 'room', 'id': other.pk})
+        finally:
+            await communicator.disconnect()
+
+
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.closed = []
+
+    async def send(self, payload):
+        self.sent.append(payload)
+
+    async def close(self, code):
+        self.closed.append(code)
+
+    def makeQueue(self, **kwargs):
+        queue = outbound.OutboundQueue(self.send, self.close, **kwargs)
+        self.addCleanup(queue.cancel)
+        return queue
+
+    def fill(self, queue, *frames):
+        # put() doesn't yield, so nothing is sent yet: a client that hasn't read anything
+        for frame in frames:
+            queue.put(frame)
+        return list(queue.frames)
+
+    async def test_frames_go_out_in_order_before_close(self):
+        queue = self.makeQueue(max_size=10)
+        self.fill(queue, {'type': 'chat', 'id': 1}, {'type': 'chat', 'id': 2})
+        queue.closeAfterSend(1000)
+        queue.put({'type': 'chat', 'id': 3})
+
+        await queue.task
+        self.assertEqual([frame['id'] for frame in self.sent], [1, 2])
+        self.assertEqual(self.closed, [1000])
+
+    async def test_coalesce_keeps_newest_typing_and_read(self):
+        queue = self.makeQueue(max_size=4, policy='coalesce')
+        frames = self.fill(
+            queue,
+            {'type': 'chat', 'id': 1},
+            {'type': 'typing', 'user_id': 7, 'is_typing': True},
+            {'type': 'read', 'user_id': 7, 'last_read_id': 1},
+            {'type': 'typing', 'user_id': 7, 'is_typing': False},
+            {'type': 'read', 'user_id': 7, 'last_read_id': 2},
+        )
+        self.assertEqual(frames, [
+            {'type': 'chat', 'id': 1},
+            {'type': 'typing', 'user_id': 7, 'is_typing': False},
+            {'type': 'read', 'user_id': 7, 'last_read_id': 2},
+        ])
+
+    async def test_coalesce_then_drops_typing(self):
+        queue = self.makeQueue(max_size=2, policy='coalesce')
+        frames = self.fill(
+            queue,
+            {'type': 'chat', 'id': 1},
+            {'type': 'typing', 'user_id': 7, 'is_typing': True},
+            {'type': 'chat', 'id': 2},
+        )
+        self.assertEqual(frames, [{'type': 'chat', 'id': 1}, {'type': 'chat', 'id': 2}])
+        self.assertFalse(queue.closing)
+
+    async def test_drop_typing_only(self):
+        queue = self.makeQueue(max_size=3, policy='drop_typing')
+        frames = self.fill(
+            queue,
+            {'type': 'read', 'user_id': 7, 'last_read_id': 1},
+            {'type': 'read', 'user_id': 7, 'last_read_id': 2},
+            {'type': 'typing', 'user_id': 8, 'is_typing': True},
+            {'type': 'chat', 'id': 1},
+        )
+        self.assertEqual([frame['type'] for frame in frames], ['read', 'read', 'chat'])
+
+    async def test_chat_frames_are_never_dropped(self):
+        for policy in outbound.POLICIES:
+            with self.subTest(policy=policy):
+                self.sent, self.closed = [], []
+                queue = self.makeQueue(max_size=2, policy=policy)
+                self.fill(queue, *[{'type': 'chat', 'id': index} for index in range(3)])
+
+                await queue.task
+                self.assertEqual(self.sent, [])
+                self.assertEqual(self.closed, [outbound.SLOW_CONSUMER_CLOSE_CODE])
+
+    async def test_disconnect_policy_sheds_nothing(self):
+        queue = self.makeQueue(max_size=1, policy='disconnect')
+        self.fill(queue, {'type': 'typing', 'user_id': 7, 'is_typing': True}, {'type': 'typing', 'user_id': 8, 'is_typing': True})
+
+        await queue.task
+        self.assertEqual(self.closed, [outbound.SLOW_CONSUMER_CLOSE_CODE])
+
+    async def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            outbound.OutboundQueue(self.send, self.close, policy='drop_everything')
+
+
+class RecordingLayer:
+    """Stands in for the channel layer, remembering each group_send."""
+
+    def __init__(self):
+        self.sends = []
+
+    async def group_send(self, group, event):
+        self.sends.append((group, event))
+
+
+class GroupPostTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+        self.layer = RecordingLayer()
+        patcher = mock.patch('chat.views.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_posted_message_is_published_to_the_room(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse('group', args=[self.room.pk]), {'body': 'agenda'})
+        self.assertEqual(response.status_code, 200)
+
+        message = RoomMessagesModel.objects.get(room=self.room)
+        self.assertEqual(message.message, 'agenda')
+        self.assertEqual(self.layer.sends, [(getRoomGroupName(self.room.pk), {
+            'type': 'chat_message',
+            'id': message.pk,
+            'room_id': self.room.pk,
+            'sender_id': self.alice.pk,
+            'sender_username': 'alice',
+            'sender_avatar': self.alice.avatarUrl(80),
+            'message': 'agenda',
+            'created_at': message.timestamp.isoformat(),
+        })])
+
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, message.pk)
+
+    def test_non_members_and_empty_messages_are_not_sent(self):
+        self.client.force_login(createUser('carol'))
+        self.client.post(reverse('group', args=[self.room.pk]), {'body': 'hi'})
+
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse('group', args=[self.room.pk]), {'body': '  '})
+        self.assertEqual(response.status_code, 400)
+
+        self.assertFalse(RoomMessagesModel.objects.exists())
+        self.assertEqual(self.layer.sends, [])
+
+
+class GroupBatcherTests(TestCase):
+    def setUp(self):
+        self.layer = RecordingLayer()
+
+    async def settle(self, batcher):
+        while batcher.tails:
+            await asyncio.gather(*batcher.tails.values())
+
+    async def test_events_in_a_window_go_out_together(self):
+        batcher = batching.GroupBatcher(window=0.01, max_batch=50)
+        for index in range(3):
+            await batcher.send(self.layer, 'room', {'type': 'chat_message', 'id': index})
+        await batcher.send(self.layer, 'quiet', {'type': 'chat_message', 'id': 9})
+        await self.settle(batcher)
+
+        self.assertEqual(sorted(self.layer.sends, key=lambda send: send[0]), [
+            ('quiet', {'type': 'chat_message', 'id': 9}),
+            ('room', {'type': 'event_batch', 'events': [{'type': 'chat_message', 'id': index} for index in range(3)]}),
+        ])
+
+    async def test_full_batch_goes_out_before_the_window_closes(self):
+        batcher = batching.GroupBatcher(window=60, max_batch=2)
+        await batcher.send(self.layer, 'room', {'id': 1})
+        await batcher.send(self.layer, 'room', {'id': 2})
+
+        await asyncio.wait_for(self.settle(batcher), timeout=5)
+        self.assertEqual(self.layer.sends, [('room', {'type': 'event_batch', 'events': [{'id': 1}, {'id': 2}]})])
+
+    async def test_batches_keep_their_order(self):
+        batcher = batching.GroupBatcher(window=0.01, max_batch=2)
+        for index in range(5):
+            await batcher.send(self.layer, 'room', {'id': index})
+            await asyncio.sleep(0)
+        await self.settle(batcher)
+
+        delivered = []
+        for _, event in self.layer.sends:
+            delivered += event.get('events', [event])
+        self.assertEqual([event['id'] for event in delivered], list(range(5)))
+
+
+class EventBatchTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+
+    async def test_batch_reaches_the_client_as_one_frame(self):
+        communicator = await connectSocket(f'/ws/room/{self.room.pk}', self.alice)
+        try:
+            events = [
+                {'type': 'typing_status', 'user_id': user.pk, 'username': user.username, 'is_typing': True}
+                for user in (self.alice, self.bob)
+            ]
+            await get_channel_layer().group_send(getRoomGroupName(self.room.pk), {'type': 'event_batch', 'events': events})
+
+            frame = await receiveType(communicator, 'batch')
+            self.assertEqual([event['user_id'] for event in frame['events']], [self.alice.pk, self.bob.pk])
+            self.assertEqual({event['type'] for event in frame['events']}, {'typing'})
+        finally:
+            await communicator.disconnect()
+
+
+class SeqTrackerTests(TestCase):
+    def test_late_lower_seq_is_delivered_once(self):
+        seqs = replay.SeqTracker(1)
+        self.assertTrue(seqs.accept(3))
+        self.assertTrue(seqs.accept(2))
+        self.assertFalse(seqs.accept(2))
+        self.assertFalse(seqs.accept(3))
+        self.assertFalse(seqs.accept(1))
+        self.assertEqual(seqs.last_seq, 3)
+
+    def test_first_event_without_position_leaves_no_gap(self):
+        seqs = replay.SeqTracker()
+        self.assertTrue(seqs.accept(5000))
+        self.assertEqual(seqs.missing, set())
+        self.assertFalse(seqs.accept(4999))
+
+    def test_buffer_keeps_late_events_in_seq_order(self):
+        buffer = replay.ReplayBuffer(size=3)
+        for seq in (1, 3, 2, 3):
+            buffer.record({'seq': seq})
+
+        self.assertEqual([event['seq'] for event in buffer.since(0)], [1, 2, 3])
+
+        buffer.record({'seq': 4})
+        self.assertIsNone(buffer.since(0))
+        self.assertEqual([event['seq'] for event in buffer.since(1)], [2, 3, 4])
+
+
+class DirectReplayTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.group = getPrivateGroupName(self.alice.pk, self.bob.pk)
+
+    async def receiveChats(self, communicator):
+        chats = []
+        while not await communicator.receive_nothing(timeout=0.2):
+            frame = await communicator.receive_json_from()
+            if frame['type'] == 'chat':
+                chats.append(frame['seq'])
+        return chats
+
+    async def test_out_of_order_events_are_not_lost(self):
+        first = await sync_to_async(Messages.sendMessage)(self.bob, self.alice, 'message 0')
+        communicator = await connectSocket(f'/ws/socket-server/{self.bob.pk}?last_seq={first.seq}', self.alice)
+        try:
+            second, third = [
+                await sync_to_async(Messages.sendMessage)(self.bob, self.alice, f'message {index}') for index in (1, 2)
+            ]
+
+            # Published by two processes, the later message gets there first
+            layer = get_channel_layer()
+            for message in (third, second, third):
+                await layer.group_send(self.group, directMessageEvent(message))
+
+            self.assertEqual(await self.receiveChats(communicator), [third.seq, second.seq])
+        finally:
+            await communicator.disconnect()
+
+    async def test_buffered_replay_skips_deleted_messages(self):
+        listener = await connectSocket(f'/ws/socket-server/{self.bob.pk}', self.alice)
+        try:
+            sent = []
+            for index in range(3):
+                message = await sync_to_async(Messages.sendMessage)(self.bob, self.alice, f'message {index}')
+                await publishDirectMessage(get_channel_layer(), message, batched=False)
+                sent.append(message)
+            self.assertEqual(await self.receiveChats(listener), [message.seq for message in sent])
+
+            await sync_to_async(sent[1].deleteFor)(self.alice)
+
+            # Served from the buffer the listener keeps alive
+            buffer_replays = replay.stats()['buffer_replays']
+            reconnected = await connectSocket(f'/ws/socket-server/{self.bob.pk}?last_seq=0', self.alice)
+            try:
+                self.assertEqual(await self.receiveChats(reconnected), [sent[0].seq, sent[2].seq])
+                self.assertEqual(replay.stats()['buffer_replays'], buffer_replays + 1)
+            finally:
+                await reconnected.disconnect()
+        finally:
+            await listener.disconnect()
+
+
+class AttachmentTests(TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(attachments, 'ROOT', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+
+    async def create(self, **conversation):
+        response = await self.async_client.post(reverse('attachments'), dict(
+            conversation, name='notes.bin', size=len(self.content)
+        ))
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    async def put(self, upload_url, first, last):
+        return await self.async_client.put(
+            upload_url, self.content[first:last + 1], content_type='application/octet-stream',
+            headers={'Content-Range': f'bytes {first}-{last}/{len(self.content)}'}
+        )
+
+    async def upload(self):
+        await self.async_client.aforce_login(self.alice)
+        created = await self.create(to_user=self.bob.pk)
+        for first in range(0, len(self.content), 512):
+            response = await self.put(created['upload_url'], first, first + 511)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'offset': len(self.content), 'complete': True})
+        return created
+
+    async def download(self, url, **headers):
+        response = await self.async_client.get(url, headers=headers)
+        body = b''
+        if response.streaming:
+            body = b''.join([piece async for piece in response.streaming_content])
+        return response, body
+
+    async def test_resumed_upload(self):
+        await self.async_client.aforce_login(self.alice)
+        created = await self.create(to_user=self.bob.pk)
+        upload_url = created['upload_url']
+
+        self.assertEqual((await self.put(upload_url, 0, 299)).json(), {'offset': 300, 'complete': False})
+
+        # A gap is refused; the client asks where to resume
+        gap = await self.put(upload_url, 400, 599)
+        self.assertEqual((gap.status_code, gap.json()['offset']), (409, 300))
+        self.assertEqual((await self.async_client.get(upload_url)).json()['offset'], 300)
+
+        # Overlapping the stored part is fine, e.g. a retried chunk
+        self.assertEqual((await self.put(upload_url, 200, 1023)).json(), {'offset': 1024, 'complete': True})
+
+        response, body = await self.download(created['url'])
+        self.assertEqual(body, self.content)
+
+    async def test_bad_content_range(self):
+        await self.async_client.aforce_login(self.alice)
+        created = await self.create(to_user=self.bob.pk)
+        response = await self.async_client.put(
+            created['upload_url'], b'abc', content_type='application/octet-stream',
+            headers={'Content-Range': 'bytes 0-2/99'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    async def test_range_requests(self):
+        url = (await self.upload())['url']
+
+        response, body = await self.download(url)
+        self.assertEqual((response.status_code, response['Accept-Ranges']), (200, 'bytes'))
+        self.assertEqual(body, self.content)
+
+        response, body = await self.download(url, Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(body, self.content[10:20])
+
+        response, body = await self.download(url, Range='bytes=-5')
+        self.assertEqual(body, self.content[-5:])
+
+        response, body = await self.download(url, Range='bytes=1000-')
+        self.assertEqual(body, self.content[1000:])
+
+        response, _ = await self.download(url, Range=f'bytes={len(self.content)}-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, f'bytes */{len(self.content)}'))
+
+        # A partial copy of some other file gets the whole of this one
+        response, body = await self.download(url, Range='bytes=0-9', If_Range='"another-file"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+
+        etag = response['ETag']
+        response, _ = await self.download(url, If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+
+    async def test_only_the_conversation_can_download(self):
+        await self.async_client.aforce_login(self.alice)
+        created = await self.create(to_user=self.bob.pk)
+        self.assertEqual((await self.async_client.get(created['url'])).status_code, 404)  # Not complete yet
+
+        await self.put(created['upload_url'], 0, len(self.content) - 1)
+        self.assertEqual((await self.async_client.get(created['url'])).status_code, 200)
+
+        # Not sent yet, so only the uploader sees it
+        await self.async_client.aforce_login(self.bob)
+        self.assertEqual((await self.async_client.get(created['url'])).status_code, 404)
+        self.assertEqual((await self.async_client.get(created['upload_url'])).status_code, 404)
+
+        await self.async_client.aforce_login(await sync_to_async(createUser)('carol'))
+        self.assertEqual((await self.async_client.get(created['url'])).status_code, 404)
+
+    async def test_rooms_need_membership(self):
+        room = await sync_to_async(createRoom)('private', self.bob)
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.post(reverse('attachments'), {'name': 'a.txt', 'size': 3, 'room': room.pk})
+        self.assertEqual(response.status_code, 404)
+
+
+class UploadSizeLimitTests(TestCase):
+    async def call(self, method, path, headers=()):
+        """(paths the wrapped application saw, response start message or None)."""
+        seen, sent = [], []
+
+        async def application(scope, receive, send):
+            seen.append(scope['path'])
+
+        async def receive():
+            raise AssertionError('The body was read')
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers)}
+        await attachments.UploadSizeLimit(application)(scope, receive, send)
+        return seen, sent[0] if sent else None
+
+    async def test_oversized_chunk_is_refused_before_the_body_is_read(self):
+        path = reverse('attachment-upload', args=[1])
+        too_long = str(attachments.CHUNK_SIZE + 1).encode()
+
+        seen, response = await self.call('PUT', path, [(b'content-length', too_long)])
+        self.assertEqual((seen, response['status']), ([], 413))
+
+        seen, response = await self.call('PUT', path)
+        self.assertEqual((seen, response['status']), ([], 411))
+
+    async def test_everything_else_goes_through(self):
+        upload = reverse('attachment-upload', args=[1])
+        fits = str(attachments.CHUNK_SIZE).encode()
+        too_long = str(attachments.CHUNK_SIZE + 1).encode()
+
+        for method, path, length in [
+            ('PUT', upload, fits),
+            ('GET', upload, too_long),
+            ('POST', reverse('attachments'), too_long),
+        ]:
+            seen, response = await self.call(method, path, [(b'content-length', length)])
+            self.assertEqual((seen, response), ([path], None))
+
+
+class ChannelBrokerTests(TestCase):
+    async def test_socket_is_private_when_created(self):
+        start_unix_server = asyncio.start_unix_server
+        modes = []
+
+        async def startAndCheck(*args, path, **kwargs):
+            # Before anything else in serve() runs
+            server = await start_unix_server(*args, path=path, **kwargs)
+            modes.append(stat.S_IMODE(os.stat(path).st_mode))
+            return server
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('chat.layers.asyncio.start_unix_server', startAndCheck):
+            serving = asyncio.ensure_future(ChannelBroker(os.path.join(directory, 'channels.sock')).serve())
+            try:
+                while not modes:
+                    await asyncio.sleep(0.01)
+            finally:
+                serving.cancel()
+                await asyncio.gather(serving, return_exceptions=True)
+
+        self.assertEqual(modes[0] & 0o077, 0)
+
+
+class WebSocketLoadTests(TransactionTestCase):
+
+    def assertAllDelivered(self, report):
+        self.assertGreater(report.expected, 0)
+        self.assertEqual(report.delivered, report.expected)
+        self.assertGreater(report.throughput, 0)
+        self.assertGreater(report.memory_per_connection, 0)
+        self.assertLessEqual(report.percentile(0.5), report.percentile(0.95))
+        self.assertLessEqual(report.percentile(0.95), report.percentile(0.99))
+
+    def test_direct_messages_reach_partners(self):
+        report = loadtest.run('dm', clients=10, messages=3, timeout=30)
+
+        self.assertEqual(report.sent, 30)
+        self.assertAllDelivered(report)
+
+    def test_group_messages_reach_every_other_member(self):
+        report = loadtest.run('group', clients=12, messages=2, senders=3, timeout=30)
+
+        # 6 messages, each delivered to the 11 members that didn't send it
+        self.assertEqual(report.expected, 6 * 11)
+        self.assertAllDelivered(report)
+
+    def test_fixtures_are_removed(self):
+        users = CustomUser.objects.count()
+        loadtest.run('group', clients=4, messages=1, timeout=30)
+
+        self.assertEqual(CustomUser.objects.count(), users)
+
+
+class InboxCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        inbox.resetStats()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        with self.captureOnCommitCallbacks(execute=True):
+            Messages.sendMessage(self.bob, self.alice, 'hello')
+
+    def conversations(self, user):
+        return {
+            conversation['partner'].username: (conversation['last_message_body'], conversation['unread_count'])
+            for conversation in inbox.getConversationsList(user)
+        }
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        self.assertEqual(self.conversations(self.alice), {'bob': ('hello', 1)})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.conversations(self.alice), {'bob': ('hello', 1)})
+        self.assertEqual((inbox.stats()['hits'], inbox.stats()['misses']), (1, 1))
+
+    def test_new_message_drops_both_lists_once_committed(self):
+        self.conversations(self.alice)
+        self.conversations(self.bob)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            Messages.sendMessage(self.alice, self.bob, 'reply')
+            # Still the old token until the commit
+            self.assertEqual(self.conversations(self.bob), {'alice': ('hello', 0)})
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.conversations(self.alice), {'bob': ('reply', 1)})
+        self.assertEqual(self.conversations(self.bob), {'alice': ('reply', 1)})
+
+    def test_reading_and_deleting_drop_the_list(self):
+        self.conversations(self.alice)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Messages.markConversationRead(self.alice, self.bob)
+        self.assertEqual(self.conversations(self.alice), {'bob': ('hello', 0)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Messages.deleteConversation(self.alice, self.bob)
+        self.assertEqual(self.conversations(self.alice), {})
+        self.assertEqual(self.conversations(self.bob), {'alice': ('hello', 0)})
+
+    def test_partner_rename_drops_the_list(self):
+        self.conversations(self.alice)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.username = 'robert'
+            self.bob.save(update_fields=['username'])
+        self.assertEqual(self.conversations(self.alice), {'robert': ('hello', 1)})
+
+        # Fields the list doesn't show leave it alone
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.save(update_fields=['last_login'])
+        self.conversations(self.alice)
+        self.assertEqual(inbox.stats()['hits'], 1)
+
+
+class AvatarVariantsCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        CustomUser.objects.filter(pk=self.bob.pk).update(avatar='users/bob/avatar.jpg')
+        Messages.sendMessage(self.alice, self.bob, 'hello')
+
+    def test_recorded_variants_reach_cached_conversation_lists(self):
+        self.assertEqual(inbox.getConversationsList(self.alice)[0]['partner'].avatar_variants, {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            avatars.record(CustomUser, self.bob.pk, 'users/bob/avatar.jpg', {'96': 'users/bob/avatar_96.jpg'})
+
+        partner = inbox.getConversationsList(self.alice)[0]['partner']
+        self.assertEqual(partner.avatarUrl(80), partner.avatar.storage.url('users/bob/avatar_96.jpg'))
+
+
+class PresenceFlushTests(TestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+
+    def test_flush_at_exit_writes_pending_activity(self):
+        presence.touch(self.alice.pk)
+        presence.connect(self.bob.pk, 'socket')
+        self.addCleanup(presence.flush)
+        self.addCleanup(presence.disconnect, self.bob.pk, 'socket')
+
+        presence.flushOnExit()
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertIsNotNone(self.alice.last_activity)
+        self.assertIsNotNone(self.bob.last_activity)
+        self.assertEqual(presence.stats()['pending'], 0)
+
+
+class SharedPresenceTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = directory.name
+
+        shared = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': self.location,
+        }})
+        shared.enable()
+        self.addCleanup(shared.disable)
+
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        Messages.sendMessage(self.alice, self.bob, 'hello')
+        self.client.force_login(self.alice)
+        self.client.get(reverse('conversation', args=[self.bob.pk]))
+
+    def test_user_connected_to_another_worker_is_online_here(self):
+        url = reverse('conversation', args=[self.bob.pk])
+        offline = self.client.get(url)['ETag']
+        self.assertFalse(presence.isOnline(self.bob.pk))
+
+        # The other worker exits without closing the socket, as if it had been killed
+        runInOtherWorker(self.location, f"""
+from chat import presence
+presence.ONLINE_TTL = 3
+presence.connect({self.bob.pk}, 'socket')
+""")
+        self.assertTrue(presence.isOnline(self.bob.pk))
+        self.assertEqual(presence.onlineAmong([self.alice.pk, self.bob.pk]), {self.bob.pk})
+        self.assertIsNotNone(presence.latestActivity(self.bob.pk, None))
+        online = self.client.get(url)['ETag']
+        self.assertNotEqual(online, offline)
+
+        # Nobody refreshes bob's key anymore
+        time.sleep(3)
+        self.assertFalse(presence.isOnline(self.bob.pk))
+
+    def test_closing_the_last_socket_here_takes_the_user_offline(self):
+        presence.connect(self.bob.pk, 'first')
+        presence.connect(self.bob.pk, 'second')
+        self.addCleanup(presence.flush)
+
+        presence.disconnect(self.bob.pk, 'first')
+        self.assertTrue(presence.isOnline(self.bob.pk))
+        presence.disconnect(self.bob.pk, 'second')
+        self.assertFalse(presence.isOnline(self.bob.pk))
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+        self.room = createRoom('planning', self.alice, self.bob)
+        Messages.sendMessage(self.alice, self.bob, 'hello')
+        self.client.force_login(self.alice)
+        # The first page with a form sets the CSRF cookie, which is part of every ETag
+        self.client.get(reverse('conversation', args=[self.bob.pk]))
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_pages_are_not_modified(self):
+        urls = [
+            reverse('conversation', args=[self.bob.pk]),
+            reverse('conversation-messages', args=[self.bob.pk]),
+            reverse('conversations-list'),
+            reverse('groups'),
+            reverse('group', args=[self.room.pk]),
+            reverse('group-messages', args=[self.room.pk]),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(set(response['Cache-Control'].split(', ')), {'private', 'no-cache'})
+
+                revalidated = self.revalidate(url, response['ETag'])
+                self.assertEqual(revalidated.status_code, 304)
+                self.assertEqual(revalidated.content, b'')
+
+    def test_new_direct_message_changes_conversation_and_inbox(self):
+        urls = [reverse('conversation', args=[self.bob.pk]), reverse('conversations-list')]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+
+        Messages.sendMessage(self.bob, self.alice, 'hi')
+
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.revalidate(url, etags[url]).status_code, 200)
+
+    def test_new_room_message_changes_group_pages(self):
+        urls = [reverse('groups'), reverse('group', args=[self.room.pk])]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+
+        RoomMessagesModel.objects.create(room=self.room, sender=self.bob, message='agenda')
+
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.revalidate(url, etags[url]).status_code, 200)
+
+    def test_unflushed_partner_activity_changes_conversation(self):
+        url = reverse('conversation', args=[self.bob.pk])
+        etag = self.client.get(url)['ETag']
+
+        # The page shows this before it reaches the database, once a heartbeat published it
+        presence.touch(self.bob.pk)
+        self.addCleanup(presence.flush)
+        self.assertEqual(self.revalidate(url, etag).status_code, 304)
+        presence.heartbeat()
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 200)
+
+    def test_non_members_get_no_validator(self):
+        self.client.force_login(createUser('carol'))
+        response = self.client.get(reverse('group', args=[self.room.pk]))
+        self.assertNotIn('ETag', response)
+
+
+class ProtocolNegotiationTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = createUser('alice')
+        self.bob = createUser('bob')
+
+    async def connectOffering(self, subprotocols):
+        path = f'/ws/socket-server/{self.bob.pk}'
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+        communicator.scope['user'] = self.alice
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_json_without_msgpack_installed(self):
+        with mock.patch.object(protocol, 'msgpack', None):
+            communicator, subprotocol = await self.connectOffering([protocol.MSGPACK_SUBPROTOCOL])
+            try:
+                self.assertIsNone(subprotocol)
+                self.assertEqual((await receiveType(communicator, 'connected'))['type'], 'connected')
+            finally:
+                await communicator.disconnect()
+
+    @skipUnless(protocol.msgpack, 'msgpack is not installed')
+    async def test_msgpack_when_offered_and_installed(self):
+        communicator, subprotocol = await self.connectOffering([protocol.MSGPACK_SUBPROTOCOL])
+        try:
+            self.assertEqual(subprotocol, protocol.MSGPACK_SUBPROTOCOL)
+            frame = protocol.MsgpackCodec().decode(bytes_data=await communicator.receive_from(timeout=5))
+            self.assertEqual(frame['type'], 'connected')
+        finally:
+            await communicator.disconnect()
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import weakref
+
+from django.conf import settings
+
+
+TYPING = getattr(settings, 'CHAT_TYPING', {})
+TIMEOUT = TYPING.get('TIMEOUT_MS', 5000) / 1000  # Typing stops by itself after this long
+
+_lock = threading.Lock()
+_counters = {'received': 0, 'emitted': 0, 'suppressed': 0, 'timeouts': 0}
+
+# One coalescer per event loop; its timers belong to that loop
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+class TypingCoalescer:
+    """
+    Tracks who is typing in which channel group and only lets state changes
+    through: the first "typing" of a burst and the matching "stopped".
+    Repeats in between are suppressed, and a user who goes quiet for
+    timeout seconds is reported as stopped automatically.
+
+    publish(is_typing) is the coroutine that actually broadcasts.
+    """
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.typing = {}  # (group, user id) -> (timer, publish)
+
+    async def update(self, group, user_id, is_typing, publish):
+        _count('received')
+        key = (group, user_id)
+        current = self.typing.get(key)
+
+        if is_typing and current is not None:
+            # Still typing; just push the automatic stop further out
+            current[0].cancel()
+            self.typing[key] = (self.startTimer(key), publish)
+            _count('suppressed')
+            return
+
+        if not is_typing and current is None:
+            _count('suppressed')
+            return
+
+        if is_typing:
+            self.typing[key] = (self.startTimer(key), publish)
+        else:
+            current[0].cancel()
+            del self.typing[key]
+
+        _count('emitted')
+        await publish(is_typing)
+
+    async def stop(self, group, user_id):
+        """Ends a typing burst right away, e.g. when the message is sent or the socket closes."""
+        current = self.typing.pop((group, user_id), None)
+        if current is None:
+            return
+
+        timer, publish = current
+        timer.cancel()
+        _count('emitted')
+        await publish(False)
+
+    def startTimer(self, key):
+        return asyncio.get_running_loop().call_later(self.timeout, self.expire, key)
+
+    def expire(self, key):
+        current = self.typing.pop(key, None)
+        if current is None:
+            return
+
+        _count('timeouts')
+        _count('emitted')
+        asyncio.ensure_future(current[1](False))
+
+
+def getCoalescer():
+    """Returns the coalescer for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _coalescers:
+        _coalescers[loop] = TypingCoalescer()
+    return _coalescers[loop]
+
+
+def stats():
+    """Typing event counters for this process."""
+    with _lock:
+        return dict(_counters)
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
@@ -3,22 +3,30 @@ from django.urls import path
 from .views import (
     GroupView,
     GroupListView,
+    GroupMessagesView,
     CreateGroupView,
     SendMessageView,
     SearchUsersView,
+    SearchMessagesView,
     ConversationView,
+    ConversationMessagesView,
     DeleteMessageView,
     DeleteConversationView,
     ConversationsListView,
     DeleteGroupMessage,
     DeleteGroupView,
+    CreateAttachmentView,
+    AttachmentUploadView,
+    AttachmentView,
 )
 
 urlpatterns = [
     # Conversation
     path('conversations-list/', ConversationsListView.as_view(), name='conversations-list'),
     path('conversation/<int:partner_id>', ConversationView.as_view(), name='conversation'),
+    path('conversation/<int:partner_id>/messages', ConversationMessagesView.as_view(), name='conversation-messages'),
     path('search-users/', SearchUsersView.as_view(), name='search-users'),
+    path('search-messages/', SearchMessagesView.as_view(), name='search-messages'),
     path('send-message/', SendMessageView.as_view(), name='send-message'),
     path('delete-message/<int:pk>', DeleteMessageView.as_view(), name='delete-message'),
     path('delete-conversation/<int:partner_id>', DeleteConversationView.as_view(), name='delete-conversation'),
@@ -26,7 +34,13 @@ urlpatterns = [
     # Group
     path('groups/', GroupListView.as_view(), name='groups'),
     path('group/<int:pk>', GroupView.as_view(), name='group'),
+    path('group/<int:pk>/messages', GroupMessagesView.as_view(), name='group-messages'),
     path('create-group/', CreateGroupView.as_view(), name='create-group'),
     path('delete-group-message/<int:pk>/<int:message_id>', DeleteGroupMessage.as_view(), name='delete-group-message'),
     path('delete-group/<int:pk>', DeleteGroupView.as_view(), name='delete-group'),
+
+    # Attachments
+    path('attachments/', CreateAttachmentView.as_view(), name='attachments'),
+    path('attachments/<int:pk>', AttachmentView.as_view(), name='attachment'),
+    path('attachments/<int:pk>/upload', AttachmentUploadView.as_view(), name='attachment-upload'),
 ]
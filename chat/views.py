@@ -1,40 +1,79 @@
+import asyncio
+import mimetypes
+import os
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from django.views import View
-from django.db.models import Q
+from django.db.models import Q, F
 from django.contrib import messages
+from django.urls import reverse
 from django.shortcuts import render, redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import (
+    HttpResponse,
     JsonResponse,
     HttpResponseRedirect,
+    StreamingHttpResponse,
 )
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
 
 from chat.models import CustomUser
 from userauths.forms import CustomRegisterForm
-from .serializers import ConversationSerializer
+from . import attachments, conditional, inbox, membership, presence
+from .consumers import publishDirectMessage, publishRoomMessage
+from .search import searchMessages
+from .pagination import parseLimit, paginateByCursor
+from .serializers import (
+    MessageSerializer,
+    ConversationSerializer,
+    RoomMessageSerializer,
+)
 from .models import (
+    Attachment,
     Messages,
     RoomModel,
     RoomMessagesModel,
+    RoomReadWatermark,
 )
 from .forms import (
     RoomForm,
 )
 
-class ConversationsListView(LoginRequiredMixin, View):
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    """LoginRequiredMixin for views with async handlers."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Load the user off the event loop, so the check in LoginRequiredMixin doesn't query on it
+        request.user = await request.auser()
+        response = super().dispatch(request, *args, **kwargs)
+        return await response if asyncio.iscoroutine(response) else response
+
+class ConversationsListView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
 
+    def validators(self, request):
+        rows, last_modified = conditional.inbox(request.user)
+        online = presence.onlineAmong([partner_id for partner_id, _ in rows])
+        return [rows, sorted(online)], last_modified
+
     def get(self, request):
         conversations_list = []
         
         try:
-            conversations_list = Messages.getConversationsList(
-                user=request.user
-            )
+            conversations_list = inbox.getConversationsList(request.user)
         
         except Exception as e:
             messages.error(request, f"Error loading conversations: {str(e)}")
             conversations_list = []  # Ensure we always have a list
+
+        # One cache lookup for the whole inbox
+        online = presence.onlineAmong([conversation['partner'].pk for conversation in conversations_list])
+        for conversation in conversations_list:
+            conversation['is_online'] = conversation['partner'].pk in online
         
         return render(request, 'chat/conversations_list.html', {
             'conversations': conversations_list
@@ -46,9 +85,13 @@ class SearchUsersView(LoginRequiredMixin, View):
 
     def get(self, request):
         try:
-            searched_users = CustomUser.objects.exclude(
-                id=request.user.id
-            ).order_by('username')[:20]  # Limit to 20 random users
+            searched_users = CustomUser.objects.exclude(id=request.user.id)
+
+            query = request.GET.get('q', '').strip()
+            if query:
+                searched_users = searched_users.filter(username__icontains=query)
+
+            searched_users = searched_users.order_by('username')[:20]  # Limit to 20 users
             
         except Exception as e:
             messages.error(request, f"{str(e)}")
@@ -57,14 +100,101 @@ class SearchUsersView(LoginRequiredMixin, View):
             'searched_users': searched_users
         })
 
-class ConversationView(LoginRequiredMixin, View):
+class SearchMessagesView(LoginRequiredMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
 
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({"message": "Search query is required."}, status=400)
+
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            page = 1
+
+        found = searchMessages(request.user, query, page=page)
+
+        results = []
+        for result in found['results']:
+            if result['kind'] == 'group':
+                url = reverse('group', args=[result['room_id']])
+            else:
+                partner_id = (
+                    result['recipient_id']
+                    if result['sender_id'] == request.user.id
+                    else result['sender_id']
+                )
+                url = reverse('conversation', args=[partner_id])
+
+            results.append(dict(result, url=url))
+
+        return JsonResponse({
+            "results": results,
+            "page": found['page'],
+            "has_next": found['has_next'],
+        })
+
+class ConversationView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    def validators(self, request, partner_id):
+        validators = conditional.conversation(request.user, partner_id)
+        if validators is None:
+            return None
+
+        # The page shows presence's view of the partner: online, and last activity
+        # including what hasn't been flushed to the database yet
+        (summary_changed, read_changed, last_activity), last_modified = validators
+        last_activity = presence.latestActivity(partner_id, last_activity)
+        return [summary_changed, read_changed, last_activity, presence.isOnline(partner_id)], last_modified
+
     def get(self, request, partner_id):
+        # Latest page only; older messages are loaded from ConversationMessagesView
         conversation = Messages.getConversation(user=request.user, partner_id=partner_id)
+        conversation['partner_online'] = presence.isOnline(conversation['partner'].pk)
+        conversation['partner_last_activity'] = presence.lastActivity(conversation['partner'])
         return render(request, 'chat/conversation.html', context={'conversation': conversation})
 
+class ConversationMessagesView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    def validators(self, request, partner_id):
+        return conditional.conversation(request.user, partner_id)
+
+    def get(self, request, partner_id):
+        try:
+            conversation = Messages.getConversation(
+                user=request.user,
+                partner_id=partner_id,
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                limit=parseLimit(request.GET.get('limit'))
+            )
+
+        except CustomUser.DoesNotExist:
+            return JsonResponse({"message": "User not found."}, status=404)
+
+        except ValueError as e:
+            return JsonResponse({"message": str(e)}, status=400)
+
+        return JsonResponse({
+            "messages": [
+                dict(
+                    MessageSerializer(message).data,
+                    recipient_has_read=getattr(message, 'recipient_has_read', None)
+                )
+                for message in conversation['messages']
+            ],
+            "older": conversation['older_cursor'],
+            "newer": conversation['newer_cursor'],
+            "has_older": conversation['has_older'],
+            "has_newer": conversation['has_newer'],
+        })
+
 class SendMessageView(LoginRequiredMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
@@ -74,7 +204,10 @@ class SendMessageView(LoginRequiredMixin, View):
         body = request.POST.get('body')
 
         to_user = CustomUser.objects.get(pk=user_id)
-        Messages.sendMessage(request.user, to_user, body)
+        message = Messages.sendMessage(request.user, to_user, body)
+
+        # Open sockets see it live and keep their seq numbering gap-free
+        async_to_sync(publishDirectMessage)(get_channel_layer(), message, batched=False)
 
         return JsonResponse({"message": f"Message Sent to {to_user.username}."})
     
@@ -83,8 +216,17 @@ class DeleteMessageView(LoginRequiredMixin, View):
     redirect_field_name = 'next'  # Default (optional)
 
     def get(self, request, pk):
-        Messages.objects.get(pk=pk).delete()
-        messages.success(request, f"Message deleted.")
+        try:
+            # Only a participant can remove the message from their own view
+            message = Messages.objects.get(
+                Q(sender=request.user) | Q(recipient=request.user),
+                pk=pk
+            )
+            message.deleteFor(request.user)
+            messages.success(request, f"Message deleted.")
+
+        except Messages.DoesNotExist:
+            messages.error(request, "Message not found")
         
         return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
@@ -96,12 +238,8 @@ class DeleteConversationView(LoginRequiredMixin, View):
         try:
             partner = CustomUser.objects.get(pk=partner_id)
             
-            # Delete both copies (current user's copies only)
-            deleted_count, _ = Messages.objects.filter(
-                Q(user=request.user) &  # Current user's copy
-                (Q(sender=request.user, recipient=partner) | 
-                 Q(sender=partner, recipient=request.user))
-            ).delete()
+            # Hide the conversation for the current user only
+            deleted_count = Messages.deleteConversation(request.user, partner)
             
             messages.success(request, f"Deleted {deleted_count} messages")
             return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
@@ -159,20 +297,24 @@ class CreateGroupView(LoginRequiredMixin, View):
                 'users': users
             })
         
-class GroupListView(LoginRequiredMixin, View):
+class GroupListView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
 
+    def validators(self, request):
+        return conditional.groupList(request.user)
+
     def get(self, request):
         try:
             # Get groups where user is a participant
-            groups = RoomModel.objects.filter(
-                participants=request.user
-            ).distinct().order_by('-created_at')
-
-            # Prefetch the last message for each group
-            for group in groups:
-                group.last_message = group.messages.order_by('-timestamp').first()
+            # Most recently active first; last message comes from the room's own pointer
+            groups = RoomReadWatermark.annotateUnreadCount(
+                RoomModel.objects.filter(participants=request.user),
+                request.user
+            ).select_related('last_message').order_by(
+                F('last_message_at').desc(nulls_last=True),
+                '-created_at'
+            )
 
         except Exception as e:
             messages.error(request, f"Error loading conversations: {str(e)}")
@@ -182,44 +324,103 @@ class GroupListView(LoginRequiredMixin, View):
             'groups': groups
         })
 
-class GroupView(LoginRequiredMixin, View):
+class GroupView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
 
+    def validators(self, request, pk):
+        # Non-members get the view's own error response
+        if not membership.isMember(pk, request.user.id):
+            return None
+        return conditional.room(pk)
+
     def get(self, request, pk):
         try:
-            # Get the group with prefetched messages and participants
+            if not membership.isMember(pk, request.user.id):
+                raise RoomModel.DoesNotExist
+
+            # Get the group; only the latest page of messages is rendered
             group = RoomModel.objects.get(pk=pk)
             
-            messages = group.messages.all().order_by('timestamp')
-            print(f'Messages --> {messages}')
+            page = paginateByCursor(
+                group.messages.select_related('sender').prefetch_related('attachments'),
+                'timestamp'
+            )
         
-        except Exception as e:
-            messages.error(request, f"Error loading conversations: {str(e)}")
+        except RoomModel.DoesNotExist:
+            messages.error(request, "Group not found")
+            return redirect('groups')
+
+        if page['items']:
+            RoomReadWatermark.markRead(request.user, group, page['items'][-1].pk)
             
         return render(request, 'chat/group.html', {
             'group': group,
-            'chat_messages': messages
+            'chat_messages': page['items'],
+            'older_cursor': page['older'],
         })
     
     def post(self, request, pk):
         try:
-            group = RoomModel.objects.get(pk=pk)
+            # Room name and membership come from the membership cache
+            group = membership.getRoomEntry(pk)
+            if group is None or request.user.id not in group['members']:
+                raise RoomModel.DoesNotExist
+
             body = request.POST.get('body', '').strip()
+            if not body:
+                return JsonResponse({"message": "Message is empty"}, status=400)
+
+            # Saved the way RoomConsumer saves it, and published like it too,
+            # so open sockets see it live
+            [message] = RoomMessagesModel.bulkSend([(pk, request.user.id, body)])
+            if message is None:
+                raise RoomModel.DoesNotExist
+            async_to_sync(publishRoomMessage)(get_channel_layer(), message, request.user, batched=False)
             
-            # Create the message
-            RoomMessagesModel.objects.create(
-                room=group,
-                sender=request.user,
-                message=body
-            )
-            
-            return JsonResponse({"message": f"{request.user.username} send a message on {group.name}."})
+            return JsonResponse({"message": f"{request.user.username} send a message on {group['name']}."})
             
         except RoomModel.DoesNotExist:
             messages.error(request, "Group not found or access denied")
             return redirect('group', pk=pk)
 
+class GroupMessagesView(LoginRequiredMixin, conditional.ConditionalGetMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    def validators(self, request, pk):
+        # Non-members get the view's own error response
+        if not membership.isMember(pk, request.user.id):
+            return None
+        return conditional.room(pk)
+
+    def get(self, request, pk):
+        try:
+            if not membership.isMember(pk, request.user.id):
+                raise RoomModel.DoesNotExist
+
+            page = paginateByCursor(
+                RoomMessagesModel.objects.filter(room_id=pk).select_related('sender').prefetch_related('attachments'),
+                'timestamp',
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                limit=parseLimit(request.GET.get('limit'))
+            )
+
+        except RoomModel.DoesNotExist:
+            return JsonResponse({"message": "Group not found or access denied"}, status=404)
+
+        except ValueError as e:
+            return JsonResponse({"message": str(e)}, status=400)
+
+        return JsonResponse({
+            "messages": RoomMessageSerializer(page['items'], many=True).data,
+            "older": page['older'],
+            "newer": page['newer'],
+            "has_older": page['has_older'],
+            "has_newer": page['has_newer'],
+        })
+
 class DeleteGroupView(LoginRequiredMixin, View):
     login_url = '/'  # Redirect URL if not authenticated
     redirect_field_name = 'next'  # Default (optional)
@@ -250,15 +451,14 @@ class DeleteGroupMessage(LoginRequiredMixin, View):
 
     def get(self, request, pk, message_id):
         try:
-            # Get message and verify permissions
-            message = RoomMessagesModel.objects.get(
-                pk=message_id,
-                room__pk=pk,
-                room__participants=request.user  # User must be in group
-            )
+            # User must be in group
+            if not membership.isMember(pk, request.user.id):
+                raise RoomMessagesModel.DoesNotExist
+
+            message = RoomMessagesModel.objects.get(pk=message_id, room_id=pk)
             
             # Only allow delete if user is sender or group admin
-            if request.user == message.sender:
+            if request.user.id == message.sender_id:
                 message.delete()
                 messages.success(request, f"Message deleted.")
             else:
@@ -267,4 +467,165 @@ class DeleteGroupMessage(LoginRequiredMixin, View):
         except RoomMessagesModel.DoesNotExist:
             messages.error(request, "Message not found")
             
-        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
\ No newline at end of file
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+
+class CreateAttachmentView(LoginRequiredMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    def post(self, request):
+        # Starts an upload for a direct (to_user) or group (room) conversation; see chat.attachments
+        name = os.path.basename(request.POST.get('name', '').strip())[:255]
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            size = 0
+
+        if not name or size <= 0:
+            return JsonResponse({"message": "A file name and size are required."}, status=400)
+        if size > attachments.MAX_SIZE:
+            return JsonResponse({"message": f"Files can be at most {attachments.MAX_SIZE // (1024 * 1024)} MB."}, status=413)
+
+        to_user = request.POST.get('to_user')
+        room = request.POST.get('room')
+        if bool(to_user) == bool(room):
+            return JsonResponse({"message": "Either to_user or room is required."}, status=400)
+
+        try:
+            if to_user:
+                recipient, room_id = CustomUser.objects.get(pk=to_user), None
+            else:
+                recipient, room_id = None, int(room)
+                if not membership.isMember(room_id, request.user.id):
+                    raise RoomModel.DoesNotExist
+
+        except (CustomUser.DoesNotExist, RoomModel.DoesNotExist, ValueError):
+            return JsonResponse({"message": "Conversation not found."}, status=404)
+
+        attachment = Attachment.objects.create(
+            uploader=request.user,
+            recipient=recipient,
+            room_id=room_id,
+            name=name,
+            content_type=(
+                request.POST.get('content_type') or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            )[:100],
+            size=size,
+            path=attachments.createFile()
+        )
+
+        return JsonResponse({
+            "id": attachment.pk,
+            "offset": 0,
+            "chunk_size": attachments.CHUNK_SIZE,
+            "upload_url": reverse('attachment-upload', args=[attachment.pk]),
+            "url": reverse('attachment', args=[attachment.pk]),
+        }, status=201)
+
+class AttachmentUploadView(AsyncLoginRequiredMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    async def get(self, request, pk):
+        # Where to resume from
+        attachment = await database_sync_to_async(
+            Attachment.objects.filter(pk=pk, uploader=request.user).first
+        )()
+        if attachment is None:
+            return JsonResponse({"message": "Upload not found."}, status=404)
+
+        return JsonResponse({
+            "offset": attachment.received,
+            "size": attachment.size,
+            "complete": attachment.is_complete,
+            "chunk_size": attachments.CHUNK_SIZE,
+        })
+
+    async def put(self, request, pk):
+        attachment = await database_sync_to_async(
+            Attachment.objects.filter(pk=pk, uploader=request.user).first
+        )()
+        if attachment is None:
+            return JsonResponse({"message": "Upload not found."}, status=404)
+
+        # A finished file never changes, e.g. when the last chunk is retried
+        if attachment.is_complete:
+            return JsonResponse({"offset": attachment.received, "complete": True})
+
+        try:
+            first, last = attachments.parseContentRange(request.headers.get('Content-Range'), attachment.size)
+        except ValueError as e:
+            return JsonResponse({"message": str(e)}, status=400)
+
+        length = last - first + 1
+        if length > attachments.CHUNK_SIZE:
+            return JsonResponse({"message": f"Chunks can be at most {attachments.CHUNK_SIZE} bytes."}, status=413)
+        if first > attachment.received:
+            return JsonResponse(
+                {"message": "Chunks must continue from the stored offset.", "offset": attachment.received},
+                status=409
+            )
+
+        # Content-Length was checked by attachments.UploadSizeLimit before the ASGI handler buffered the body
+        written = await sync_to_async(attachments.writeChunk, thread_sensitive=False)(
+            attachment.path, first, request, length
+        )
+        offset = await database_sync_to_async(attachment.advance)(first + written)
+
+        if written < length:
+            return JsonResponse({"message": "The body is shorter than its Content-Range.", "offset": offset}, status=400)
+
+        return JsonResponse({"offset": offset, "complete": attachment.is_complete})
+
+class AttachmentView(AsyncLoginRequiredMixin, View):
+    login_url = '/'  # Redirect URL if not authenticated
+    redirect_field_name = 'next'  # Default (optional)
+
+    async def get(self, request, pk):
+        attachment = await database_sync_to_async(
+            Attachment.objects.select_related('message').filter(pk=pk).first
+        )()
+        # Only people in the conversation, see Attachment.isVisibleTo
+        if (
+            attachment is None or not attachment.is_complete
+            or not await database_sync_to_async(attachment.isVisibleTo)(request.user.id)
+        ):
+            return JsonResponse({"message": "Attachment not found."}, status=404)
+
+        size = attachment.size
+        etag = f'"{os.path.basename(attachment.path)}"'
+        last_modified = int(attachment.completed_at.timestamp())
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        # A Range only applies if the client's partial copy is of this file
+        byte_range = None
+        if request.headers.get('If-Range') in (None, etag, http_date(last_modified)):
+            try:
+                byte_range = attachments.parseRange(request.headers.get('Range'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        first, last = byte_range or (0, size - 1)
+        inline = attachment.content_type in attachments.INLINE_TYPES
+
+        response = StreamingHttpResponse(
+            attachments.readFile(attachment.path, first, last),
+            status=206 if byte_range else 200,
+            content_type=attachment.content_type if inline else 'application/octet-stream'
+        )
+        response['Content-Length'] = last - first + 1
+        if byte_range:
+            response['Content-Range'] = f'bytes {first}-{last}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Content-Disposition'] = content_disposition_header(not inline, attachment.name)
+        response['Cache-Control'] = 'private, max-age=86400'
+
+        attachments.countDownload(byte_range is not None)
+        return response
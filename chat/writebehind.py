@@ -0,0 +1,93 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+from channels.db import database_sync_to_async
+
+
+WRITE_BEHIND = getattr(settings, 'CHAT_WRITE_BEHIND', {})
+MAX_BATCH = WRITE_BEHIND.get('MAX_BATCH', 100)
+MAX_DELAY = WRITE_BEHIND.get('MAX_DELAY_MS', 5) / 1000
+
+# One queue per (event loop, name); consumers in the same process share it
+_queues = weakref.WeakKeyDictionary()
+
+
+class WriteBehindQueue:
+    """
+    Collects writes from many consumers and hands them to flush_fn in batches.
+
+    A batch is flushed as soon as it holds max_batch items or max_delay seconds
+    after its first item arrived. flush_fn runs in a worker thread and must
+    return one result per item in the same order; submit() resolves with that
+    item's result once the whole batch has committed.
+    """
+
+    def __init__(self, flush_fn, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.flush = database_sync_to_async(flush_fn)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = asyncio.Queue()
+        self.full = asyncio.Event()
+        self.batches = 0
+        self.items = 0
+        self.worker = None
+
+    async def submit(self, item):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.put_nowait((item, future))
+        if self.pending.qsize() >= self.max_batch - 1:
+            self.full.set()
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.pending.get()]
+
+            # Give the batch max_delay to fill up, unless it's already full
+            if self.pending.qsize() < self.max_batch - 1:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+
+            while len(batch) < self.max_batch and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+
+            await self.write(batch)
+
+    async def write(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.flush(items)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def drain(self):
+        """Flushes whatever is queued right now (used by tests and shutdown)."""
+        batch = []
+        while not self.pending.empty():
+            batch.append(self.pending.get_nowait())
+        if batch:
+            await self.write(batch)
+
+
+def getQueue(name, flush_fn):
+    """Returns the queue called name for the running event loop, creating it if needed."""
+    queues = _queues.setdefault(asyncio.get_running_loop(), {})
+    if name not in queues:
+        queues[name] = WriteBehindQueue(flush_fn)
+    return queues[name]
@@ -0,0 +1,152 @@
+"""
+Avatar variants for users and rooms.
+
+Saving a model whose avatar file changed queues a job (after the
+transaction commits) that renders square SIZES-pixel copies next to the
+original, in its format and, with WEBP, as WebP:
+
+    users/gwen/avatar.jpg -> avatar_48.jpg, avatar_48.webp, avatar_96.jpg, ...
+
+The jobs run in a process pool, off the request path. When one finishes, the
+variant names are stored in the model's avatar_variants field along with
+the avatar they were made from, and avatarUrl(size) starts returning them.
+Until then (or for an avatar with no variants) it returns the original.
+
+Saves that don't change the avatar, such as save(update_fields=[...]), never
+open the image. Variants are stored with update(), which sends no post_save,
+so variantsRecorded is sent instead for caches of pages that show them.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+AVATARS = getattr(settings, 'AVATARS', {})
+SIZES = AVATARS.get('SIZES', [48, 96, 300])
+WEBP = AVATARS.get('WEBP', True)
+WORKERS = AVATARS.get('WORKERS', 2)  # 0 renders inline, e.g. in tests and management commands
+
+_pool = None
+
+# Sent with the model as sender and pk= once an avatar's variants are stored
+variantsRecorded = Signal()
+
+
+def renderVariants(media_root, name, sizes, webp):
+    """
+    Runs in a pool process: writes the variants of one avatar and returns
+    {"48": name, "48.webp": name, ...}. Variants newer than the original are
+    left alone, so running it twice for the same file is cheap.
+    """
+    source = os.path.join(media_root, name)
+    stem, ext = os.path.splitext(name)
+    source_mtime = os.path.getmtime(source)
+
+    formats = [(ext, '')]
+    if webp and ext.lower() != '.webp':
+        formats.append(('.webp', '.webp'))
+
+    variants = {}
+    image = None
+    try:
+        for size in sizes:
+            for extension, suffix in formats:
+                variant = f'{stem}_{size}{extension}'
+                variants[f'{size}{suffix}'] = variant
+
+                target = os.path.join(media_root, variant)
+                if os.path.exists(target) and os.path.getmtime(target) >= source_mtime:
+                    continue
+
+                if image is None:
+                    image = ImageOps.exif_transpose(Image.open(source))
+                    if image.mode not in ('RGB', 'RGBA'):
+                        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+                resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+                if extension.lower() in ('.jpg', '.jpeg') and resized.mode != 'RGB':
+                    resized = resized.convert('RGB')
+                resized.save(target, quality=85)
+    finally:
+        if image is not None:
+            image.close()
+    return variants
+
+
+def getPool():
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the server process has threads and an event loop
+        _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def needsVariants(instance, update_fields=None):
+    if update_fields is not None and 'avatar' not in update_fields:
+        return False
+    return bool(instance.avatar) and instance.avatar_variants.get('source') != instance.avatar.name
+
+
+def record(model, pk, name, variants):
+    # Only if the avatar hasn't changed again in the meantime
+    if model.objects.filter(pk=pk, avatar=name).update(avatar_variants={'source': name, **variants}):
+        variantsRecorded.send(sender=model, pk=pk)
+
+
+def process(instance):
+    """Renders and records the variants of instance's current avatar."""
+    name = instance.avatar.name
+    args = (str(settings.MEDIA_ROOT), name, SIZES, WEBP)
+
+    if not WORKERS:
+        try:
+            variants = renderVariants(*args)
+        except Exception:
+            logger.exception('Could not make avatar variants for %s %s', type(instance).__name__, instance.pk)
+            return
+        record(type(instance), instance.pk, name, variants)
+        instance.avatar_variants = {'source': name, **variants}
+        return
+
+    model, pk = type(instance), instance.pk
+
+    def done(future):
+        # Called on the pool's management thread
+        try:
+            record(model, pk, name, future.result())
+        except Exception:
+            logger.exception('Could not make avatar variants for %s %s', model.__name__, pk)
+        finally:
+            close_old_connections()
+
+    getPool().submit(renderVariants, *args).add_done_callback(done)
+
+
+def avatarSaved(instance, update_fields=None):
+    """Called at the end of save(): queues the variants if the avatar file changed."""
+    if needsVariants(instance, update_fields):
+        transaction.on_commit(lambda: process(instance))
+
+
+def variantUrl(instance, size, webp=False):
+    """The URL of the smallest variant at least size pixels wide, else of the original avatar."""
+    if not instance.avatar:
+        return settings.MEDIA_URL + 'default.jpg'
+
+    variants = instance.avatar_variants
+    if variants.get('source') == instance.avatar.name:
+        for known in sorted(SIZES):
+            if known < size:
+                continue
+            # WebP originals only have the one format
+            for key in ([f'{known}.webp'] if webp else []) + [str(known)]:
+                if key in variants:
+                    return instance.avatar.storage.url(variants[key])
+    return instance.avatar.url
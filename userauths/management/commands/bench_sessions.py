@@ -0,0 +1,149 @@
+import asyncio
+import datetime
+import statistics
+import time
+from importlib import import_module
+from unittest import mock
+
+from channels.auth import AuthMiddlewareStack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from userauths import middleware, sessions
+from userauths.models import CustomUser
+
+ENGINES = [
+    ('db', 'django.contrib.sessions.backends.db', AuthMiddlewareStack),
+    ('cached', 'userauths.sessions', middleware.CachedAuthMiddlewareStack),
+]
+
+
+class AcceptConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        if self.scope["user"].is_authenticated:
+            await self.accept()
+        else:
+            await self.close()
+
+
+def page(request):
+    request.session.get(SESSION_KEY)  # As the auth middleware does on every request
+    return HttpResponse()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda fraction: samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    return statistics.median(samples), pick(0.95), pick(0.99)
+
+
+class Command(BaseCommand):
+    help = 'Compare WebSocket handshake latency and session-table writes of the plain and cached session engines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Logged-in users (existing accounts) to simulate')
+        parser.add_argument('--handshakes', type=int, default=50, help='Handshakes per user')
+        parser.add_argument('--minutes', type=int, default=10, help='Simulated minutes of page requests')
+        parser.add_argument('--requests-per-minute', type=int, default=6, help='Page requests per user per minute')
+
+    def handle(self, *args, **options):
+        users = list(CustomUser.objects.filter(is_active=True).order_by('pk')[:options['users']])
+        if not users:
+            raise CommandError('No active users to log in as')
+
+        self.stdout.write(
+            f'{len(users)} users; handshake latency over {options["handshakes"]} handshakes each, '
+            f'session writes over {options["minutes"]} simulated minutes at '
+            f'{options["requests_per_minute"]} requests/user/minute'
+        )
+        self.stdout.write(
+            f'{"engine":<10}{"p50 µs":>10}{"p95 µs":>10}{"p99 µs":>10}{"writes/min":>12}{"cache hits":>12}'
+        )
+
+        for name, engine, stack in ENGINES:
+            with override_settings(SESSION_ENGINE=engine):
+                sessions._sessions.clear()
+                middleware._users.clear()
+                sessions.resetStats()
+                middleware.resetStats()
+
+                session_keys = [self.logIn(user) for user in users]
+                try:
+                    latencies = asyncio.run(self.handshakes(stack, session_keys, options['handshakes']))
+                    writes = self.pageRequests(session_keys, options['minutes'], options['requests_per_minute'])
+                finally:
+                    import_module(engine).SessionStore.get_model_class().objects.filter(
+                        session_key__in=session_keys
+                    ).delete()
+
+            p50, p95, p99 = (value * 1_000_000 for value in percentiles(latencies))
+            hits = middleware.stats()['hits'] if engine == 'userauths.sessions' else 0
+            self.stdout.write(
+                f'{name:<10}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}'
+                f'{writes / options["minutes"]:>12.1f}{hits / len(latencies):>12.0%}'
+            )
+
+    def logIn(self, user):
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    async def handshakes(self, stack, session_keys, count):
+        application = stack(AcceptConsumer.as_asgi())
+        latencies = []
+
+        for _ in range(count):
+            for session_key in session_keys:
+                headers = [(b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode())]
+                communicator = WebsocketCommunicator(application, '/ws/bench/', headers=headers)
+
+                started = time.perf_counter()
+                connected, _ = await communicator.connect()
+                latencies.append(time.perf_counter() - started)
+
+                if not connected:
+                    raise CommandError('Handshake was not authenticated')
+                await communicator.disconnect()
+        return latencies
+
+    def pageRequests(self, session_keys, minutes, per_minute):
+        """
+        Page requests through SessionMiddleware with SESSION_SAVE_EVERY_REQUEST,
+        on a simulated clock so minutes of traffic run in a moment.
+        Returns the number of writes to the session table.
+        """
+        writes = 0
+
+        def countWrites(execute, sql, params, many, context):
+            nonlocal writes
+            if sql.startswith(('UPDATE "django_session"', 'INSERT INTO "django_session"')):
+                writes += 1
+            return execute(sql, params, many, context)
+
+        factory = RequestFactory()
+        session_middleware = SessionMiddleware(page)
+        clock = timezone.now()
+        step = datetime.timedelta(minutes=1) / (per_minute * len(session_keys))
+
+        with override_settings(SESSION_SAVE_EVERY_REQUEST=True), \
+                mock.patch('django.utils.timezone.now', lambda: clock), \
+                connection.execute_wrapper(countWrites):
+            for _ in range(minutes * per_minute):
+                for session_key in session_keys:
+                    request = factory.get('/chat/conversations-list/')
+                    request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+                    session_middleware(request)
+                    clock += step
+
+        return writes
@@ -0,0 +1,74 @@
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import RoomModel
+from userauths import avatars, storage
+from userauths.models import CustomUser
+
+MODELS = (CustomUser, RoomModel)
+
+
+class Command(BaseCommand):
+    help = 'Move user and room avatars saved under their old names into content-addressed storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved')
+        parser.add_argument('--keep', action='store_true', help='Leave the old files and their variants in place')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, storage.ContentAddressedStorage):
+            raise CommandError('The default storage is not userauths.storage.ContentAddressedStorage')
+
+        # default.jpg is what new rows get, so it stays where it is
+        defaults = {model._meta.get_field('avatar').default for model in MODELS}
+        names = set()
+        for model in MODELS:
+            names.update(model.objects.exclude(avatar='').values_list('avatar', flat=True).distinct())
+        names = sorted(name for name in names if name not in defaults and not storage.isBlob(name))
+
+        moved = missing = rows = 0
+        blobs = set()
+        for name in names:
+            if not default_storage.exists(name):
+                self.stderr.write(f'{name}: file is missing, left as is')
+                missing += 1
+                continue
+
+            if options['dry_run']:
+                self.stdout.write(f'{name}: would be moved')
+                continue
+
+            with default_storage.open(name) as content:
+                blob = default_storage.save(name, content)
+            blobs.add(blob)
+
+            # Existing variants are remade next to the blob, if not there yet
+            variants = avatars.renderVariants(str(settings.MEDIA_ROOT), blob, avatars.SIZES, avatars.WEBP)
+            for model in MODELS:
+                rows += model.objects.filter(avatar=name).update(
+                    avatar=blob, avatar_variants={'source': blob, **variants}
+                )
+            moved += 1
+
+            if not options['keep']:
+                self.deleteOld(name)
+
+        if options['dry_run']:
+            self.stdout.write(f'{len(names) - missing} files to move, {missing} missing')
+        else:
+            self.stdout.write(f'{moved} files moved into {len(blobs)} blobs for {rows} rows, {missing} missing')
+
+    def deleteOld(self, name):
+        stem, ext = os.path.splitext(name)
+        # The file itself and the variants rebuild_avatars made from it
+        for old in [name] + [f'{stem}_{size}{suffix}' for size in avatars.SIZES for suffix in (ext, '.webp')]:
+            default_storage.delete(old)
+
+        # Like handleUsernameChange, drop the user's directory once it's empty
+        try:
+            os.removedirs(os.path.dirname(default_storage.path(name)))
+        except OSError:
+            pass
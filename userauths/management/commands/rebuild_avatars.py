@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.models import RoomModel
+from userauths import avatars
+from userauths.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Make the resized avatar variants of users and rooms that have none for their current avatar'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Re-record every avatar, not only those missing variants')
+
+    def handle(self, *args, **options):
+        for model in (CustomUser, RoomModel):
+            processed = failed = 0
+            for owner in model.objects.only('pk', 'avatar', 'avatar_variants').iterator():
+                if not owner.avatar or not (options['all'] or avatars.needsVariants(owner)):
+                    continue
+
+                try:
+                    variants = avatars.renderVariants(
+                        str(settings.MEDIA_ROOT), owner.avatar.name, avatars.SIZES, avatars.WEBP
+                    )
+                except (OSError, ValueError) as error:
+                    self.stderr.write(f'{model.__name__} {owner.pk}: {error}')
+                    failed += 1
+                    continue
+
+                avatars.record(model, owner.pk, owner.avatar.name, variants)
+                processed += 1
+
+            self.stdout.write(f'{model.__name__}: {processed} processed, {failed} failed')
@@ -0,0 +1,55 @@
+"""
+Serves MEDIA_URL from the ASGI application, with caching headers.
+
+Content-addressed files (see userauths.storage) never change, so they go
+out with a far-future, immutable Cache-Control and their hash as ETag.
+Other files, like default.jpg, must be revalidated but get an ETag and
+Last-Modified, so revalidating costs a 304 rather than the file.
+"""
+import os
+import posixpath
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.http import Http404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.views.static import serve
+
+from . import storage
+
+MEDIA_FILES = getattr(settings, 'MEDIA_FILES', {})
+IMMUTABLE_MAX_AGE = MEDIA_FILES.get('IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+MUTABLE_CACHE_CONTROL = MEDIA_FILES.get('MUTABLE_CACHE_CONTROL', 'public, no-cache')
+
+
+def cacheHeaders(name, stat):
+    """(ETag, Cache-Control) for the media file called name."""
+    match = storage.BLOB_NAME.match(name)
+    if match:
+        etag = '"%s%s"' % (match.group(1), match.group(2) or '')
+        return etag, f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size), MUTABLE_CACHE_CONTROL
+
+
+class MediaFilesHandler(ASGIStaticFilesHandler):
+    """Wraps the HTTP application and answers requests under MEDIA_URL itself."""
+
+    def get_base_url(self):
+        return settings.MEDIA_URL
+
+    def serve(self, request):
+        name = posixpath.normpath(self.file_path(request.path)).lstrip('/')
+        try:
+            stat = os.stat(safe_join(settings.MEDIA_ROOT, name))
+        except (OSError, ValueError, SuspiciousFileOperation):
+            raise Http404('"%s" does not exist' % name)
+
+        etag, cache_control = cacheHeaders(name, stat)
+        response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+        if response is None:
+            response = serve(request, name, document_root=settings.MEDIA_ROOT)
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = cache_control
+        return response
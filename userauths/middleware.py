@@ -0,0 +1,142 @@
+"""
+WebSocket authentication with the session and user looked up in memory.
+
+CachedAuthMiddlewareStack replaces channels' AuthMiddlewareStack. When the
+session is in the userauths.sessions cache and the user was loaded in the
+last USER_TTL_S seconds, the handshake resolves scope["user"] without a
+query or a thread hop. Otherwise it falls back to loading both, like
+channels does, and caches them for the next handshake.
+
+Cached users carry a version token like sessions do (see
+userauths.sessions), so a password change or deactivation saved by any
+worker reaches the handshakes of the others, given a shared cache.
+"""
+import copy
+import threading
+import time
+
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare
+
+from . import sessions
+
+CACHE = getattr(settings, 'AUTH_CACHE', {})
+USER_TTL = CACHE.get('USER_TTL_S', 10)
+
+_users = {}  # user id -> (user, version, loaded at)
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def sessionLogin(session):
+    """(backend path, user id) of the login stored in a session, or None."""
+    try:
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return None
+
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    return backend_path, user_id
+
+
+def hashMatches(session, user):
+    # Sessions made before a password change stop working, as in django.contrib.auth
+    if not hasattr(user, 'get_session_auth_hash'):
+        return True
+    session_hash = session.get(HASH_SESSION_KEY)
+    return bool(session_hash) and constant_time_compare(session_hash, user.get_session_auth_hash())
+
+
+def cachedUser(user_id):
+    cached = _users.get(user_id)
+    if cached is None or time.monotonic() - cached[2] >= USER_TTL:
+        return None
+    if caches[sessions.SHARED_CACHE].get(sessions.versionKey('user', user_id)) != cached[1]:
+        return None  # Changed since, maybe in another worker
+    # Each connection gets its own instance
+    return copy.copy(cached[0])
+
+
+def forgetUser(user_id):
+    """Drops a user from the cache of every worker."""
+    _users.pop(user_id, None)
+    sessions.changeVersion('user', user_id)
+
+
+def loadUser(backend_path, user_id):
+    version = sessions.currentVersion('user', user_id)
+    user = load_backend(backend_path).get_user(user_id)
+    if user is not None:
+        if len(_users) >= sessions.MAX_ENTRIES:
+            _users.clear()
+        _users[user.pk] = (copy.copy(user), version, time.monotonic())
+    return user
+
+
+@database_sync_to_async
+def getUser(scope):
+    """channels.auth.get_user, going through the caches."""
+    session = scope["session"]
+    login = sessionLogin(session)
+    if login is None:
+        return AnonymousUser()
+
+    user = loadUser(*login)
+    if user is not None and not hashMatches(session, user):
+        session.flush()
+        user = None
+    return user or AnonymousUser()
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+
+    async def resolve_scope(self, scope):
+        user = None
+        session_data = sessions.peek(scope["session"].session_key)
+        if session_data is not None:
+            login = sessionLogin(session_data)
+            if login is None:
+                user = AnonymousUser()
+            else:
+                user = cachedUser(login[1])
+                if user is not None and not hashMatches(session_data, user):
+                    user = None  # Maybe cached before a password change; ask the database
+
+        if user is not None:
+            _count('hits')
+        else:
+            _count('misses')
+            user = await getUser(scope)
+
+        scope["user"]._wrapped = user
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+def stats():
+    """User cache counters for this process."""
+    with _lock:
+        counters = dict(_counters)
+    counters['cached'] = len(_users)
+    return counters
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
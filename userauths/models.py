@@ -1,11 +1,12 @@
 import os
-from PIL import Image
 from django.utils.text import slugify
 
 from django.db import models
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import AbstractUser
 
+from . import avatars
+
 def userDirectoryPath(instance, filename):
     """Generate path for user uploads using username instead of ID"""
     # Get file extension
@@ -50,6 +51,8 @@ class CustomUser(AbstractUser):
         default='default.jpg',
         help_text='Profile picture (300x300 recommended)'
     )
+    # Resized copies of the avatar, filled in by userauths.avatars
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     
     # Social media fields with better validation
     website = models.URLField(
@@ -96,11 +99,12 @@ class CustomUser(AbstractUser):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
-        img = Image.open(self.avatar.path)
-        if img.height > 300 or img.width > 300:
-            output_size = (300, 300) # (height, width)
-            img.thumbnail(output_size)
-            img.save(self.avatar.path)
+        # Resized copies are made in the background, and only when the file changed
+        avatars.avatarSaved(self, kwargs.get('update_fields'))
+
+    def avatarUrl(self, size=48, webp=False):
+        """The avatar sized for a size-pixel slot (see userauths.avatars)."""
+        return avatars.variantUrl(self, size, webp)
 
     def __str__(self):
         # return f'{self.username} ({self.email})'
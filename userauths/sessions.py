@@ -0,0 +1,177 @@
+"""
+Database sessions with an in-process cache in front.
+
+Set SESSION_ENGINE = 'userauths.sessions'. Sessions are still stored in the
+django_session table, so every process sees them, but:
+
+- a session loaded in the last TTL_S seconds is served from memory, which
+  makes the WebSocket handshake that follows a page load free;
+- with SESSION_SAVE_EVERY_REQUEST, a request that only pushes the expiry
+  forward skips the UPDATE unless the stored expiry is TOUCH_INTERVAL_S
+  behind. A session then expires at most that much earlier than it would
+  otherwise.
+
+Entries are kept per process, so each one is stored with a version token
+read from a Django cache (AUTH_CACHE["CACHE"]) before the database was:
+
+    auth:session:<session key>:version -> "9c1e0f..."
+
+forget() replaces the token, and an entry whose token is no longer current
+is ignored, so a logout or key change in one worker reaches the others on
+their next lookup. That takes a cache shared by the workers; with the
+local-memory default it only covers this process. userauths.middleware
+does the same for users.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+CACHE = getattr(settings, 'AUTH_CACHE', {})
+TTL = CACHE.get('SESSION_TTL_S', 10)
+TOUCH_INTERVAL = CACHE.get('TOUCH_INTERVAL_S', 60)
+MAX_ENTRIES = CACHE.get('MAX_ENTRIES', 10_000)
+SHARED_CACHE = CACHE.get('CACHE', 'default')
+VERSION_TIMEOUT = 300  # Seconds; outlives cached entries, and a lost token only costs a miss
+
+_sessions = {}  # session key -> CachedSession
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'writes': 0, 'touches_skipped': 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def versionKey(kind, key):
+    return f'auth:{kind}:{key}:version'
+
+
+def currentVersion(kind, key):
+    """The shared token for a session or user; read it before loading from the database."""
+    cache = caches[SHARED_CACHE]
+    version = cache.get(versionKey(kind, key))
+    if version is None:
+        # add(), so workers starting at once agree on one token
+        cache.add(versionKey(kind, key), uuid.uuid4().hex, VERSION_TIMEOUT)
+        version = cache.get(versionKey(kind, key))
+    return version
+
+
+def changeVersion(kind, key):
+    """Makes every worker's cached copy of a session or user stale."""
+    def change():
+        caches[SHARED_CACHE].set(versionKey(kind, key), uuid.uuid4().hex, VERSION_TIMEOUT)
+
+    change()
+    # Again on commit: a worker that loaded the old row in between cached it under the new token
+    transaction.on_commit(change)
+
+
+class CachedSession:
+    __slots__ = ('data', 'expire_date', 'version', 'loaded_at')
+
+    def __init__(self, data, expire_date, version):
+        self.data = data
+        self.expire_date = expire_date  # As last written to (or read from) the database
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def isFresh(self, session_key):
+        if time.monotonic() - self.loaded_at >= TTL or self.expire_date <= timezone.now():
+            return False
+        return caches[SHARED_CACHE].get(versionKey('session', session_key)) == self.version
+
+
+def remember(session_key, data, expire_date, version):
+    if len(_sessions) >= MAX_ENTRIES:
+        now = timezone.now()
+        for key in [key for key, cached in _sessions.items() if cached.expire_date <= now]:
+            _sessions.pop(key, None)
+        if len(_sessions) >= MAX_ENTRIES:
+            _sessions.clear()
+
+    _sessions[session_key] = CachedSession(dict(data), expire_date, version)
+
+
+def forget(session_key):
+    """Drops a session from the cache of every worker."""
+    _sessions.pop(session_key, None)
+    changeVersion('session', session_key)
+
+
+def peek(session_key):
+    """The cached data of a session if it is fresh, else None. Never touches the database."""
+    cached = _sessions.get(session_key) if session_key else None
+    if cached is None or not cached.isFresh(session_key):
+        return None
+    return dict(cached.data)
+
+
+class SessionStore(DBStore):
+
+    def load(self):
+        data = peek(self.session_key)
+        if data is not None:
+            _count('hits')
+            return data
+
+        _count('misses')
+        session_key = self.session_key
+        version = currentVersion('session', session_key)
+        session = self._get_session_from_db()
+        if session is None:
+            # Missing or expired; the lookup also cleared self.session_key
+            _sessions.pop(session_key, None)
+            return {}
+
+        data = self.decode(session.session_data)
+        remember(session.session_key, data, session.expire_date, version)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()  # Saves again with must_create=True
+
+        if not must_create and not self.modified and self.isRecentlyTouched():
+            _count('touches_skipped')
+            return
+
+        version = currentVersion('session', self.session_key)
+        super().save(must_create=must_create)
+        _count('writes')
+        remember(self.session_key, self._get_session(no_load=True), self.get_expiry_date(), version)
+
+    def isRecentlyTouched(self):
+        cached = _sessions.get(self.session_key) if self.session_key else None
+        if cached is None:
+            return False
+        return (self.get_expiry_date() - cached.expire_date).total_seconds() < TOUCH_INTERVAL
+
+    def delete(self, session_key=None):
+        forget(session_key or self.session_key)
+        super().delete(session_key)
+
+    def cycle_key(self):
+        forget(self.session_key)
+        super().cycle_key()
+
+
+def stats():
+    """Session cache counters for this process."""
+    with _lock:
+        counters = dict(_counters)
+    counters['cached'] = len(_sessions)
+    return counters
+
+
+def resetStats():
+    with _lock:
+        for name in _counters:
+            _counters[name] = 0
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .middleware import forgetUser
+from .models import CustomUser
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def userChanged(sender, instance, **kwargs):
+    # Password, activation or profile changes reach new WebSocket handshakes right away
+    forgetUser(instance.pk)
@@ -0,0 +1,75 @@
+"""
+Content-addressed media storage.
+
+Uploads are stored under a name made from the SHA-256 of their bytes,
+whatever name the model's upload_to gives them:
+
+    users/gwen/avatar.JPG -> blobs/3f/3fa2...c9.jpg
+
+Identical uploads share one file, renaming a user or room leaves its
+avatar where it is, and since a name always means the same bytes the
+files can be cached forever (see userauths.media). Names derived from a
+blob, like the avatar variants blobs/3f/3fa2...c9_48.webp, are just as
+immutable.
+
+Files are shared, so a blob must not be deleted while any row still
+names it.
+"""
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+PREFIX = 'blobs'
+BLOB_NAME = re.compile(r'^%s/[0-9a-f]{2}/([0-9a-f]{64})(_\w+)?(\.\w+)?$' % PREFIX)
+
+_counters = {'stored': 0, 'deduplicated': 0}
+
+
+def contentHash(content):
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blobName(digest, ext):
+    return f'{PREFIX}/{digest[:2]}/{digest}{ext.lower()}'
+
+
+def isBlob(name):
+    """Whether name is a content-addressed file, or derived from one."""
+    return BLOB_NAME.match(name) is not None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = blobName(contentHash(content), os.path.splitext(name)[1])
+        if self.exists(name):
+            # Two uploads of the same bytes racing past this check end up as
+            # two files, the second with a suffix; both are still correct
+            _counters['deduplicated'] += 1
+            return name
+
+        _counters['stored'] += 1
+        return super().save(name, content, max_length)
+
+
+def stats():
+    """Storage counters for this process."""
+    return dict(_counters)
+
+
+def resetStats():
+    for name in _counters:
+        _counters[name] = 0
@@ -0,0 +1,16 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def avatar_url(owner, size=48):
+    """{{ user|avatar_url:48 }}: the avatar variant for a 48px slot."""
+    return owner.avatarUrl(int(size))
+
+
+@register.filter
+def avatar_srcset(owner, size=48):
+    """{{ user|avatar_srcset:48 }}: WebP variants for 1x and 2x screens."""
+    size = int(size)
+    return f'{owner.avatarUrl(size, webp=True)} 1x, {owner.avatarUrl(size * 2, webp=True)} 2x'
@@ -1,3 +1,199 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from unittest import mock
+from PIL import Image
+
+from . import avatars, media, middleware, sessions, storage
+from .models import CustomUser
+
+
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        sessions._sessions.clear()
+        middleware._users.clear()
+        self.user = CustomUser.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.backend = settings.AUTHENTICATION_BACKENDS[0]
+
+    def logIn(self):
+        session = sessions.SessionStore()
+        session[SESSION_KEY] = str(self.user.pk)
+        session[BACKEND_SESSION_KEY] = self.backend
+        session[HASH_SESSION_KEY] = self.user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    def test_session_forgotten_by_another_worker(self):
+        session_key = self.logIn()
+        self.assertIsNotNone(sessions.peek(session_key))
+
+        # What forget() in another process does through the shared cache
+        sessions.changeVersion('session', session_key)
+
+        self.assertIsNone(sessions.peek(session_key))
+        self.assertEqual(sessions.SessionStore(session_key).load()[SESSION_KEY], str(self.user.pk))
+        self.assertIsNotNone(sessions.peek(session_key))
+
+    def test_logout_drops_cached_session(self):
+        session_key = self.logIn()
+        sessions.SessionStore(session_key).delete()
+
+        self.assertIsNone(sessions.peek(session_key))
+        self.assertEqual(sessions.SessionStore(session_key).load(), {})
+
+    def test_user_changed_by_another_worker(self):
+        middleware.loadUser(self.backend, self.user.pk)
+        self.assertIsNotNone(middleware.cachedUser(self.user.pk))
+
+        # A password change saved in another process
+        CustomUser.objects.filter(pk=self.user.pk).update(password='changed')
+        sessions.changeVersion('user', self.user.pk)
+
+        self.assertIsNone(middleware.cachedUser(self.user.pk))
+        self.assertEqual(middleware.loadUser(self.backend, self.user.pk).password, 'changed')
+        self.assertEqual(middleware.cachedUser(self.user.pk).password, 'changed')
+
+    def test_saving_a_user_drops_it_from_the_cache(self):
+        middleware.loadUser(self.backend, self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(middleware.cachedUser(self.user.pk))
+
+
+class MediaStorageTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        settings_override = override_settings(MEDIA_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def writeImage(self, name, color='red'):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (400, 400), color).save(path)
+        return name
+
+    def test_identical_uploads_share_a_blob(self):
+        first = default_storage.save('users/alice/avatar.JPG', ContentFile(b'same bytes'))
+        second = default_storage.save('users/bob/avatar.jpg', ContentFile(b'same bytes'))
+        other = default_storage.save('users/carol/avatar.jpg', ContentFile(b'other bytes'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertTrue(storage.isBlob(first))
+        self.assertTrue(first.endswith('.jpg'))
+        self.assertFalse(storage.isBlob('users/alice/avatar.jpg'))
+
+    def test_blobs_are_served_immutable(self):
+        name = default_storage.save('avatar.jpg', ContentFile(b'avatar bytes'))
+        handler = media.MediaFilesHandler(None)
+
+        response = handler.serve(RequestFactory().get(settings.MEDIA_URL + name))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        revalidated = handler.serve(RequestFactory().get(settings.MEDIA_URL + name, HTTP_IF_NONE_MATCH=response['ETag']))
+        self.assertEqual(revalidated.status_code, 304)
+
+        self.writeImage('default.jpg')
+        response = handler.serve(RequestFactory().get(settings.MEDIA_URL + 'default.jpg'))
+        self.assertEqual(response['Cache-Control'], media.MUTABLE_CACHE_CONTROL)
+
+        with self.assertRaises(Http404):
+            handler.serve(RequestFactory().get(settings.MEDIA_URL + '../secret.txt'))
+
+    def test_migrate_media_moves_avatars_into_blobs(self):
+        alice = CustomUser.objects.create_user(username='alice', email='alice@example.com', password='password')
+        bob = CustomUser.objects.create_user(username='bob', email='bob@example.com', password='password')
+        old = self.writeImage('users/alice/avatar.jpg')
+        self.writeImage('users/bob/avatar.jpg')
+        CustomUser.objects.filter(pk=alice.pk).update(avatar=old)
+        CustomUser.objects.filter(pk=bob.pk).update(avatar='users/bob/avatar.jpg')
+
+        call_command('migrate_media', stdout=io.StringIO())
+
+        alice.refresh_from_db()
+        bob.refresh_from_db()
+        # Same pixels, same file
+        self.assertEqual(alice.avatar.name, bob.avatar.name)
+        self.assertTrue(storage.isBlob(alice.avatar.name))
+        self.assertEqual(alice.avatar_variants['source'], alice.avatar.name)
+        self.assertTrue(default_storage.exists(alice.avatar_variants['96']))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'users', 'alice')))
+
+
+class AvatarVariantsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        settings_override = override_settings(MEDIA_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.alice = CustomUser.objects.create_user(username='alice', email='alice@example.com', password='password')
+
+    def writeImage(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (400, 300), 'red').save(path)
+        return name
+
+    def changeAvatar(self, name):
+        self.alice.avatar = self.writeImage(name)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.save()
+
+    def test_changed_avatar_gets_every_size_and_webp(self):
+        self.changeAvatar('users/alice/avatar.jpg')
+
+        self.alice.refresh_from_db()
+        variants = dict(self.alice.avatar_variants)
+        self.assertEqual(variants.pop('source'), 'users/alice/avatar.jpg')
+        self.assertEqual(set(variants), {'48', '48.webp', '96', '96.webp', '300', '300.webp'})
+        for key, name in variants.items():
+            size = int(key.split('.')[0])
+            with Image.open(os.path.join(self.root, name)) as image:
+                self.assertEqual(image.size, (size, size))
+                self.assertEqual(image.format, 'WEBP' if key.endswith('.webp') else 'JPEG')
+
+        self.assertEqual(self.alice.avatarUrl(80), settings.MEDIA_URL + variants['96'])
+
+    def test_saves_that_keep_the_avatar_do_not_open_it(self):
+        self.changeAvatar('users/alice/avatar.jpg')
+        self.alice.refresh_from_db()
+
+        with mock.patch.object(avatars, 'process', wraps=avatars.process) as processed, \
+                mock.patch.object(avatars.Image, 'open', wraps=Image.open) as opened:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.alice.save(update_fields=['last_activity'])
+                self.alice.first_name = 'Alice'
+                self.alice.save()
+
+        processed.assert_not_called()
+        opened.assert_not_called()
+
+    def test_rebuild_avatars_fills_in_missing_variants(self):
+        name = self.writeImage('users/alice/avatar.jpg')
+        CustomUser.objects.filter(pk=self.alice.pk).update(avatar=name, avatar_variants={})
+
+        output = io.StringIO()
+        call_command('rebuild_avatars', stdout=output)
+        self.assertIn('CustomUser: 1 processed, 0 failed', output.getvalue())
+
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.avatar_variants['source'], name)
+        self.assertTrue(os.path.exists(os.path.join(self.root, self.alice.avatar_variants['300.webp'])))